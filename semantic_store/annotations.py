@@ -1,7 +1,6 @@
 from django.db import transaction
 
 from rdflib import Literal, URIRef, Graph
-from rdflib.plugins.sparql import prepareQuery
 
 from semantic_store.rdfstore import rdfstore
 from semantic_store.namespaces import NS, ns, bind_namespaces
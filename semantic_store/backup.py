@@ -0,0 +1,595 @@
+"""
+Helpers for the backup_rdf and restore_rdf commands.
+
+An archive backup is a directory holding one or more compressed N-Quads files, and a manifest.json describing
+them:
+
+    {
+        "format": "nquads",
+        "compression": "gzip",
+        "created": "2014-03-01T12:00:00",
+        "files": ["graphs-000.nq.gz", ...],
+        "graphs": {
+            "<graph uri>": {"file": "graphs-000.nq.gz", "triples": 120, "sha1": "...", "version": "..."},
+            ...
+        }
+    }
+
+Each graph's quads are written together in one of the files, and its checksum is the sha1 of its sorted N-Quads
+lines. The version is the graph's version counter (see semantic_store.versions) when it was read, which lets an
+incremental backup skip graphs which have not been written since: their manifest entries are carried over,
+pointing at the file (relative to the new backup directory) which already holds them. This needs the version
+cache (SEMANTIC_STORE_CACHE) to be shared between processes, since a backup runs in its own: with a per process
+cache, every version starts afresh and nothing is skipped.
+
+A restore parses backup files in a pool of worker processes and adds the quads to the store in large batches
+(with store.addN, which is a bulk insert in one transaction on the SQLAlchemy store, and batched INSERT DATA
+requests on FourStore). Progress is recorded graph by graph in a checkpoint file, so an interrupted restore can
+be resumed, and the number of triples parsed for each graph is checked against the manifest.
+
+Each worker parses a whole file, so a restore runs at most one process per file, and holds up to one parsed file
+per process in memory. An archive is a single file unless more shards are asked for, which a restore reads in
+the restoring process, graph by graph, so only one graph is held in memory at a time (as it does for any backup
+with a single worker); an archive written with as many shards as the restore has workers is parsed in parallel.
+"""
+from rdflib import Graph, Literal, URIRef, BNode
+from rdflib.plugins.parsers.nquads import NQuadsParser
+from rdflib.plugins.parsers.ntriples import unquote, uriquote, ParseError, r_tail, r_wspace
+from rdflib.plugins.serializers.nt import _quoteLiteral
+from rdflib.util import guess_format
+from django.utils import simplejson
+
+from semantic_store import versions
+
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from codecs import getreader
+import datetime
+import gzip
+import hashlib
+import itertools
+import os
+import re
+import threading
+import urllib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = 'manifest.json'
+CHECKPOINT_FILENAME = '.restore_checkpoint'
+
+COMPRESSION_EXTENSIONS = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+    'none': '',
+}
+
+DEFAULT_WORKERS = 4
+
+# Archives are a single file unless sharding is asked for; a restore parses each file in one process, so an archive
+# needs at least as many shards as the restore has workers to be parsed in parallel
+DEFAULT_SHARDS = 1
+
+DEFAULT_BATCH_QUADS = 10000
+
+# Graphs fetched ahead of the writer per worker, which bounds the number held in memory at once
+FETCH_AHEAD = 4
+
+class BackupError(Exception):
+    pass
+
+def graph_identifier(context):
+    """Store.contexts() yields graphs from some stores and identifiers from others"""
+    return getattr(context, 'identifier', context)
+
+def open_compressed(path, mode='rb', compression=None):
+    """Opens a (possibly) compressed file, guessing the compression from the file extension if not given"""
+    if compression is None:
+        compression = 'none'
+        for name, extension in COMPRESSION_EXTENSIONS.iteritems():
+            if extension and path.endswith(extension):
+                compression = name
+
+    if compression == 'gzip':
+        return gzip.open(path, mode)
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise BackupError('zstd compression needs the zstandard package to be installed')
+        if 'w' in mode:
+            return zstandard.ZstdCompressor().stream_writer(open(path, mode))
+        else:
+            return zstandard.ZstdDecompressor().stream_reader(open(path, mode))
+    elif compression == 'none':
+        return open(path, mode)
+    else:
+        raise BackupError('Unknown compression "%s"' % compression)
+
+def nquads_line(triple, identifier=None):
+    """Returns the N-Quads line of a triple in the named graph identifier (or the N-Triples line, without one)"""
+    s, p, o = triple
+    if isinstance(o, Literal):
+        o_n3 = _quoteLiteral(o)
+    else:
+        o_n3 = o.n3()
+
+    if identifier is None:
+        return u'%s %s %s .\n' % (s.n3(), p.n3(), o_n3)
+    else:
+        return u'%s %s %s %s .\n' % (s.n3(), p.n3(), o_n3, identifier.n3())
+
+def nquads_row(triple, identifier):
+    return nquads_line(triple, identifier).encode('utf-8')
+
+def graph_nquads(store, identifier):
+    """Returns the N-Quads lines of a named graph, sorted so that they always checksum the same way"""
+    return sorted(nquads_row(triple, identifier) for triple in Graph(store, identifier))
+
+def checksum(lines):
+    digest = hashlib.sha1()
+    for line in lines:
+        digest.update(line)
+
+    return digest.hexdigest()
+
+def graph_version(graph_versions, identifier):
+    return '%x-%x' % (graph_versions[identifier], graph_versions[versions.ALL_GRAPHS])
+
+def bounded_imap_unordered(pool, function, items, workers, ahead=FETCH_AHEAD):
+    """
+    Like pool.imap_unordered, but only hands the pool `ahead` items per worker at a time, so that results can't
+    pile up in memory faster than the caller consumes them
+    """
+    items = list(items)
+    step = workers * ahead
+    for i in xrange(0, len(items), step):
+        for result in pool.imap_unordered(function, items[i:i + step]):
+            yield result
+
+def map_graphs(function, identifiers, workers=DEFAULT_WORKERS):
+    """
+    Yields function(identifier) for each of the graph identifiers, running it for up to `workers` graphs
+    concurrently. Results are yielded in the order they finish, not the order given.
+    """
+    if workers <= 1:
+        for identifier in identifiers:
+            yield function(identifier)
+        return
+
+    pool = ThreadPool(workers)
+    try:
+        for result in bounded_imap_unordered(pool, function, identifiers, workers):
+            yield result
+    finally:
+        pool.terminate()
+
+def fetch_graphs(store, identifiers, workers=DEFAULT_WORKERS):
+    """Yields (identifier, sorted N-Quads lines) for each of the named graphs"""
+    return map_graphs(lambda identifier: (identifier, graph_nquads(store, identifier)), identifiers, workers)
+
+def shard_filename(identifier, shards, compression):
+    shard = int(hashlib.md5(unicode(identifier).encode('utf-8')).hexdigest(), 16) % shards
+    return 'graphs-%03d.nq%s' % (shard, COMPRESSION_EXTENSIONS[compression])
+
+def read_manifest(directory):
+    path = os.path.join(directory, MANIFEST_FILENAME)
+    if not os.path.isfile(path):
+        raise BackupError('There is no %s in "%s"' % (MANIFEST_FILENAME, directory))
+
+    with open(path) as f:
+        return simplejson.load(f)
+
+def write_manifest(directory, manifest):
+    path = os.path.join(directory, MANIFEST_FILENAME)
+    with open(path + '.tmp', 'w') as f:
+        simplejson.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+def manifest_graph_path(directory, entry):
+    return os.path.normpath(os.path.join(directory, entry['file']))
+
+def write_archive(store, directory, compression='gzip', shards=DEFAULT_SHARDS, workers=DEFAULT_WORKERS, since=None):
+    """
+    Backs up every named graph in the store to `shards` compressed N-Quads files in directory, and returns
+    the manifest written alongside them. If since is the directory of an earlier archive backup, graphs whose
+    versions have not changed since it was made are not fetched again.
+    """
+    if compression not in COMPRESSION_EXTENSIONS:
+        raise BackupError('Unknown compression "%s"' % compression)
+    if compression == 'zstd' and zstandard is None:
+        raise BackupError('zstd compression needs the zstandard package to be installed')
+
+    identifiers = [graph_identifier(context) for context in store.contexts()]
+
+    # Versions are read before any graph is, so a write made during the backup is picked up by the next one
+    current_versions = versions.graph_versions(identifiers)
+
+    manifest = {
+        'format': 'nquads',
+        'compression': compression,
+        'created': datetime.datetime.now().isoformat(),
+        'base': os.path.abspath(since) if since else None,
+        'files': [],
+        'graphs': {},
+    }
+
+    to_fetch = identifiers
+    if since:
+        if not versions.is_shared():
+            logger.warning('SEMANTIC_STORE_CACHE is not shared between processes, so the versions read by this process '
+                           'start afresh and no graph will be found unchanged since %s', since)
+
+        previous = read_manifest(since).get('graphs', {})
+        to_fetch = []
+
+        for identifier in identifiers:
+            entry = previous.get(unicode(identifier))
+            if entry is not None and entry.get('version') == graph_version(current_versions, identifier):
+                carried = dict(entry, file=os.path.relpath(manifest_graph_path(since, entry), directory))
+                manifest['graphs'][unicode(identifier)] = carried
+            else:
+                to_fetch.append(identifier)
+
+        logger.info('%d of %d graphs unchanged since the backup in %s', len(identifiers) - len(to_fetch), len(identifiers), since)
+
+    files = {}
+    try:
+        for identifier, lines in fetch_graphs(store, to_fetch, workers):
+            filename = shard_filename(identifier, shards, compression)
+            if filename not in files:
+                files[filename] = open_compressed(os.path.join(directory, filename), 'wb', compression)
+
+            f = files[filename]
+            for line in lines:
+                f.write(line)
+
+            manifest['graphs'][unicode(identifier)] = {
+                'file': filename,
+                'triples': len(lines),
+                'sha1': checksum(lines),
+                'version': graph_version(current_versions, identifier),
+            }
+    finally:
+        for f in files.itervalues():
+            f.close()
+
+    manifest['files'] = sorted(set(entry['file'] for entry in manifest['graphs'].itervalues()))
+    write_manifest(directory, manifest)
+
+    return manifest
+
+def write_graph_files(store, directory, format='ttl', workers=DEFAULT_WORKERS):
+    """
+    Backs up each named graph in the store to its own file in directory, named with the url encoded graph uri,
+    and returns the manifest written alongside them
+    """
+    identifiers = [graph_identifier(context) for context in store.contexts()]
+    current_versions = versions.graph_versions(identifiers)
+
+    def backup_graph(identifier):
+        graph = Graph()
+        graph += Graph(store, identifier)
+
+        filename = '%s.%s' % (urllib.quote(identifier, ''), format)
+        graph.serialize(os.path.abspath(os.path.join(directory, filename)), format=guess_format(filename) or format)
+
+        lines = sorted(nquads_row(triple, identifier) for triple in graph)
+        return identifier, {
+            'file': filename,
+            'triples': len(lines),
+            'sha1': checksum(lines),
+            'version': graph_version(current_versions, identifier),
+        }
+
+    manifest = {
+        'format': format,
+        'compression': 'none',
+        'created': datetime.datetime.now().isoformat(),
+        'base': None,
+        'graphs': dict((unicode(identifier), entry) for identifier, entry in map_graphs(backup_graph, identifiers, workers)),
+    }
+    manifest['files'] = sorted(entry['file'] for entry in manifest['graphs'].itervalues())
+    write_manifest(directory, manifest)
+
+    return manifest
+
+def backup_files(directory):
+    """
+    Returns a list of (path, {graph identifier: expected number of triples}) for the files of a backup. Backups
+    without a manifest (written by older versions of backup_rdf) have one graph per file, named with the url
+    encoded graph uri, and no expected counts.
+    """
+    if os.path.isfile(os.path.join(directory, MANIFEST_FILENAME)):
+        files = {}
+        for identifier, entry in read_manifest(directory)['graphs'].iteritems():
+            files.setdefault(manifest_graph_path(directory, entry), {})[identifier] = entry['triples']
+
+        return sorted(files.items())
+    else:
+        files = []
+        for filename in sorted(os.listdir(directory)):
+            full_path = os.path.join(directory, filename)
+            if os.path.isfile(full_path) and not filename.startswith('.') and filename != MANIFEST_FILENAME:
+                files.append((full_path, {urllib.unquote(filename[:filename.rfind('.')]): None}))
+
+        return files
+
+def manifest_checksums(directory):
+    """Returns {graph identifier: sha1} from the manifest of a backup, or {} for a backup without one"""
+    if not os.path.isfile(os.path.join(directory, MANIFEST_FILENAME)):
+        return {}
+
+    return dict((identifier, entry.get('sha1')) for identifier, entry in read_manifest(directory)['graphs'].iteritems())
+
+def _uncompressed_name(path):
+    for extension in COMPRESSION_EXTENSIONS.itervalues():
+        if extension and path.endswith(extension):
+            return path[:-len(extension)]
+
+    return path
+
+_URIREF = re.compile(r'<([^\s"<>]*)>')
+
+class _NQuadsParser(NQuadsParser):
+    """
+    An N-Quads parser which also accepts the relative IRIs the store may hold (rdflib's only accepts absolute ones),
+    and which can yield the quads it parses rather than adding them to a graph
+    """
+    def uriref(self):
+        if self.peek('<'):
+            return URIRef(uriquote(unquote(self.eat(_URIREF).group(1))))
+        return False
+
+    def quads(self, f):
+        """
+        Yields ((subject, predicate, object, context), line) for each quad of an N-Quads file as it is read, with
+        the line (without its line break) it was read from
+        """
+        self.file = getreader('utf-8')(f)
+        self.buffer = ''
+        while True:
+            self.line = line = self.readline()
+            if self.line is None:
+                break
+            try:
+                quad = self.parseline()
+            except ParseError, msg:
+                raise ParseError("Invalid line (%s):\n%r" % (msg, line))
+            if quad is not None:
+                yield quad, line
+
+    def parseline(self):
+        self.eat(r_wspace)
+        if (not self.line) or self.line.startswith('#'):
+            return None
+
+        subject = self.subject()
+        self.eat(r_wspace)
+        predicate = self.predicate()
+        self.eat(r_wspace)
+        obj = self.object()
+        self.eat(r_wspace)
+        context = self.uriref() or self.nodeid()
+        self.eat(r_tail)
+
+        if self.line:
+            raise ParseError("Trailing garbage")
+
+        return subject, predicate, obj, context
+
+def iter_backup_file(path, identifiers, checksums=None):
+    """
+    Yields (identifier, triples) for each of the given graph identifiers in a backup file. N-Quads files are read
+    graph by graph, relying on each graph's quads being written together (as write_archive does), so only the
+    triples of one graph are held at a time; a graph whose quads are split up is yielded once for each run of them.
+    Graphs with no triples in the file are yielded last, with empty lists.
+
+    If checksums ({identifier: sha1}, as in the manifest) are given, each graph is checked against its checksum
+    before it is yielded, and a BackupError raised if they differ. In an archive, that is the checksum of the
+    graph's lines as they are in the file; a graph in a file of its own is checked by its parsed triples instead,
+    unless they include blank nodes, whose ids change when they are parsed.
+    """
+    identifiers = set(identifiers)
+    checksums = checksums or {}
+    format = guess_format(_uncompressed_name(path))
+
+    def verified(identifier, triples, digest):
+        expected = checksums.get(identifier)
+        if expected is not None and digest is not None and digest != expected:
+            raise BackupError('The checksum of %s in %s does not match the manifest' % (identifier, path))
+
+        return identifier, triples
+
+    with open_compressed(path) as f:
+        if format == 'nquads':
+            found = set()
+            for context, lines in itertools.groupby(_NQuadsParser().quads(f), lambda (quad, line): quad[3]):
+                identifier = unicode(context)
+                if identifier in identifiers:
+                    found.add(identifier)
+
+                    digest = hashlib.sha1()
+                    triples = []
+                    for (s, p, o, c), line in lines:
+                        digest.update(line.encode('utf-8') + '\n')
+                        triples.append((s, p, o))
+
+                    yield verified(identifier, triples, digest.hexdigest())
+
+            for identifier in identifiers - found:
+                yield verified(identifier, [], checksum([]))
+        else:
+            parsed = Graph()
+            parsed.parse(data=f.read(), format=format)
+            triples = list(parsed)
+            for identifier in identifiers:
+                if any(isinstance(term, BNode) for triple in triples for term in triple):
+                    digest = None
+                else:
+                    digest = checksum(sorted(nquads_row(triple, URIRef(identifier)) for triple in triples))
+
+                yield verified(identifier, triples, digest)
+
+def parse_backup_file((path, identifiers, checksums)):
+    """
+    Parses a backup file, and returns a list of (identifier, triples) for those of the given graph identifiers
+    it holds, checked against their checksums. This runs in the restore's worker processes, so it only returns
+    picklable values.
+    """
+    return list(iter_backup_file(path, identifiers, checksums))
+
+class GraphCheckpoint(object):
+    """
+    Records which graphs a restore (or a copy between stores) has started and finished loading, one line per
+    event, so that a resumed run can skip the finished graphs and clear out the partly loaded ones before loading
+    them again. Graphs are recorded by their identifiers as unicode strings.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.started = set()
+        self.finished = set()
+
+        if os.path.isfile(path):
+            with open(path) as f:
+                for line in f:
+                    event, identifier = line.rstrip('\n').split(' ', 1)
+                    getattr(self, event).add(identifier.decode('utf-8'))
+
+        self._file = None
+        self._lock = threading.RLock()
+
+    def unfinished(self):
+        return self.started - self.finished
+
+    def _record(self, event, identifier):
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a')
+
+            self._file.write(('%s %s\n' % (event, identifier)).encode('utf-8'))
+            getattr(self, event).add(identifier)
+
+    def start(self, identifier):
+        if identifier not in self.started:
+            self._record('started', identifier)
+
+    def finish(self, identifiers):
+        with self._lock:
+            for identifier in identifiers:
+                self._record('finished', identifier)
+
+            self.sync()
+
+    def sync(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+
+    def remove(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+def restore(store, directory, workers=DEFAULT_WORKERS, batch_size=DEFAULT_BATCH_QUADS, checkpoint_path=None,
+            verify=False):
+    """
+    Loads every graph in a backup directory into the store, resuming from the checkpoint file if there is one.
+    Returns a dictionary with the numbers of graphs and triples loaded and skipped, and a list of messages
+    describing graphs whose triple counts did not match the manifest. Graphs are checked against the checksums
+    in the manifest before they are loaded, and the restore stops with a BackupError at the first which doesn't
+    match (see iter_backup_file); the graphs loaded before it are kept in the checkpoint.
+
+    Files are parsed by up to `workers` processes, but never more than there are files; with one worker or one
+    file they are read graph by graph in this process instead (see iter_backup_file).
+    """
+    if checkpoint_path is None:
+        checkpoint_path = os.path.join(directory, CHECKPOINT_FILENAME)
+    checkpoint = GraphCheckpoint(checkpoint_path)
+
+    summary = {'graphs': 0, 'triples': 0, 'skipped': 0, 'mismatches': []}
+
+    files = []
+    expected_counts = {}
+    checksums = manifest_checksums(directory)
+    for path, graphs in backup_files(directory):
+        expected_counts.update(graphs)
+        remaining = [identifier for identifier in graphs if identifier not in checkpoint.finished]
+        summary['skipped'] += len(graphs) - len(remaining)
+        if remaining:
+            files.append((path, remaining, dict((identifier, checksums.get(identifier)) for identifier in remaining)))
+
+    for identifier in checkpoint.unfinished():
+        logger.info('Clearing partly restored graph %s', identifier)
+        store.remove((None, None, None), Graph(store, URIRef(identifier)))
+
+    batch = []
+    batch_graphs = []
+
+    def flush():
+        # The graphs in the batch must be recorded as started before any of their quads reach the store
+        checkpoint.sync()
+        if batch:
+            store.addN(batch)
+        checkpoint.finish(batch_graphs)
+
+        summary['triples'] += len(batch)
+        summary['graphs'] += len(batch_graphs)
+        del batch[:]
+        del batch_graphs[:]
+
+    workers = min(workers, len(files))
+    if workers > 1:
+        # Each worker returns a whole parsed file, so only one is fetched ahead per worker
+        pool = Pool(workers)
+        parsed_graphs = (graph for parsed in bounded_imap_unordered(pool, parse_backup_file, files, workers, ahead=1)
+                         for graph in parsed)
+    else:
+        pool = None
+        parsed_graphs = (graph for path, identifiers, file_checksums in files
+                         for graph in iter_backup_file(path, identifiers, file_checksums))
+
+    parsed_counts = {}
+    try:
+        for identifier, triples in parsed_graphs:
+            parsed_counts[identifier] = parsed_counts.get(identifier, 0) + len(triples)
+
+            checkpoint.start(identifier)
+
+            graph = Graph(store, URIRef(identifier))
+            for s, p, o in triples:
+                batch.append((s, p, o, graph))
+                if len(batch) >= batch_size:
+                    flush()
+
+            if identifier not in batch_graphs:
+                batch_graphs.append(identifier)
+
+        flush()
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    for identifier, parsed in sorted(parsed_counts.iteritems()):
+        expected = expected_counts.get(identifier)
+        if expected is not None and expected != parsed:
+            summary['mismatches'].append('%s: %d triples in the manifest, %d in the backup file' % (identifier, expected, parsed))
+
+    if verify:
+        for identifier, expected in expected_counts.iteritems():
+            stored = len(Graph(store, URIRef(identifier)))
+            if expected is not None and stored != expected:
+                summary['mismatches'].append('%s: %d triples in the manifest, %d in the store' % (identifier, expected, stored))
+
+    checkpoint.remove()
+
+    return summary
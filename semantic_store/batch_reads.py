@@ -0,0 +1,55 @@
+"""
+Reading many of a project's canvases, texts and specific resources at once, as a single merged graph:
+
+    graph = batch_reads.read_resources(project_uri, [canvas_uri, text_uri, ...])
+
+The project graph is loaded into memory once (or taken from the graph cache), and each resource's graph is built
+from it just as it is for a single read (read_canvas, read_project_text and read_specific_resource, sharing their
+result cache entries), with the contents of all of the texts then read from their Text models in one query.
+"""
+from rdflib import Graph, URIRef
+
+from semantic_store import uris, graph_cache, versions
+from semantic_store.canvases import read_canvas
+from semantic_store.namespaces import NS, bind_namespaces
+from semantic_store.project_metadata import CANVAS_TYPES
+from semantic_store.project_texts import read_project_text, overwrite_text_graphs_from_models
+from semantic_store.specific_resources import read_specific_resource
+
+# The most resources which can be read in one batch
+MAX_RESOURCES = 1000
+
+def resource_identifiers(project_uri, resource_uris):
+    """Returns the identifiers of the graph and model data a batch of resources is read from (see versions.py)"""
+    return ([uris.uri('semantic_store_projects', uri=project_uri)] +
+            [versions.model_identifier('text', resource_uri) for resource_uri in resource_uris])
+
+def read_resources(project_uri, resource_uris):
+    """
+    Returns a graph of the canvases, texts and specific resources of a project with the given uris, each as it
+    would be read on its own; any other uris are ignored
+    """
+    project_uri = URIRef(project_uri)
+    project_graph = graph_cache.readable_graph(uris.uri('semantic_store_projects', uri=project_uri), in_memory=True)
+
+    graph = Graph()
+    bind_namespaces(graph)
+
+    texts = []
+    for resource_uri in resource_uris:
+        resource_uri = URIRef(resource_uri)
+        resource_types = set(project_graph.objects(resource_uri, NS.rdf.type))
+
+        if resource_types.intersection(CANVAS_TYPES):
+            graph += read_canvas(None, project_uri, resource_uri, project_graph)
+        elif NS.dcmitype.Text in resource_types:
+            graph += read_project_text(project_uri, resource_uri, project_graph, from_model=False)
+            texts.append(resource_uri)
+        elif NS.oa.SpecificResource in resource_types:
+            source = project_graph.value(resource_uri, NS.oa.hasSource)
+            graph += read_specific_resource(project_uri, resource_uri, source, project_graph)
+
+    if texts:
+        overwrite_text_graphs_from_models(project_uri, graph, texts)
+
+    return graph
@@ -0,0 +1,157 @@
+"""
+A compact binary serialization of RDF graphs, registered with rdflib as the "dm-binary" format:
+
+    data = graph.serialize(format='dm-binary')
+    Graph().parse(data=data, format='dm-binary')
+
+Each term is written once, in a dictionary at the start, and each triple is then just the dictionary indexes of its
+terms, so the IRIs repeated throughout a graph cost a few bytes each after their first use, and nothing has to be
+escaped or tokenized to read it back. The layout is:
+
+    magic       "DMRB" followed by the version byte 1
+    terms       count, then each term as a kind byte and its fields:
+                    0 IRI               value
+                    1 blank node        id
+                    2 literal           lexical form
+                    3 literal           lexical form, language tag
+                    4 literal           lexical form, index of its datatype IRI (an earlier term)
+    triples     count, then the subject, predicate and object indexes of each triple
+
+where counts and indexes are unsigned LEB128 varints, and strings are a varint byte length followed by UTF-8.
+"""
+from rdflib import URIRef, BNode, Literal
+from rdflib.parser import Parser
+from rdflib.serializer import Serializer
+from rdflib import plugin
+
+FORMAT = 'dm-binary'
+MIMETYPE = 'application/x-dm-rdf-binary'
+
+MAGIC = 'DMRB\x01'
+
+IRI, BLANK, LITERAL, LANGUAGE_LITERAL, TYPED_LITERAL = range(5)
+
+class BinaryRDFError(Exception):
+    pass
+
+def _varint(value):
+    out = []
+    while value >= 0x80:
+        out.append(chr((value & 0x7f) | 0x80))
+        value >>= 7
+    out.append(chr(value))
+    return ''.join(out)
+
+def _string(value):
+    encoded = unicode(value).encode('utf-8')
+    return _varint(len(encoded)) + encoded
+
+def encode(triples):
+    """Returns the binary serialization of an iterable of triples"""
+    terms = {}
+    term_chunks = []
+    triple_chunks = []
+
+    def index(term):
+        try:
+            return terms[term]
+        except KeyError:
+            pass
+
+        if isinstance(term, Literal):
+            if term.language:
+                chunk = chr(LANGUAGE_LITERAL) + _string(term) + _string(term.language)
+            elif term.datatype:
+                chunk = chr(TYPED_LITERAL) + _string(term) + _varint(index(URIRef(term.datatype)))
+            else:
+                chunk = chr(LITERAL) + _string(term)
+        elif isinstance(term, BNode):
+            chunk = chr(BLANK) + _string(term)
+        else:
+            chunk = chr(IRI) + _string(term)
+
+        terms[term] = len(term_chunks)
+        term_chunks.append(chunk)
+        return terms[term]
+
+    count = 0
+    for s, p, o in triples:
+        triple_chunks.append(_varint(index(s)) + _varint(index(p)) + _varint(index(o)))
+        count += 1
+
+    return ''.join([MAGIC, _varint(len(term_chunks))] + term_chunks + [_varint(count)] + triple_chunks)
+
+class _Reader(object):
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def byte(self):
+        if self.position >= len(self.data):
+            raise BinaryRDFError('Unexpected end of data')
+        value = ord(self.data[self.position])
+        self.position += 1
+        return value
+
+    def varint(self):
+        value = 0
+        shift = 0
+        while True:
+            b = self.byte()
+            value |= (b & 0x7f) << shift
+            if not b & 0x80:
+                return value
+            shift += 7
+
+    def string(self):
+        length = self.varint()
+        end = self.position + length
+        if end > len(self.data):
+            raise BinaryRDFError('Unexpected end of data')
+        value = self.data[self.position:end].decode('utf-8')
+        self.position = end
+        return value
+
+def decode(data):
+    """Yields the triples of a binary serialization"""
+    if not data.startswith(MAGIC):
+        raise BinaryRDFError('Not a %s serialization' % FORMAT)
+
+    reader = _Reader(data)
+    reader.position = len(MAGIC)
+
+    terms = []
+    try:
+        for i in xrange(reader.varint()):
+            kind = reader.byte()
+            if kind == IRI:
+                terms.append(URIRef(reader.string()))
+            elif kind == BLANK:
+                terms.append(BNode(reader.string()))
+            elif kind == LITERAL:
+                terms.append(Literal(reader.string()))
+            elif kind == LANGUAGE_LITERAL:
+                value = reader.string()
+                terms.append(Literal(value, lang=reader.string()))
+            elif kind == TYPED_LITERAL:
+                # A datatype is always written before the literals which use it
+                value = reader.string()
+                terms.append(Literal(value, datatype=terms[reader.varint()]))
+            else:
+                raise BinaryRDFError('Unknown term kind %d' % kind)
+
+        for i in xrange(reader.varint()):
+            yield terms[reader.varint()], terms[reader.varint()], terms[reader.varint()]
+    except IndexError:
+        raise BinaryRDFError('Term index out of range')
+
+class BinarySerializer(Serializer):
+    def serialize(self, stream, base=None, encoding=None, **args):
+        stream.write(encode(self.store.triples((None, None, None))))
+
+class BinaryParser(Parser):
+    def parse(self, source, sink, **args):
+        sink.addN((s, p, o, sink) for s, p, o in decode(source.getByteStream().read()))
+
+plugin.register(FORMAT, Serializer, 'semantic_store.binary_rdf', 'BinarySerializer')
+plugin.register(FORMAT, Parser, 'semantic_store.binary_rdf', 'BinaryParser')
@@ -2,11 +2,10 @@ from django.db import transaction
 
 from rdflib.exceptions import ParserError
 from rdflib import Literal, URIRef, Graph
-from rdflib.plugins.sparql import prepareQuery
 
 from semantic_store.rdfstore import rdfstore
 from semantic_store.namespaces import NS, ns, bind_namespaces
-from semantic_store import uris, users
+from semantic_store import uris, users, queries, result_cache, graph_cache, project_metadata
 from semantic_store.utils import parse_request_into_graph, NegotiatedGraphResponse, metadata_triples, list_subgraph, timed_block
 from semantic_store.annotations import resource_annotation_subgraph, canvas_annotation_lists, annotation_list_items, annotation_subgraph
 from semantic_store.specific_resources import specific_resources_subgraph
@@ -17,15 +16,7 @@ def canvas_and_images_graph(graph, canvas_uri):
     canvas_graph = Graph()
     canvas_graph += graph.triples((canvas_uri, None, None))
 
-    qres = graph.query("""SELECT ?image_anno ?image WHERE {
-        ?image_anno a oa:Annotation .
-        ?image_anno oa:hasTarget %s .
-        ?image_anno oa:hasBody ?image .
-        ?image a ?type .
-        FILTER(?type = dcmitype:Image || ?type = dms:Image || ?type = dms:ImageChoice) .
-    }""" % (canvas_uri.n3()), initNs=ns)
-
-    for image_anno, image in qres:
+    for image_anno, image in queries.execute('canvas_images', graph, canvas=canvas_uri):
         canvas_graph += graph.triples_choices(([image_anno, image], None, None))
 
     return canvas_graph
@@ -33,17 +24,7 @@ def canvas_and_images_graph(graph, canvas_uri):
 def all_canvases_and_images_graph(graph):
     canvas_graph = Graph()
 
-    qres = graph.query("""SELECT DISTINCT ?canvas ?image_anno ?image WHERE {
-        ?canvas a ?canvasType .
-        ?image a ?imageType .
-        FILTER(?canvasType = sc:Canvas || ?canvasType = dms:Canvas) .
-        FILTER(?imageType = dcmitype:Image || ?imageType = dms:Image || ?imageType = dms:ImageChoice) .
-        ?image_anno a oa:Annotation .
-        ?image_anno oa:hasTarget ?canvas .
-        ?image_anno oa:hasBody ?image .
-    }""", initBindings={}, initNs=ns)
-
-    for canvas, image_anno, image in qres:
+    for canvas, image_anno, image in queries.execute('all_canvas_images', graph):
         canvas_graph += graph.triples_choices(([canvas, image_anno, image], None, None))
 
     return canvas_graph
@@ -117,11 +98,14 @@ def update_canvas_graph(project_uri, canvas_uri):
 
         return canvas_graph
 
-def read_canvas(request, project_uri, canvas_uri):
+def read_canvas(request, project_uri, canvas_uri, project_graph=None):
     project_identifier = uris.uri('semantic_store_projects', uri=project_uri)
-    db_project_graph = Graph(store=rdfstore(), identifier=project_identifier)
 
-    return canvas_subgraph(db_project_graph, canvas_uri, project_uri)
+    def build():
+        graph = project_graph if project_graph is not None else graph_cache.readable_graph(project_identifier)
+        return canvas_subgraph(graph, canvas_uri, project_uri)
+
+    return result_cache.cached_graph('canvas', [project_identifier], (project_uri, canvas_uri), build)
 
 def update_canvas(project_uri, canvas_uri, input_graph):
     project_uri = URIRef(project_uri)
@@ -129,32 +113,31 @@ def update_canvas(project_uri, canvas_uri, input_graph):
 
     project_identifier = uris.uri('semantic_store_projects', uri=project_uri)
     project_graph = Graph(store=rdfstore(), identifier=project_identifier)
-    project_metadata_g = Graph(rdfstore(), identifier=uris.project_metadata_graph_identifier(project_uri))
 
-    if (canvas_uri, NS.dc.title, None) in input_graph:
-        project_graph.remove((canvas_uri, NS.dc.title, None))
-        project_metadata_g.remove((canvas_uri, NS.dc.title, None))
-    if (canvas_uri, NS.rdfs.label, None) in input_graph:
-        project_graph.remove((canvas_uri, NS.rdfs.label, None))
-        project_metadata_g.remove((canvas_uri, NS.rdfs.label, None))
+    removed = []
+    for predicate in (NS.dc.title, NS.rdfs.label):
+        if (canvas_uri, predicate, None) in input_graph:
+            project_graph.remove((canvas_uri, predicate, None))
+            removed.append((canvas_uri, predicate, None))
 
     project_graph += input_graph
-    project_metadata_g += canvas_and_images_graph(input_graph, canvas_uri)
+    project_metadata.update_metadata(project_uri, removed + list(input_graph))
 
     return project_graph
 
 def remove_canvas_triples(project_uri, canvas_uri, input_graph):
-    project_graph = Graph(store=rdfstore(), identifier=canvas_identifier)
-    project_metadata_g = Graph(rdfstore(), identifier=uris.project_metadata_graph_identifier(project_uri))
+    project_identifier = uris.uri('semantic_store_projects', uri=project_uri)
+    project_graph = Graph(store=rdfstore(), identifier=project_identifier)
 
     removed_graph = Graph()
 
     for t in input_graph:
         if t in project_graph:
             project_graph.remove(t)
-            project_metadata_g.remove(t)
             removed_graph.add(t)
 
+    project_metadata.update_metadata(project_uri, removed_graph)
+
     return removed_graph
 
 def create_canvas_from_upload(graph, uploaded_image, uri, user=None, title=None):
@@ -0,0 +1,174 @@
+"""
+A per project log of the triples added to and removed from each project's graphs, so that clients holding a copy
+of a project can fetch just what has changed since they last looked:
+
+    changes, more = change_log.changes_since(project_uri, since=sequence)
+
+Every write through the store to a project graph or project metadata graph (see rdfstore.VersionedWritesMixin),
+and every change to a valid Text model (its title, label, content and modification time, as they appear in the
+text's graph), is appended to the GraphChange table once it has been made, in the order written. Writes made as
+raw SPARQL updates (such as namespace rewrites) aren't logged, since which triples they change isn't known.
+
+A change's sequence number is an ever increasing (though not contiguous) number shared by all projects, so a
+client keeps the sequence of the last change it has applied, and asks for the changes after it. That only works
+if changes become visible in sequence order, which isn't true of an auto increment column by itself: entries
+written in a long transaction (e.g. a Text saved in update_project_text) could commit after entries numbered
+later by another request, which a client would already have polled past. So on PostgreSQL, writing entries
+locks the GraphChange table (for writes only; reads aren't blocked) until the writing transaction ends, which
+hands out sequence numbers in commit order. SQLite locks the whole database for a write transaction anyway.
+
+`compact` keeps only the latest change to each triple among the old entries of a project, which loses nothing a
+client needs: whatever sequence it has reached, the latest change to each triple after it is still in the log.
+
+The log is only kept when SEMANTIC_STORE_CHANGE_LOG is True.
+"""
+from django.conf import settings
+from django.db import connection, transaction
+from rdflib import URIRef
+
+from semantic_store import uris
+from semantic_store.models import GraphChange
+
+from datetime import datetime, timedelta
+import urllib
+
+import logging
+logger = logging.getLogger(__name__)
+
+ADDED = '+'
+REMOVED = '-'
+
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+
+DEFAULT_COMPACT_DAYS = 30
+
+_PROJECT_PLACEHOLDER = 'project'
+_graph_patterns = None
+
+def enabled():
+    return getattr(settings, 'SEMANTIC_STORE_CHANGE_LOG', False)
+
+def _project_graph_patterns():
+    """Returns the (prefix, suffix) of the identifiers of project graphs and project metadata graphs"""
+    global _graph_patterns
+    if _graph_patterns is None:
+        project_identifier = unicode(uris.uri('semantic_store_projects', uri=_PROJECT_PLACEHOLDER))
+        metadata_identifier = unicode(uris.project_metadata_graph_identifier(_PROJECT_PLACEHOLDER))
+
+        _graph_patterns = [tuple(identifier.rsplit(_PROJECT_PLACEHOLDER, 1))
+                           for identifier in (metadata_identifier, project_identifier)]
+
+    return _graph_patterns
+
+def project_for_graph(identifier):
+    """Returns the uri of the project whose graph (or metadata graph) has the given identifier, or None"""
+    if identifier is None:
+        return None
+
+    identifier = unicode(getattr(identifier, 'identifier', identifier))
+    for prefix, suffix in _project_graph_patterns():
+        if identifier.startswith(prefix) and identifier.endswith(suffix):
+            project_uri = identifier[len(prefix):len(identifier) - len(suffix)]
+            if project_uri and '/' not in project_uri:
+                return URIRef(urllib.unquote(project_uri.encode('utf-8')).decode('utf-8'))
+
+    return None
+
+def is_logged(context):
+    return enabled() and project_for_graph(context) is not None
+
+def triple_line(triple):
+    return u'%s %s %s .' % tuple(term.n3() for term in triple)
+
+def _entries(op, quads):
+    for s, p, o, context in quads:
+        identifier = getattr(context, 'identifier', context)
+        project_uri = project_for_graph(identifier)
+        if project_uri is not None:
+            yield GraphChange(project=project_uri, graph=identifier, op=op, triple=triple_line((s, p, o)))
+
+def _lock_log():
+    """Takes the lock which orders sequence numbers by commit (see the module docstring), if the database needs it"""
+    if connection.vendor == 'postgresql':
+        cursor = connection.cursor()
+        cursor.execute('LOCK TABLE %s IN SHARE ROW EXCLUSIVE MODE' % connection.ops.quote_name(GraphChange._meta.db_table))
+
+def _write(entries):
+    if transaction.is_managed():
+        # The lock is held until the enclosing transaction commits or rolls back
+        _lock_log()
+        GraphChange.objects.bulk_create(entries)
+    else:
+        with transaction.commit_on_success():
+            _lock_log()
+            GraphChange.objects.bulk_create(entries)
+
+def record(removals=None, additions=None):
+    """Appends quads which have been removed from and added to the store to the logs of their projects"""
+    if not enabled():
+        return
+
+    entries = list(_entries(REMOVED, removals or [])) + list(_entries(ADDED, additions or []))
+    if entries:
+        _write(entries)
+        logger.debug('Logged %d changes to project graphs', len(entries))
+
+def record_text(text, deleted=False):
+    """Appends the triples of a Text model which have been added (or removed, if it is no longer valid or deleted)"""
+    if not enabled() or not text.project or (deleted and not text.valid):
+        return
+
+    from semantic_store.project_texts import TEXT_MODEL_PREDICATES, text_model_triples
+
+    text_uri = URIRef(text.identifier)
+    graph = uris.uri('semantic_store_projects', uri=text.project)
+    quads = [t + (graph,) for t in text_model_triples(text_uri, text.title, text.content, text.timestamp)
+             if t[1] in TEXT_MODEL_PREDICATES]
+
+    if text.valid and not deleted:
+        record(additions=quads)
+    else:
+        record(removals=quads)
+
+def latest_sequence(project_uri):
+    """Returns the sequence of the latest change to a project, or 0 if it has none"""
+    latest = GraphChange.objects.filter(project=project_uri).order_by('-sequence').values_list('sequence', flat=True)[:1]
+    return latest[0] if latest else 0
+
+def changes_since(project_uri, since=0, limit=DEFAULT_PAGE_SIZE):
+    """
+    Returns a list of up to limit of the changes to a project after the sequence since, in order, and whether
+    there are more after them
+    """
+    changes = list(GraphChange.objects.filter(project=project_uri, sequence__gt=since).order_by('sequence')[:limit + 1])
+    return changes[:limit], len(changes) > limit
+
+def compact(project_uri, before=None):
+    """
+    Deletes every change to a project before the datetime before (by default, DEFAULT_COMPACT_DAYS ago) which is
+    followed by a later change to the same triple in the same graph. Returns the number of changes deleted.
+    """
+    if before is None:
+        before = datetime.now() - timedelta(days=DEFAULT_COMPACT_DAYS)
+
+    old = GraphChange.objects.filter(project=project_uri, timestamp__lt=before)
+    horizon = old.order_by('-sequence').values_list('sequence', flat=True)[:1]
+    if not horizon:
+        return 0
+
+    seen = set()
+    superseded = []
+    changes = GraphChange.objects.filter(project=project_uri).order_by('-sequence').values_list('sequence', 'graph', 'triple')
+    for sequence, graph, triple in changes.iterator():
+        key = (graph, triple)
+        if key in seen:
+            if sequence <= horizon[0]:
+                superseded.append(sequence)
+        else:
+            seen.add(key)
+
+    for i in xrange(0, len(superseded), DEFAULT_PAGE_SIZE):
+        GraphChange.objects.filter(sequence__in=superseded[i:i + DEFAULT_PAGE_SIZE]).delete()
+
+    return len(superseded)
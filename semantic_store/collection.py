@@ -5,8 +5,9 @@ import pickle
 from rdflib.graph import ConjunctiveGraph
 from rdflib.term import URIRef
 from rdflib import RDF
-from semantic_store.namespaces import ns, bind_namespaces, update_old_namespaces, NS
+from semantic_store.namespaces import ns, bind_namespaces, NS
 from semantic_store.utils import parse_into_graph
+from semantic_store import queries
 
 """
 Example:
@@ -64,14 +65,7 @@ def resource_urls(manifest_uri, g):
 
 def aggregated_uris_urls(uri, g):
     bind_namespaces(g)
-    query = """SELECT DISTINCT ?resource_uri ?resource_url
-               WHERE {
-                   ?uri ore:aggregates ?resource_uri .
-                   OPTIONAL { ?resource_url ore:describes ?resource_uri } .
-                   OPTIONAL { ?resource_uri ore:isDescribedBy ?resource_url }
-               }"""
-    qres = g.query(query, initNs=ns, initBindings={'uri': URIRef(uri)})
-    return list(qres)
+    return queries.execute('aggregated_uris_urls', g, uri=URIRef(uri))
 
 
 def resource_uris_urls_old(manifest_uri, g):
@@ -124,18 +118,16 @@ def aggregated_seq_uris_urls(uri, g):
 def fetch_and_parse(url, g, manifest_file=None, fmt="xml", cache=None):
     if (not cache) or (cache and (url not in cache['urls'])):
         if manifest_file:
-            parse_into_graph(g, source=manifest_file, format=fmt)
+            parse_into_graph(g, source=manifest_file, format=fmt, update_namespaces=True)
         else:
             print "fetching:", url
             response = urlopen(url)
             rdf_str = response.read()
             rdf_str = rdf_str.replace("rdf:nodeID=\"urn:uuid:", "rdf:nodeID=\"_") 
-            parse_into_graph(g, data=rdf_str, format=fmt)
+            parse_into_graph(g, data=rdf_str, format=fmt, update_namespaces=True)
     if cache:
         cache['urls'].add(url)
 
-    update_old_namespaces(g)
-
 
 def harvest_resource_triples(g, collection_uri=None, pred=None, obj=None, 
                              res_uri=None, res_url=None, cache=None, fmt="xml"):
@@ -151,19 +143,7 @@ def harvest_resource_triples(g, collection_uri=None, pred=None, obj=None,
 
 def page_attributes(g, page_uri, res_uri):
     bind_namespaces(g)
-    qres = g.query("""SELECT DISTINCT ?res_title ?title ?width ?height ?image 
-               WHERE {
-                   {?res_uri dc:title ?res_title} UNION {?res_uri rdfs:label ?res_title} .
-                   {?page_uri dc:title ?title} UNION {?page_uri rdfs:label ?title} .
-                   ?page_uri exif:width ?width .
-                   ?page_uri exif:height ?height .
-                   ?anno oa:hasTarget ?page_uri .
-                   ?anno oa:hasBody ?image .
-                   ?image rdf:type dcmitype:Image .
-               }""", initBindings={
-        'res_uri': URIRef(res_uri),
-        'page_uri': URIRef(page_uri)
-    })
+    qres = queries.execute('page_attributes', g, res_uri=URIRef(res_uri), page_uri=URIRef(page_uri))
     if qres:
         (res_title, page_title, width, height, image) = list(qres)[0]
         return (unicode(res_title), unicode(page_title), int(width), int(height), 
@@ -0,0 +1,91 @@
+"""
+Conditional GETs of responses derived from named graphs and models.
+
+A view passes the identifiers of everything its response is derived from (named graphs, and model data
+identified with versions.model_identifier), and a function building the response:
+
+    return conditional.graph_response(request, [project_identifier], lambda: NegotiatedGraphResponse(request, graph()))
+
+The response gets an ETag made from the versions of those identifiers (see versions.version_token) and a
+Last-Modified header from the time of their latest change, and a request whose If-None-Match (or, without one,
+If-Modified-Since) header shows the client already has the current version gets a 304 Not Modified, without
+the response being built, so without reading from the store.
+
+Permissions must be checked before calling graph_response, since a 304 says the resource exists.
+
+A 304 is only correct if every write bumps the versions seen here, so conditional GETs are only answered when
+SEMANTIC_STORE_CONDITIONAL_GET is True, which needs the version cache (see versions.py) to be shared by every
+process writing to the store, including management commands; otherwise responses are always built, without
+an ETag or Last-Modified header.
+"""
+from django.conf import settings
+from django.http import HttpResponseNotModified
+from django.utils.http import http_date, parse_http_date_safe, parse_etags, quote_etag
+from django.utils.cache import patch_vary_headers
+
+from semantic_store import versions
+from semantic_store.utils import accepts_gzip
+
+import hashlib
+import time
+
+# Last-Modified only has a resolution of a second, so it isn't sent for a change less than this many seconds ago,
+# since another change in the same second wouldn't change it
+LAST_MODIFIED_SETTLE_SECONDS = 1
+
+def enabled():
+    return getattr(settings, 'SEMANTIC_STORE_CONDITIONAL_GET', False)
+
+def etag(request, identifiers):
+    """
+    Returns the ETag of a response derived from the given identifiers; it includes the Accept header and whether
+    gzip is accepted, since the same resource is serialized and encoded differently for different clients
+    """
+    accept = hashlib.md5(request.META.get('HTTP_ACCEPT', '')).hexdigest()[:8]
+    return '%s-%s%s' % (versions.version_token(identifiers), accept, '-gzip' if accepts_gzip(request) else '')
+
+def last_modified(identifiers):
+    """Returns the time of the latest change to the given identifiers, unless it is too recent to be sent"""
+    modified = versions.last_modified(identifiers)
+    if modified is not None and modified < time.time() - LAST_MODIFIED_SETTLE_SECONDS:
+        return int(modified)
+    else:
+        return None
+
+def is_not_modified(request, etag, last_modified):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        return etag in etags or '*' in etags
+
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return last_modified is not None and if_modified_since is not None and last_modified <= if_modified_since
+
+def graph_response(request, identifiers, build_response):
+    """
+    Returns a 304 Not Modified response if the client has the current version of the response derived from the
+    given identifiers, or else the response returned by build_response, with ETag and Last-Modified headers.
+    Requests other than GET and HEAD (and every request, unless conditional GETs are enabled) just get the
+    response from build_response.
+    """
+    if not enabled() or request.method not in ('GET', 'HEAD'):
+        return build_response()
+
+    identifiers = list(identifiers)
+    current_etag = etag(request, identifiers)
+    modified = last_modified(identifiers)
+
+    if is_not_modified(request, current_etag, modified):
+        response = HttpResponseNotModified()
+    else:
+        response = build_response()
+        if response.status_code != 200:
+            return response
+
+        if modified is not None:
+            response['Last-Modified'] = http_date(modified)
+
+    response['ETag'] = quote_etag(current_etag)
+    patch_vary_headers(response, ('Accept', 'Accept-Encoding'))
+
+    return response
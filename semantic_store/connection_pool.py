@@ -0,0 +1,239 @@
+from contextlib import contextmanager
+from collections import deque
+from StringIO import StringIO
+import httplib
+import select
+import socket
+import threading
+import time
+import urlparse
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Errors which indicate that a kept-alive connection was closed underneath us, and that the request
+# can safely be retried on a fresh connection
+STALE_CONNECTION_ERRORS = (httplib.BadStatusLine, httplib.ImproperConnectionState, socket.error)
+
+class PooledResponse(object):
+    """
+    A fully read http response, which quacks enough like an httplib.HTTPResponse for the code
+    which previously used one directly.
+    """
+    def __init__(self, response):
+        self.status = response.status
+        self.reason = response.reason
+        self.msg = response.msg
+        self.content = response.read()
+
+    def getheader(self, name, default=None):
+        return self.msg.getheader(name, default)
+
+    def read(self, *args):
+        return self.content
+
+    def as_file(self):
+        return StringIO(self.content)
+
+class ConnectionPool(object):
+    """
+    A bounded, thread safe pool of keep-alive httplib connections to a single host.
+
+    Each thread checks out its own connection for the duration of a request. At most max_size
+    connections are handed out at once; a thread which is already holding a connection (for instance
+    while streaming the results of one query and issuing another) is given an overflow connection
+    rather than waiting, since it could otherwise deadlock on itself.
+
+    Idle connections are evicted after max_idle seconds, and are health checked before being reused.
+    """
+    def __init__(self, host, port=None, max_size=10, max_idle=60, timeout=None):
+        self.host = host
+        self.port = port
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.timeout = timeout
+
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(max_size)
+        self._local = threading.local()
+
+        self._stats = {
+            'checkouts': 0,
+            'created': 0,
+            'reused': 0,
+            'waits': 0,
+            'overflow': 0,
+            'retries': 0,
+            'evicted_idle': 0,
+            'discarded': 0,
+            'in_use': 0,
+            'max_in_use': 0,
+        }
+
+    @classmethod
+    def for_url(cls, url, **kwargs):
+        parsed = urlparse.urlparse(url)
+        return cls(parsed.hostname, parsed.port, **kwargs)
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def stats(self):
+        """Returns a dictionary of pool usage counters"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = len(self._idle)
+
+        return stats
+
+    def _new_connection(self):
+        self._count('created')
+        if self.timeout is not None:
+            return httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        else:
+            return httplib.HTTPConnection(self.host, self.port)
+
+    def _is_healthy(self, connection):
+        """
+        A kept-alive connection which has become readable while idle has either been closed by the
+        server or has unexpected data waiting on it; either way it can't be reused.
+        """
+        if connection.sock is None:
+            # httplib will transparently reconnect
+            return True
+
+        try:
+            readable, writable, errored = select.select([connection.sock], [], [connection.sock], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+
+        return not readable and not errored
+
+    def _held(self):
+        return getattr(self._local, 'held', 0)
+
+    def acquire(self):
+        """Checks out a connection for the calling thread. It must be returned with release."""
+        if self._slots.acquire(False):
+            overflow = False
+        elif self._held() > 0:
+            overflow = True
+            self._count('overflow')
+        else:
+            self._count('waits')
+            self._slots.acquire()
+            overflow = False
+
+        self._local.held = self._held() + 1
+
+        connection = None
+        now = time.time()
+        with self._lock:
+            self._stats['checkouts'] += 1
+            self._stats['in_use'] += 1
+            self._stats['max_in_use'] = max(self._stats['max_in_use'], self._stats['in_use'])
+
+            while self._idle:
+                candidate, last_used = self._idle.pop()
+                if now - last_used > self.max_idle:
+                    candidate.close()
+                    self._stats['evicted_idle'] += 1
+                else:
+                    connection = candidate
+                    break
+
+        if connection is not None and not self._is_healthy(connection):
+            connection.close()
+            self._count('discarded')
+            connection = None
+
+        if connection is None:
+            connection = self._new_connection()
+        else:
+            self._count('reused')
+
+        connection._dm_pool_overflow = overflow
+        return connection
+
+    def release(self, connection, discard=False):
+        """Returns a connection to the pool, or closes it if it can't be reused"""
+        overflow = getattr(connection, '_dm_pool_overflow', False)
+        self._local.held = max(self._held() - 1, 0)
+
+        with self._lock:
+            self._stats['in_use'] -= 1
+
+            if discard:
+                connection.close()
+                self._stats['discarded'] += 1
+            elif overflow and len(self._idle) >= self.max_size:
+                connection.close()
+            else:
+                self._idle.append((connection, time.time()))
+
+        if not overflow:
+            self._slots.release()
+
+    def evict_idle(self):
+        """Closes every pooled connection which has been idle for longer than max_idle seconds"""
+        now = time.time()
+        with self._lock:
+            keep = deque()
+            for connection, last_used in self._idle:
+                if now - last_used > self.max_idle:
+                    connection.close()
+                    self._stats['evicted_idle'] += 1
+                else:
+                    keep.append((connection, last_used))
+            self._idle = keep
+
+    def close(self):
+        """Closes every idle connection"""
+        with self._lock:
+            while self._idle:
+                connection, last_used = self._idle.pop()
+                connection.close()
+
+    @contextmanager
+    def stream(self, method, path, body=None, headers={}):
+        """
+        Makes a request over a pooled connection, and yields the (unread) httplib response.
+        The connection goes back to the pool when the block exits; if the response was not read to the
+        end by then, it is drained first so the connection can be kept alive (unless the block was abandoned
+        part way through, in which case the connection is closed rather than reading the rest).
+        """
+        connection = self.acquire()
+        discard = True
+
+        try:
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+            except STALE_CONNECTION_ERRORS as e:
+                # The server may have dropped a kept-alive connection since it was last used
+                logger.debug('Retrying request to %s:%s on a new connection after "%r"', self.host, self.port, e)
+                self._count('retries')
+                connection.close()
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+
+            try:
+                yield response
+            except GeneratorExit:
+                # The consumer stopped reading early (e.g. an abandoned result generator), so the connection
+                # can only be kept if the response had already been read to the end
+                discard = response.will_close or not response.isclosed()
+                raise
+
+            if not response.isclosed():
+                response.read()
+            discard = response.will_close
+        finally:
+            self.release(connection, discard=discard)
+
+    def request(self, method, path, body=None, headers={}):
+        """Makes a request over a pooled connection, and returns a fully read PooledResponse"""
+        with self.stream(method, path, body, headers) as response:
+            return PooledResponse(response)
@@ -0,0 +1,142 @@
+"""
+Streaming project exports in line based formats (N-Triples and N-Quads), and in JSON-LD (see semantic_store.json_ld).
+
+    for chunk in export.gzip_chunks(export.project_export_chunks(project_uri, 'nquads')):
+        ...
+
+The triples of the project graph and then the metadata graph are serialized as they are read from the store,
+and followed by the contents of the project's texts from the Text model, read TEXT_ROWS rows at a time. Lines are
+grouped into chunks of CHUNK_LINES. FourStore's triples are read as the SPARQL results arrive, and the SQLAlchemy
+store's off a server side cursor (see SQLAlchemyStore.stream_triples), so the memory used is the same however
+large the project is with either; a store without stream_triples may read a whole graph before yielding any of
+it. Since nothing is held to deduplicate against, a triple in both the project and metadata graphs is written
+twice in N-Triples (in N-Quads, the two copies are in different graphs).
+"""
+from rdflib import Graph, URIRef
+
+from semantic_store import uris, json_ld
+from semantic_store.backup import nquads_line
+from semantic_store.models import Text
+from semantic_store.namespaces import NS
+from semantic_store.project_texts import TEXT_MODEL_PREDICATES, text_model_triples
+from semantic_store.rdfstore import rdfstore
+
+import itertools
+import re
+import zlib
+
+# Extension: (format, mimetype)
+LINE_FORMATS = {
+    'nt': ('nt', 'application/n-triples'),
+    'nq': ('nquads', 'application/n-quads'),
+    'nquads': ('nquads', 'application/n-quads'),
+}
+
+JSON_LD_EXTENSIONS = ('jsonld', 'json')
+
+CHUNK_LINES = 1000
+
+# Text rows read per query; the database driver may buffer every row of a query, so texts are read in pages
+TEXT_ROWS = 100
+GZIP_LEVEL = 6
+
+_NON_ASCII = re.compile(u'[^\x00-\x7f]')
+
+def _escape(match):
+    codepoint = ord(match.group())
+    return '\\u%04X' % codepoint if codepoint <= 0xFFFF else '\\U%08X' % codepoint
+
+def export_row(triple, identifier=None):
+    """
+    Returns the line of a triple, with any non-ascii characters escaped, so that the export can be read by parsers
+    which only accept ascii N-Triples
+    """
+    return _NON_ASCII.sub(_escape, nquads_line(triple, identifier)).encode('ascii')
+
+def graph_triples(store, identifier):
+    """Yields the triples of a named graph, streamed off the database where the store can (see the module docstring)"""
+    graph = Graph(store, identifier)
+    if hasattr(store, 'stream_triples'):
+        return store.stream_triples(graph)
+    else:
+        return iter(graph)
+
+def text_rows(project_uri, page_size=TEXT_ROWS):
+    """Yields (identifier, title, content, timestamp) for the valid texts of a project, page_size rows per query"""
+    rows = Text.objects.filter(project=project_uri, valid=True).order_by('pk')
+    last = None
+    while True:
+        page = rows if last is None else rows.filter(pk__gt=last)
+        page = list(page.values_list('pk', 'identifier', 'title', 'content', 'timestamp')[:page_size])
+        for row in page:
+            yield row[1:]
+
+        if len(page) < page_size:
+            break
+        last = page[-1][0]
+
+def project_export_quads(project_uri):
+    """
+    Yields the triples of a project export, with the same contents as projects.project_export_graph, each with the
+    identifier of the graph it is in
+    """
+    project_uri = URIRef(project_uri)
+    store = rdfstore()
+
+    project_identifier = uris.uri('semantic_store_projects', uri=project_uri)
+    metadata_identifier = uris.project_metadata_graph_identifier(project_uri)
+
+    texts = set(Text.objects.filter(project=project_uri, valid=True).values_list('identifier', flat=True))
+    exported_texts = set()
+
+    for identifier in (project_identifier, metadata_identifier):
+        for s, p, o in graph_triples(store, identifier):
+            if unicode(s) in texts:
+                if p in TEXT_MODEL_PREDICATES:
+                    continue
+                elif p == NS.rdf.type and o == NS.dctypes.Text:
+                    exported_texts.add(unicode(s))
+
+            yield s, p, o, identifier
+
+    for identifier, title, content, timestamp in text_rows(project_uri):
+        if identifier in exported_texts:
+            for s, p, o in text_model_triples(URIRef(identifier), title, content, timestamp):
+                yield s, p, o, project_identifier
+
+def project_export_lines(project_uri, format='nt'):
+    """Yields the lines of a project export, in N-Triples or (with format 'nquads') N-Quads"""
+    quads = format == 'nquads'
+
+    for s, p, o, identifier in project_export_quads(project_uri):
+        yield export_row((s, p, o), identifier if quads else None)
+
+def chunked(lines, chunk_lines=CHUNK_LINES):
+    """Joins lines into chunks of up to chunk_lines lines"""
+    lines = iter(lines)
+    while True:
+        chunk = ''.join(itertools.islice(lines, chunk_lines))
+        if not chunk:
+            break
+        yield chunk
+
+def project_export_chunks(project_uri, format='nt', chunk_lines=CHUNK_LINES):
+    return chunked(project_export_lines(project_uri, format), chunk_lines)
+
+def project_export_json_ld_chunks(project_uri):
+    """
+    Yields the pieces of a JSON-LD project export; the triples of each subject are written together as long as
+    the store returns them together
+    """
+    return chunked(json_ld.graph_chunks((s, p, o) for s, p, o, identifier in project_export_quads(project_uri)))
+
+def gzip_chunks(chunks, level=GZIP_LEVEL):
+    """Compresses a sequence of strings into a gzip stream, as they are produced"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+
+    yield compressor.flush()
@@ -0,0 +1,106 @@
+"""
+An in-process cache of whole named graphs, for read paths which make many small lookups against one graph.
+
+    project_graph = graph_cache.readable_graph(project_identifier)
+    canvas_graph = canvas_subgraph(project_graph, canvas_uri, project_uri)
+
+The first read of a graph loads all of its triples into an indexed in-memory graph, with one request to the
+store, and later reads are answered from that copy without going to the store at all. The copy returned is
+shared, so callers must only read from it.
+
+Each copy is kept with the versions of its graph (and of ALL_GRAPHS) it was loaded at (see semantic_store.versions),
+which are checked on every read. A write made through the store in this process drops the copies of the graphs it
+changed, and since the versions are shared between processes, a write made by another worker changes a version
+this process didn't expect; either way the copy is loaded again on its next read. Copies are never changed in
+place, since they may be being read by other threads, and never copied to apply a write, which would make every
+write as slow as loading the graph; so the cache suits graphs which are read far more often than they are written,
+with writes batched by a unit of work.
+
+Graphs are evicted least recently used first, bounded by number of graphs and total number of triples.
+The cache is only enabled when SEMANTIC_STORE_GRAPH_CACHE is True.
+"""
+from django.conf import settings
+from rdflib import Graph
+
+from semantic_store import versions
+from semantic_store.result_cache import LRUCache
+from semantic_store.unit_of_work import active_store
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Bounds on the per process cache (these can be overridden with SEMANTIC_STORE_GRAPH_CACHE_ENTRIES and
+# SEMANTIC_STORE_GRAPH_CACHE_TRIPLES); a graph with more triples than the whole cache holds is never cached
+DEFAULT_MAX_ENTRIES = 100
+DEFAULT_MAX_TRIPLES = 2000000
+
+_cache = LRUCache(getattr(settings, 'SEMANTIC_STORE_GRAPH_CACHE_ENTRIES', DEFAULT_MAX_ENTRIES),
+                  getattr(settings, 'SEMANTIC_STORE_GRAPH_CACHE_TRIPLES', DEFAULT_MAX_TRIPLES))
+
+def enabled():
+    return getattr(settings, 'SEMANTIC_STORE_GRAPH_CACHE', False)
+
+def stats():
+    return _cache.stats()
+
+def clear():
+    _cache.clear()
+
+def _key(identifier):
+    return unicode(identifier)
+
+def _entry_versions(identifier, graph_versions):
+    return graph_versions[identifier], graph_versions[versions.ALL_GRAPHS]
+
+def load_graph(store, identifier):
+    """Returns an in-memory copy of a named graph in store"""
+    graph = Graph(identifier=identifier)
+    for prefix, namespace in store.namespaces():
+        graph.bind(prefix, namespace)
+    graph.addN((s, p, o, graph) for s, p, o in Graph(store, identifier))
+
+    return graph
+
+def readable_graph(identifier, in_memory=False):
+    """
+    Returns a graph for reading the named graph with the given identifier: the cached in-memory copy when
+    the cache is enabled, or else the graph in the store (or, if in_memory is True, an uncached in-memory copy,
+    for callers about to make enough reads to be worth loading the whole graph for).
+    """
+    from semantic_store.rdfstore import rdfstore
+    store = rdfstore()
+
+    buffered = active_store()
+    if not enabled() or (buffered is not None and buffered.is_dirty(identifier)):
+        return load_graph(store, identifier) if in_memory else Graph(store=store, identifier=identifier)
+
+    # The versions are read before loading, so a write made while loading leaves the copy looking out of date
+    current = _entry_versions(identifier, versions.graph_versions([identifier]))
+
+    entry = _cache.get(_key(identifier))
+    if entry is not None and entry[0] == current:
+        return entry[1]
+
+    graph = load_graph(store, identifier)
+    _cache.set(_key(identifier), (current, graph), len(graph))
+    logger.debug('Loaded %d triples of %s into the graph cache', len(graph), identifier)
+
+    return graph
+
+def apply_changes(new_versions, removals=None, additions=None):
+    """
+    Brings the cache up to date with a write which changed the named graphs in new_versions (a dictionary of
+    their versions after the write, as returned by versions.bump), by dropping the copies of those graphs to be
+    loaded again when they are next read. removals and additions are the quads the write removed and added,
+    which aren't needed to do that.
+    """
+    if not enabled() or not len(_cache):
+        return
+
+    if versions.ALL_GRAPHS in new_versions:
+        # A write across graphs, such as a SPARQL update, could have changed anything
+        _cache.clear()
+        return
+
+    for identifier in new_versions:
+        _cache.delete(_key(identifier))
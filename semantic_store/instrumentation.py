@@ -0,0 +1,208 @@
+"""
+Instrumentation of calls to the rdf store.
+
+`instrument_store` wraps the read and write methods of a store class, so that each call is counted and timed
+(for methods which return generators, the time spent producing results is included, but not the time the
+caller spends between results). Calls made from inside another instrumented call (e.g. triples_choices running
+its query) are only counted once.
+
+While a request is being handled by StoreInstrumentationMiddleware, calls are collected in a RequestStats:
+- in DEBUG mode the totals are added to the response as X-Store-* headers;
+- if SEMANTIC_STORE_INSTRUMENTATION_LOG is set, a JSON summary of each request is appended to that file.
+
+Any call which takes longer than SEMANTIC_STORE_SLOW_QUERY_SECONDS is logged as a warning to the
+semantic_store.slow_queries logger, along with the view which made it.
+"""
+from django.conf import settings
+from django.utils import simplejson
+
+from functools import wraps
+import inspect
+import threading
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+slow_query_logger = logging.getLogger('semantic_store.slow_queries')
+
+DEFAULT_SLOW_QUERY_SECONDS = 1.0
+
+# Upper bounds (in seconds) of the latency histogram buckets; the last bucket holds everything slower
+LATENCY_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+INSTRUMENTED_METHODS = ('query', 'update', 'triples', 'triples_choices', 'triples_multi', 'contexts', '__len__',
+                        'add', 'addN', 'remove', 'apply_changes', 'rewrite_namespace')
+
+_local = threading.local()
+
+def _bucket_label(i):
+    if i < len(LATENCY_BUCKETS):
+        return '<%gms' % (LATENCY_BUCKETS[i] * 1000)
+    else:
+        return '>%gms' % (LATENCY_BUCKETS[-1] * 1000)
+
+class OperationStats(object):
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record(self, elapsed):
+        self.count += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if elapsed <= bound:
+                self.histogram[i] += 1
+                break
+        else:
+            self.histogram[-1] += 1
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total_time': self.total_time,
+            'max_time': self.max_time,
+            'histogram': dict((_bucket_label(i), n) for i, n in enumerate(self.histogram) if n),
+        }
+
+class RequestStats(object):
+    """The store calls made while handling a single request"""
+    def __init__(self, path=None):
+        self.path = path
+        self.view_name = None
+        self.started = time.time()
+        self.operations = {}
+        self.totals = OperationStats()
+
+    def record(self, operation, elapsed):
+        self.operations.setdefault(operation, OperationStats()).record(elapsed)
+        self.totals.record(elapsed)
+
+    def as_dict(self):
+        return {
+            'path': self.path,
+            'view': self.view_name,
+            'started': self.started,
+            'duration': time.time() - self.started,
+            'store_calls': self.totals.as_dict(),
+            'operations': dict((operation, stats.as_dict()) for operation, stats in self.operations.iteritems()),
+        }
+
+    def headers(self):
+        return {
+            'X-Store-Calls': str(self.totals.count),
+            'X-Store-Time': '%.4f' % self.totals.total_time,
+            'X-Store-Operations': ', '.join('%s=%d/%.4fs' % (operation, stats.count, stats.total_time)
+                                            for operation, stats in sorted(self.operations.iteritems())),
+            'X-Store-Latency-Histogram': ', '.join('%s=%d' % (_bucket_label(i), n)
+                                                   for i, n in enumerate(self.totals.histogram) if n),
+        }
+
+def current_stats():
+    return getattr(_local, 'stats', None)
+
+def _describe_call(args):
+    description = repr(args)
+    if len(description) > 1000:
+        description = description[:1000] + '...'
+
+    return description
+
+def _finished(operation, elapsed, args):
+    stats = current_stats()
+    if stats is not None:
+        stats.record(operation, elapsed)
+
+    threshold = getattr(settings, 'SEMANTIC_STORE_SLOW_QUERY_SECONDS', DEFAULT_SLOW_QUERY_SECONDS)
+    if threshold is not None and elapsed >= threshold:
+        slow_query_logger.warning('Slow store %s (%.3fs) in view %s: %s', operation, elapsed,
+                                  stats.view_name if stats is not None else None, _describe_call(args))
+
+def _is_outermost():
+    return getattr(_local, 'depth', 0) == 0
+
+class _Call(object):
+    """Tracks nesting, so only the outermost instrumented call is recorded"""
+    def __enter__(self):
+        _local.depth = getattr(_local, 'depth', 0) + 1
+
+    def __exit__(self, *exc_info):
+        _local.depth -= 1
+
+def _timed_generator(operation, generator, args):
+    elapsed = 0.0
+    try:
+        while True:
+            start = time.time()
+            with _Call():
+                try:
+                    item = next(generator)
+                finally:
+                    elapsed += time.time() - start
+            yield item
+    except StopIteration:
+        pass
+    finally:
+        _finished(operation, elapsed, args)
+
+def instrumented(operation, method):
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not _is_outermost():
+            return method(self, *args, **kwargs)
+
+        start = time.time()
+        with _Call():
+            result = method(self, *args, **kwargs)
+        elapsed = time.time() - start
+
+        if inspect.isgenerator(result):
+            return _timed_generator(operation, result, args)
+
+        _finished(operation, elapsed, args)
+        return result
+
+    wrapper._dm_instrumented = True
+    return wrapper
+
+def instrument_store(cls):
+    """Wraps the store operations of a store class (including those it inherits) with instrumented"""
+    for name in INSTRUMENTED_METHODS:
+        method = getattr(cls, name, None)
+        if method is not None and not getattr(method, '_dm_instrumented', False):
+            setattr(cls, name, instrumented(name.strip('_'), method.im_func))
+
+    return cls
+
+class StoreInstrumentationMiddleware(object):
+    def process_request(self, request):
+        _local.stats = RequestStats(request.path)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        stats = current_stats()
+        if stats is not None:
+            stats.view_name = '%s.%s' % (view_func.__module__, getattr(view_func, '__name__', view_func.__class__.__name__))
+
+    def process_response(self, request, response):
+        stats = current_stats()
+        if stats is None:
+            return response
+        _local.stats = None
+
+        if settings.DEBUG:
+            for header, value in stats.headers().iteritems():
+                if value:
+                    response[header] = value
+
+        log_path = getattr(settings, 'SEMANTIC_STORE_INSTRUMENTATION_LOG', None)
+        if log_path:
+            try:
+                with open(log_path, 'a') as f:
+                    f.write(simplejson.dumps(stats.as_dict()) + '\n')
+            except IOError as e:
+                logger.error('Unable to write store instrumentation to %s: %s', log_path, e)
+
+        return response
@@ -0,0 +1,139 @@
+"""
+JSON-LD serialization of graphs in a compact form, with a fixed context of the prefixes in namespaces.ns, registered
+with rdflib as the "json-ld" format:
+
+    data = graph.serialize(format='json-ld')
+
+    for chunk in json_ld.graph_chunks(triples):
+        ...
+
+The output is a single object, the context followed by the node objects of the graph:
+
+    {"@context": {"dc": "http://purl.org/dc/elements/1.1/", ...},
+     "@graph": [
+    {"@id": "http://example.org/canvas", "@type": "sc:Canvas", "dc:title": {"@value": "Title", "@language": "en"}},
+    ...]}
+
+Predicates, types and IRIs in the namespaces of the context are written as compact IRIs (prefix:name), blank
+nodes as "_:" identifiers, and literals as plain strings, or as value objects when they have a language or
+datatype. The context is built once, when this module is imported, and no expanded form of the graph is ever
+built.
+
+Only graph_chunks streams: it serializes each node object as soon as its triples have been read, so nothing but
+the triples of one subject is held (project downloads use it, see semantic_store.export). A subject whose triples
+are not read together may be written as more than one node object, which JSON-LD processors merge. The registered
+serializer, which negotiated responses use through graph.serialize, instead collects the graph's subjects first so
+that each has a single node object, and the whole document is built in memory (see utils.negotiated_serialization).
+"""
+from rdflib import URIRef, BNode, Literal
+from rdflib.namespace import XSD
+from rdflib.serializer import Serializer
+from rdflib import plugin
+from django.utils import simplejson
+
+from semantic_store.namespaces import ns, NS
+
+import itertools
+
+FORMAT = 'json-ld'
+MIMETYPE = 'application/ld+json'
+
+CONTEXT = dict((prefix, unicode(namespace)) for prefix, namespace in ns.items())
+CONTEXT['xsd'] = unicode(XSD)
+
+# The start of every document, with the context serialized once
+DOCUMENT_START = '{"@context": %s,\n "@graph": [\n' % simplejson.dumps(CONTEXT, sort_keys=True)
+
+# (namespace, prefix), longest namespaces first, so an IRI is compacted with the most specific prefix, and the
+# same prefix is always chosen for namespaces with more than one
+_PREFIXES = sorted(((namespace, prefix) for prefix, namespace in CONTEXT.iteritems()),
+                   key=lambda (namespace, prefix): (-len(namespace), prefix))
+
+_compacted = {}
+
+def compact_iri(iri):
+    """Returns an IRI as a compact IRI with a prefix of the context, or as it is if none of them apply"""
+    try:
+        return _compacted[iri]
+    except KeyError:
+        pass
+
+    compacted = iri_string = unicode(iri)
+    for namespace, prefix in _PREFIXES:
+        if iri_string.startswith(namespace):
+            name = iri_string[len(namespace):]
+            if not name.startswith('//'):
+                compacted = u'%s:%s' % (prefix, name)
+                break
+
+    if len(_compacted) < 10000:
+        _compacted[iri] = compacted
+
+    return compacted
+
+def node_id(term):
+    if isinstance(term, BNode):
+        return u'_:%s' % term
+    else:
+        return compact_iri(term)
+
+def value(term):
+    """Returns the JSON-LD value of an object"""
+    if isinstance(term, Literal):
+        if term.language:
+            return {'@value': unicode(term), '@language': term.language}
+        elif term.datatype and term.datatype != XSD.string:
+            return {'@value': unicode(term), '@type': compact_iri(term.datatype)}
+        else:
+            return unicode(term)
+    else:
+        return {'@id': node_id(term)}
+
+def node_object(subject, predicate_objects):
+    """Returns the node object of a subject, given its (predicate, object) pairs"""
+    node = {'@id': node_id(subject)}
+
+    for predicate, object in predicate_objects:
+        if predicate == NS.rdf.type and not isinstance(object, Literal):
+            key, object_value = '@type', node_id(object)
+        else:
+            key, object_value = compact_iri(predicate), value(object)
+
+        if key not in node:
+            node[key] = object_value
+        elif isinstance(node[key], list):
+            node[key].append(object_value)
+        else:
+            node[key] = [node[key], object_value]
+
+    return node
+
+def node_chunks(nodes):
+    """Yields the serialization of a document of an iterable of node objects, in pieces"""
+    yield DOCUMENT_START
+
+    for i, node in enumerate(nodes):
+        if i:
+            yield ',\n'
+        yield simplejson.dumps(node)
+
+    yield ']}\n'
+
+def graph_chunks(triples):
+    """
+    Yields the serialization of a document of an iterable of triples, in pieces, writing the triples of each run of
+    triples with the same subject as a node object
+    """
+    return node_chunks(node_object(subject, ((p, o) for s, p, o in subject_triples))
+                       for subject, subject_triples in itertools.groupby(triples, lambda triple: triple[0]))
+
+class JSONLDSerializer(Serializer):
+    """Serializes a graph with one node object per subject, holding the set of its subjects while doing so"""
+    def serialize(self, stream, base=None, encoding=None, **args):
+        graph = self.store
+        subjects = set(graph.subjects())
+
+        for chunk in node_chunks(node_object(subject, graph.predicate_objects(subject)) for subject in subjects):
+            stream.write(chunk)
+
+plugin.register(FORMAT, Serializer, 'semantic_store.json_ld', 'JSONLDSerializer')
@@ -1,24 +1,45 @@
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from optparse import make_option
 
 from semantic_store.rdfstore import rdfstore
+from semantic_store import backup, versions
 
-import urllib
 import os
 
-from rdflib import Graph, URIRef, Literal
-from rdflib.util import guess_format
-
 class Command(BaseCommand):
-    """Exports all graphs in the rdf store to files in a given directory"""
+    """
+    Exports all graphs in the rdf store to a given directory, along with a manifest of their triple counts and
+    checksums
+
+    By default each graph is written to its own file; with --archive, all graphs are streamed into a compressed
+    N-Quads file instead (or into --shards of them: a restore parses each file in one process, so an archive
+    restores in parallel only if it has several). With --since, an archive backup only fetches the graphs which
+    have been written since an earlier archive backup, and refers to that backup for the rest. --since relies on
+    the graph version counters kept in SEMANTIC_STORE_CACHE, so it needs a cache shared with the processes which
+    write to the store (memcached, the database cache, ...): with a per process cache such as the default
+    LocMemCache, every version is new to this command, and nothing is skipped.
+    """
 
     option_list = BaseCommand.option_list + (
         make_option('-o', '--output', dest='directory', help='Directory in which to output RDF serializations'),
         make_option('--format', dest='format', help='Serialization format', default='ttl'),
-        make_option('--overwrite', dest='overwrite', help='Overwrite the contents of the directory', default=False, action='store_true'),
+        make_option('--overwrite', dest='overwrite', help='Overwrite the contents of the directory',
+                    default=False, action='store_true'),
+        make_option('--archive', dest='archive', help='Write compressed N-Quads files rather than a file per graph',
+                    default=False, action='store_true'),
+        make_option('--compression', dest='compression', help='Compression of archive files (gzip, zstd or none)',
+                    default='gzip'),
+        make_option('--shards', dest='shards', type='int', default=backup.DEFAULT_SHARDS,
+                    help='Number of archive files to spread graphs across (%d by default); a restore parses each '
+                         'file in one process, so it runs at most this many in parallel' % backup.DEFAULT_SHARDS),
+        make_option('--workers', dest='workers', help='Number of graphs to fetch from the store concurrently',
+                    type='int', default=backup.DEFAULT_WORKERS),
+        make_option('--since', dest='since', default=None,
+                    help='Directory of an earlier archive backup, whose unchanged graphs are not fetched again '
+                         '(needs a shared SEMANTIC_STORE_CACHE)'),
     )
 
-    def handle(self, directory, format, overwrite, *args, **kwargs):
+    def handle(self, directory, format, overwrite, archive, compression, shards, workers, since, *args, **kwargs):
         store = rdfstore()
 
         if not os.path.isdir(directory):
@@ -30,8 +51,19 @@ class Command(BaseCommand):
         if format.startswith('.'):
             format = format[1:]
 
-        for context in store.contexts():
-            graph = Graph(store, context)
-            filename = urllib.quote(context, '')
-            
-            graph.serialize(os.path.abspath(os.path.join(directory, '%s.%s' % (filename, format))))
+        if since and not versions.is_shared():
+            self.stderr.write('Warning: SEMANTIC_STORE_CACHE is not shared between processes, '
+                              'so --since will not skip any graphs\n')
+
+        try:
+            if archive:
+                manifest = backup.write_archive(store, directory, compression, shards, workers, since)
+            elif since:
+                raise CommandError('--since can only be used with --archive')
+            else:
+                manifest = backup.write_graph_files(store, directory, format, workers)
+        except backup.BackupError as e:
+            raise CommandError(e)
+
+        print 'Backed up %d graphs (%d triples) to %s' % (len(manifest['graphs']),
+            sum(entry['triples'] for entry in manifest['graphs'].itervalues()), directory)
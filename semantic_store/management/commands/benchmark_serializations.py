@@ -0,0 +1,73 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import simplejson
+from django.utils.text import compress_string
+from optparse import make_option
+
+from semantic_store.models import ProjectPermission
+from semantic_store.namespaces import bind_namespaces
+from semantic_store.projects import project_export_graph
+from semantic_store.utils import RDFLIB_SERIALIZER_FORMATS
+from semantic_store import json_ld
+
+from rdflib import Graph, URIRef
+
+import time
+
+DEFAULT_FORMATS = 'turtle,%s,nt' % json_ld.FORMAT
+
+def best_time(repeat, function):
+    """Returns the result of a function, and the shortest time it took in repeat calls"""
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        result = function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return result, best
+
+class Command(BaseCommand):
+    """
+    Compares serializations of the exports of all projects (or of the projects whose uris are given as arguments):
+    for each format, the time to serialize the export, its size (raw and gzipped), and the time to read it back.
+    JSON-LD is read back with a plain JSON parser, as a client with native JSON parsing would; the other formats are
+    parsed with rdflib.
+    """
+    args = '[project uri ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--formats', dest='formats', help='Comma separated rdflib formats to compare', default=DEFAULT_FORMATS),
+        make_option('--repeat', dest='repeat', help='Number of times each format is timed (the best time is shown)', type='int', default=3),
+    )
+
+    def handle(self, *args, **options):
+        formats = [format.strip() for format in options.get('formats', DEFAULT_FORMATS).split(',') if format.strip()]
+        repeat = max(options.get('repeat', 3), 1)
+
+        for format in formats:
+            if format not in RDFLIB_SERIALIZER_FORMATS:
+                raise CommandError('Unknown format %s' % format)
+
+        if args:
+            project_uris = [URIRef(uri) for uri in args]
+        else:
+            project_uris = [URIRef(uri) for uri in ProjectPermission.objects.values_list('identifier', flat=True).distinct()]
+
+        for project_uri in project_uris:
+            graph, elapsed = best_time(1, lambda: project_export_graph(project_uri))
+            bind_namespaces(graph)
+            print '%s: %d triples, read in %.3fs' % (project_uri, len(graph), elapsed)
+            print '    %-12s %10s %12s %12s %10s' % ('format', 'serialize', 'bytes', 'gzipped', 'parse')
+
+            for format in formats:
+                content, serialize_time = best_time(repeat, lambda: graph.serialize(format=format))
+
+                if format == json_ld.FORMAT:
+                    parse = lambda: simplejson.loads(content)
+                else:
+                    parse = lambda: Graph().parse(data=content, format=format)
+                parsed, parse_time = best_time(repeat, parse)
+
+                print '    %-12s %9.3fs %12d %12d %9.3fs' % (format, serialize_time, len(content),
+                                                             len(compress_string(content)), parse_time)
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from semantic_store.models import GraphChange
+from semantic_store import change_log
+
+from datetime import datetime, timedelta
+
+class Command(BaseCommand):
+    """
+    Compacts the change logs of all projects (or of the projects whose uris are given as arguments), deleting the
+    changes older than --days days which are followed by a later change to the same triple (see change_log.compact).
+    """
+    args = '[project uri ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days', dest='days', help='Only compact changes older than this many days', type='float', default=change_log.DEFAULT_COMPACT_DAYS),
+    )
+
+    def handle(self, *args, **options):
+        days = options.get('days', change_log.DEFAULT_COMPACT_DAYS)
+        before = datetime.now() - timedelta(days=days)
+
+        if args:
+            project_uris = args
+        else:
+            project_uris = GraphChange.objects.values_list('project', flat=True).distinct()
+
+        compacted = 0
+        for project_uri in project_uris:
+            deleted = change_log.compact(project_uri, before)
+            if deleted:
+                compacted += deleted
+                print '%s: %d superseded changes deleted' % (project_uri, deleted)
+
+        print '%d superseded changes deleted' % compacted
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+from semantic_store import migration, backup
+
+class Command(BaseCommand):
+    """
+    Copies every graph from one rdf store to another, e.g. from the SQLAlchemy store to 4store
+
+    Stores are given as:
+        default                     the configured store
+        sqlalchemy[:<db uri>]       the SQLAlchemy store in the given database (RDFLIB_DB_URI by default)
+        fourstore[:<base url>]      4store, at <base url>/sparql/ and <base url>/update/ (FOUR_STORE_URIS by default)
+
+    Graphs are recorded in the --log file as they are copied, so running the command again with the same log after
+    an interruption carries on where it left off.
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option('--from', dest='source', help='Store to copy from', default='sqlalchemy'),
+        make_option('--to', dest='target', help='Store to copy to', default='fourstore'),
+        make_option('--workers', dest='workers', help='Number of graphs to copy concurrently', type='int', default=backup.DEFAULT_WORKERS),
+        make_option('--batch-size', dest='batch_size', help='Number of triples written to the new store at a time', type='int', default=migration.DEFAULT_BATCH_QUADS),
+        make_option('--log', dest='log_path', help='Completion log, from which an interrupted copy can be resumed', default=None),
+        make_option('--no-verify', dest='verify', help='Skip comparing the triple counts of each graph in the two stores', default=True, action='store_false'),
+    )
+
+    def handle(self, source, target, workers, batch_size, log_path, verify, *args, **kwargs):
+        try:
+            old_store = migration.open_store(source)
+            new_store = migration.open_store(target)
+        except ValueError as e:
+            raise CommandError(e)
+
+        def report(progress):
+            print unicode(progress)
+
+        summary = migration.copy_store(old_store, new_store, workers, batch_size, log_path, verify, report)
+
+        print 'Copied %d graphs (%d triples), skipped %d already copied' % (summary['graphs'], summary['triples'], summary['skipped'])
+
+        problems = summary['failures'] + summary['mismatches']
+        if problems:
+            raise CommandError('Some graphs were not copied correctly:\n%s' % '\n'.join(problems))
@@ -0,0 +1,71 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from semantic_store.models import ProjectPermission
+from semantic_store import backup, project_gc
+
+from rdflib import URIRef
+
+class Command(BaseCommand):
+    """
+    Deletes orphaned specific resources, selectors and annotations from all projects (or from the projects whose uris
+    are given as arguments), which are collected concurrently, each traversed in memory (see project_gc).
+
+    A project which takes longer than --time-budget seconds to traverse is skipped, without deleting anything.
+    """
+    args = '[project uri ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', dest='workers', help='Number of projects to collect concurrently', type='int', default=backup.DEFAULT_WORKERS),
+        make_option('--dry-run', dest='dry_run', help='Report orphans without deleting them', default=False, action='store_true'),
+        make_option('--batch-size', dest='batch_size', help='Number of triples deleted at a time', type='int', default=project_gc.DEFAULT_BATCH_TRIPLES),
+        make_option('--time-budget', dest='time_budget', help='Seconds allowed for finding the orphans of each project', type='float', default=None),
+        make_option('--show-orphans', dest='show_orphans', help='List each orphaned resource', default=False, action='store_true'),
+    )
+
+    def handle(self, *args, **options):
+        workers = options.get('workers', backup.DEFAULT_WORKERS)
+        dry_run = options.get('dry_run', False)
+        batch_size = options.get('batch_size', project_gc.DEFAULT_BATCH_TRIPLES)
+        time_budget = options.get('time_budget')
+        show_orphans = options.get('show_orphans', False)
+
+        if args:
+            project_uris = [URIRef(uri) for uri in args]
+        else:
+            project_uris = [URIRef(uri) for uri in ProjectPermission.objects.values_list('identifier', flat=True).distinct()]
+
+        def collect(project_uri):
+            try:
+                return project_uri, project_gc.collect_garbage(project_uri, dry_run, batch_size, time_budget), None
+            except Exception as e:
+                return project_uri, None, e
+
+        total_orphans = 0
+        total_triples = 0
+        skipped = 0
+        stale_metadata = 0
+        for project_uri, summary, error in backup.map_graphs(collect, project_uris, workers):
+            if isinstance(error, project_gc.MetadataNotUpdated):
+                # The orphans were deleted, so they're counted, but the metadata graph needs rebuilding
+                stale_metadata += 1
+                summary = error.summary
+                print '%s: %s (run rebuild_metadata_graphs %s)' % (project_uri, error, project_uri)
+            elif error is not None:
+                skipped += 1
+                print 'Skipped %s: %s' % (project_uri, error)
+                continue
+
+            if summary['orphans']:
+                total_orphans += len(summary['orphans'])
+                total_triples += len(summary['garbage'])
+                print '%s: %d orphaned resources (%d of %d triples) %s' % (project_uri, len(summary['orphans']),
+                    len(summary['garbage']), summary['triples'], 'found' if dry_run else 'deleted')
+
+                if show_orphans:
+                    for orphan in sorted(summary['orphans']):
+                        print '  %s' % orphan.n3()
+
+        print '%d projects checked, %d orphaned resources (%d triples) %s%s%s' % (len(project_uris), total_orphans,
+            total_triples, 'found' if dry_run else 'deleted', ', %d projects skipped' % skipped if skipped else '',
+            ', %d metadata graphs not updated' % stale_metadata if stale_metadata else '')
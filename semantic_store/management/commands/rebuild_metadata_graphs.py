@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from semantic_store.models import ProjectPermission
+from semantic_store import backup, project_metadata
+
+from rdflib import URIRef
+
+class Command(BaseCommand):
+    """
+    Rebuilds the metadata graphs of all projects (or of the projects whose uris are given as arguments) from their
+    project graphs, and reports the triples which had drifted from what the project graphs say.
+
+    Projects are rebuilt concurrently, each in a fixed number of queries (see project_metadata.rebuild_metadata).
+    """
+    args = '[project uri ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', dest='workers', help='Number of projects to rebuild concurrently', type='int', default=backup.DEFAULT_WORKERS),
+        make_option('--dry-run', dest='dry_run', help='Report drift without changing any metadata graphs', default=False, action='store_true'),
+        make_option('--show-triples', dest='show_triples', help='List each triple removed or added', default=False, action='store_true'),
+    )
+
+    def handle(self, *args, **options):
+        workers = options.get('workers', backup.DEFAULT_WORKERS)
+        dry_run = options.get('dry_run', False)
+        show_triples = options.get('show_triples', False)
+
+        if args:
+            project_uris = [URIRef(uri) for uri in args]
+        else:
+            project_uris = [URIRef(uri) for uri in ProjectPermission.objects.values_list('identifier', flat=True).distinct()]
+
+        def rebuild(project_uri):
+            try:
+                return project_uri, project_metadata.rebuild_metadata(project_uri, dry_run), None
+            except Exception as e:
+                return project_uri, None, e
+
+        drifted = 0
+        failed = 0
+        for project_uri, changes, error in backup.map_graphs(rebuild, project_uris, workers):
+            if error is not None:
+                failed += 1
+                print 'Could not rebuild %s: %s' % (project_uri, error)
+                continue
+
+            removed, added = changes
+            if removed or added:
+                drifted += 1
+                print '%s: %d stale triples %s, %d missing triples %s' % (project_uri,
+                    len(removed), 'found' if dry_run else 'removed', len(added), 'found' if dry_run else 'added')
+
+                if show_triples:
+                    for t in removed:
+                        print '  - %s %s %s' % tuple(term.n3() for term in t)
+                    for t in added:
+                        print '  + %s %s %s' % tuple(term.n3() for term in t)
+
+        print '%d projects checked, %d had drifted%s%s' % (len(project_uris), drifted,
+            ' (not changed, since this was a dry run)' if dry_run and drifted else '',
+            ', %d could not be rebuilt' % failed if failed else '')
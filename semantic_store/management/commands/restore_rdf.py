@@ -1,32 +1,53 @@
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from optparse import make_option
 
 from semantic_store.rdfstore import rdfstore
+from semantic_store import backup
 
-import urllib
+import multiprocessing
 import os
 
-from rdflib import Graph, URIRef, Literal
-from rdflib.util import guess_format
-
 class Command(BaseCommand):
     """
     Restores all graphs in the rdfstore from the contents of a backup directory (as generated from the backup_rdf command)
 
-    Graphs are identified using the folling format:
+    Graphs are identified by the backup's manifest, or for older backups without one, using the folling format:
     <url encoded graph uri>.<serialization format>
+
+    Files are parsed in a pool of worker processes, at most one per file (archives are a single file, which is
+    parsed graph by graph in this process, unless backup_rdf was given --shards), and their quads added to the
+    store in large batches. Progress is recorded in a checkpoint file, so running the command again after an
+    interruption resumes the restore.
     """
 
     option_list = BaseCommand.option_list + (
         make_option('-i', '--input', dest='directory', help='Directory from which to read RDF serializations'),
+        make_option('--workers', dest='workers', type='int', default=multiprocessing.cpu_count(),
+                    help='Number of processes parsing backup files; each file is parsed by one process, so no more '
+                         'are used than the backup has files'),
+        make_option('--batch-size', dest='batch_size', help='Number of quads added to the store at a time', type='int', default=backup.DEFAULT_BATCH_QUADS),
+        make_option('--checkpoint', dest='checkpoint', help='Checkpoint file (%s in the backup directory by default)' % backup.CHECKPOINT_FILENAME, default=None),
+        make_option('--restart', dest='restart', help='Ignore any checkpoint left by an interrupted restore', default=False, action='store_true'),
+        make_option('--verify', dest='verify', help='Check the number of triples in each restored graph against the manifest', default=False, action='store_true'),
     )
 
-    def handle(self, directory, *args, **kwargs):
+    def handle(self, directory, workers, batch_size, checkpoint, restart, verify, *args, **kwargs):
         store = rdfstore()
 
-        for filename in os.listdir(directory):
-            full_path = os.path.join(directory, filename)
-            if os.path.isfile(full_path) and not filename.startswith('.'):
-                context = URIRef(urllib.unquote(filename[:filename.rfind('.')]))
-                graph = Graph(store, context)
-                graph.parse(full_path, format=guess_format(filename))
+        if checkpoint is None:
+            checkpoint = os.path.join(directory, backup.CHECKPOINT_FILENAME)
+
+        if restart and os.path.isfile(checkpoint):
+            os.remove(checkpoint)
+        elif os.path.isfile(checkpoint):
+            print 'Resuming the restore recorded in %s' % checkpoint
+
+        try:
+            summary = backup.restore(store, directory, workers, batch_size, checkpoint, verify)
+        except backup.BackupError as e:
+            raise CommandError(e)
+
+        print 'Restored %d graphs (%d triples), skipped %d already restored' % (summary['graphs'], summary['triples'], summary['skipped'])
+
+        if summary['mismatches']:
+            raise CommandError('Triple counts did not match the manifest:\n%s' % '\n'.join(summary['mismatches']))
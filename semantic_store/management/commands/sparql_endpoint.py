@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from semantic_store.sparql_endpoint import LocalSPARQLEndpoint, MIN_RECURSION_LIMIT
+
+class Command(BaseCommand):
+    """
+    Serves a local, in-memory SPARQL endpoint which can stand in for 4store, optionally loaded with the contents
+    of a backup directory (as generated from the backup_rdf command).
+
+    Point FOUR_STORE_URIS at the urls printed on startup to run the site or benchmarks against it.
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option('--host', dest='host', help='Address to listen on', default='127.0.0.1'),
+        make_option('--port', dest='port', help='Port to listen on', type='int', default=8765),
+        make_option('-i', '--input', dest='directory', help='Backup directory from which to load graphs', default=None),
+        make_option('--latency', dest='latency', help='Seconds by which to delay each request', type='float', default=0),
+        make_option('--jitter', dest='jitter', help='Maximum random variation of the latency, in seconds', type='float', default=0),
+        make_option('--error-rate', dest='error_rate', help='Probability that a request fails with a server error', type='float', default=0),
+        make_option('--drop-rate', dest='drop_rate', help='Probability that a request has its connection closed', type='float', default=0),
+        make_option('--error-status', dest='error_status', help='Http status of injected errors', type='int', default=500),
+    )
+
+    def handle(self, host, port, directory, latency, jitter, error_rate, drop_rate, error_status, *args, **kwargs):
+        endpoint = LocalSPARQLEndpoint(host=host, port=port, latency=latency, jitter=jitter,
+                                       error_rate=error_rate, drop_rate=drop_rate, error_status=error_status,
+                                       recursion_limit=MIN_RECURSION_LIMIT)
+
+        if directory:
+            endpoint.load_backup(directory)
+            print 'Loaded %d triples from %s' % (len(endpoint.dataset), directory)
+
+        endpoint.start()
+        print 'SPARQL endpoint: %s' % endpoint.query_url
+        print 'Update endpoint: %s' % endpoint.update_url
+
+        try:
+            endpoint.serve_forever()
+        except KeyboardInterrupt:
+            pass
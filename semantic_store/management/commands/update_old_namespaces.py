@@ -1,7 +1,7 @@
 from django.core.management.base import BaseCommand
 
 from semantic_store.rdfstore import rdfstore
-from semantic_store.namespaces import update_old_namespaces, NS
+from semantic_store.namespaces import update_old_namespaces, OLD_NAMESPACES, NS
 
 from rdflib import Graph
 
@@ -11,10 +11,18 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         store = rdfstore()
 
-        print 'About to update every graph in the store... go grab some coffee.'
+        if hasattr(store, 'rewrite_namespace'):
+            # The store rewrites the old namespaces itself, touching only the triples which use them
+            for old_base, new_base in OLD_NAMESPACES:
+                print '- Updating %s to %s in every graph' % (old_base, new_base)
+                store.rewrite_namespace(old_base, new_base)
+        else:
+            print 'About to update every graph in the store... go grab some coffee.'
 
-        for identifier in store.contexts():
-            print '- Updating graph with identifier %s' % identifier
-            graph = Graph(store=store, identifier=identifier)
-            update_old_namespaces(graph)
-            graph.bind('oa', NS.oa)
+            for identifier in store.contexts():
+                print '- Updating graph with identifier %s' % identifier
+                graph = Graph(store=store, identifier=identifier)
+                update_old_namespaces(graph)
+
+        # Namespace bindings belong to the store rather than to each graph
+        Graph(store=store).bind('oa', NS.oa)
@@ -4,7 +4,7 @@ from rdflib import URIRef
 from semantic_store.rdfstore import rdfstore
 from semantic_store.namespaces import NS
 
-from semantic_store.utils import metadata_triples, list_subgraph
+from semantic_store.utils import metadata_triples, metadata_triples_multi, list_subgraph
 
 
 def canvases(uri):
@@ -33,10 +33,12 @@ def manuscript_subgraph(graph, manuscript_uri):
     subgraph += graph.triples((manuscript_uri, None, None))
     subgraph += list_subgraph(graph, graph.value(manuscript_uri, NS.sc.hasSequences))
 
+    canvas_uris = []
     for sequence in sequences(graph, manuscript_uri):
         subgraph += graph.triples((sequence, None, None))
         subgraph += list_subgraph(graph, graph.value(sequence, NS.sc.hasCanvases))
-        for canvas in sequence_canvases(graph, sequence):
-            subgraph += metadata_triples(graph, canvas)
+        canvas_uris.extend(sequence_canvases(graph, sequence))
+
+    subgraph += metadata_triples_multi(graph, canvas_uris)
 
     return subgraph
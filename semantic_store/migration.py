@@ -0,0 +1,182 @@
+"""
+Copying the contents of one rdf store to another, e.g. when moving from the SQLAlchemy store to 4store.
+
+    summary = migration.copy_store(old_store, new_store, workers=4, log_path='copy.log', report=print_progress)
+
+Several graphs are copied at once, each by streaming its triples from the old store (off the database cursor, or
+the SPARQL results as they are read) and adding them to the new store in batches. Progress is reported
+periodically with the overall throughput and an estimate of the time remaining. Graphs are recorded in a
+completion log as they are started and finished (see backup.GraphCheckpoint), so a copy which is interrupted can
+be run again to carry on where it left off. When every graph has been copied, the number of triples in each is
+compared between the two stores.
+"""
+from django.conf import settings
+from rdflib import Graph, Literal, URIRef
+
+from semantic_store import backup
+
+import itertools
+import threading
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_QUADS = 5000
+DEFAULT_REPORT_INTERVAL = 10
+
+class CopyProgress(object):
+    """Counts the graphs and triples copied so far, and estimates the time remaining from the rate of copying"""
+    def __init__(self, total_graphs, total_triples, report=None, interval=DEFAULT_REPORT_INTERVAL):
+        self.total_graphs = total_graphs
+        self.total_triples = total_triples
+        self.graphs = 0
+        self.triples = 0
+        self.started = time.time()
+
+        self.report = report
+        self.interval = interval
+        self._last_report = self.started
+        self._lock = threading.Lock()
+
+    def rate(self):
+        elapsed = time.time() - self.started
+        return self.triples / elapsed if elapsed > 0 else 0.0
+
+    def eta(self):
+        """Returns the estimated number of seconds remaining, or None if there's nothing to go on yet"""
+        rate = self.rate()
+        if not rate or self.total_triples is None:
+            return None
+
+        return max(self.total_triples - self.triples, 0) / rate
+
+    def __unicode__(self):
+        eta = self.eta()
+        return u'%d/%d graphs, %d triples copied (%.0f triples/s), %s remaining' % (
+            self.graphs, self.total_graphs, self.triples, self.rate(),
+            '%d:%02d:%02d' % (eta // 3600, eta % 3600 // 60, eta % 60) if eta is not None else 'unknown')
+
+    def _changed(self, force=False):
+        now = time.time()
+        if self.report is not None and (force or now - self._last_report >= self.interval):
+            self._last_report = now
+            self.report(self)
+
+    def add_triples(self, count):
+        with self._lock:
+            self.triples += count
+            self._changed()
+
+    def graph_finished(self):
+        with self._lock:
+            self.graphs += 1
+            self._changed(force=self.graphs == self.total_graphs)
+
+def copy_graph(old_store, new_store, identifier, batch_size=DEFAULT_BATCH_QUADS, progress=None):
+    """Copies a single named graph, a batch of triples at a time, and returns the number of triples copied"""
+    new_graph = Graph(new_store, identifier)
+    triples = iter(Graph(old_store, identifier))
+
+    copied = 0
+    while True:
+        batch = [(s, p, o, new_graph) for s, p, o in itertools.islice(triples, batch_size)]
+        if not batch:
+            break
+
+        new_store.addN(batch)
+        copied += len(batch)
+        if progress is not None:
+            progress.add_triples(len(batch))
+
+    return copied
+
+def copy_store(old_store, new_store, workers=backup.DEFAULT_WORKERS, batch_size=DEFAULT_BATCH_QUADS, log_path=None,
+               verify=True, report=None, report_interval=DEFAULT_REPORT_INTERVAL):
+    """
+    Copies every named graph in old_store to new_store. If log_path is given, graphs finished by an earlier run
+    with the same log are skipped. Returns a dictionary with the numbers of graphs and triples copied and
+    skipped, a list of messages for graphs which could not be copied, and (when verify is True) a list of
+    messages for graphs whose triple counts differ between the stores.
+    """
+    identifiers = [backup.graph_identifier(context) for context in old_store.contexts()]
+    checkpoint = backup.GraphCheckpoint(log_path) if log_path else None
+
+    summary = {'graphs': 0, 'triples': 0, 'skipped': 0, 'failures': [], 'mismatches': []}
+
+    if checkpoint is not None:
+        for identifier in checkpoint.unfinished():
+            logger.info('Clearing partly copied graph %s', identifier)
+            new_store.remove((None, None, None), Graph(new_store, URIRef(identifier)))
+
+        remaining = [identifier for identifier in identifiers if unicode(identifier) not in checkpoint.finished]
+        summary['skipped'] = len(identifiers) - len(remaining)
+    else:
+        remaining = identifiers
+
+    progress = CopyProgress(len(remaining), None, report, report_interval)
+    if report is not None:
+        # Counting every triple up front is one query, which is worth it for an estimate of the time remaining
+        progress.total_triples = sum(len(Graph(old_store, identifier)) for identifier in remaining) \
+            if summary['skipped'] else len(old_store)
+
+    def copy(identifier):
+        if checkpoint is not None:
+            checkpoint.start(unicode(identifier))
+            checkpoint.sync()
+
+        try:
+            copied = copy_graph(old_store, new_store, identifier, batch_size, progress)
+        except Exception as e:
+            logger.exception('Copying graph %s failed', identifier)
+            return identifier, None, e
+
+        if checkpoint is not None:
+            checkpoint.finish([unicode(identifier)])
+        progress.graph_finished()
+
+        return identifier, copied, None
+
+    for identifier, copied, error in backup.map_graphs(copy, remaining, workers):
+        if error is not None:
+            summary['failures'].append('%s: %s' % (identifier, error))
+        else:
+            summary['graphs'] += 1
+            summary['triples'] += copied
+
+    if verify:
+        for identifier in identifiers:
+            old_count, new_count = len(Graph(old_store, identifier)), len(Graph(new_store, identifier))
+            if old_count != new_count:
+                summary['mismatches'].append('%s: %d triples in the old store, %d in the new' % (identifier, old_count, new_count))
+
+    if checkpoint is not None and not summary['failures']:
+        checkpoint.remove()
+
+    return summary
+
+def open_store(spec):
+    """
+    Returns the store described by spec, for the copy_store command:
+        default                     the configured store (rdfstore.store)
+        sqlalchemy[:<db uri>]       the SQLAlchemy store in the given database (RDFLIB_DB_URI by default)
+        fourstore[:<base url>]      4store, at <base url>/sparql/ and <base url>/update/ (FOUR_STORE_URIS by default)
+    """
+    from semantic_store import rdfstore
+
+    kind, _, location = spec.partition(':')
+
+    if kind == 'default':
+        return rdfstore.store
+    elif kind == 'sqlalchemy':
+        store = rdfstore.SQLAlchemyStore(identifier=rdfstore.default_identifier)
+        store.open(Literal(location or settings.RDFLIB_DB_URI), create=True)
+        return store
+    elif kind == 'fourstore':
+        if location:
+            location = location.rstrip('/')
+            return rdfstore.FourStore(location + '/sparql/', location + '/update/')
+        else:
+            return rdfstore.FourStore(settings.FOUR_STORE_URIS['SPARQL'], settings.FOUR_STORE_URIS['UPDATE'])
+    else:
+        raise ValueError('Unknown store "%s"' % spec)
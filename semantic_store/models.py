@@ -1,10 +1,14 @@
 from django.contrib.auth.models import User
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 
 from bs4 import BeautifulSoup
 
 from settings import IMAGE_UPLOAD_LOCATION
 
+from semantic_store import versions
+
 class ProjectPermission(models.Model):
     PERMISSION_CHOICES = (
         ('r', 'Read'),
@@ -27,7 +31,7 @@ class ProjectPermission(models.Model):
 
 class Text(models.Model):
     identifier = models.CharField(max_length=2000, db_index=True)
-    project = models.CharField(max_length=2000, null=True)
+    project = models.CharField(max_length=2000, null=True, db_index=True)
     title = models.CharField(max_length=200, blank=True, null=True, db_index=True)
     content = models.TextField(blank=True, null=True, default=lambda:'')
     valid = models.BooleanField(default=True, db_index=True)
@@ -61,3 +65,41 @@ class UploadedImage(models.Model):
     def __str__(self):
         return self.imagefile.name[len(IMAGE_UPLOAD_LOCATION):]
 
+class GraphChange(models.Model):
+    """A triple added to or removed from one of a project's graphs, in the order written (see change_log.py)"""
+    OP_CHOICES = (
+        ('+', 'Added'),
+        ('-', 'Removed')
+    )
+
+    sequence = models.AutoField(primary_key=True)
+    project = models.CharField(max_length=2000, db_index=True)
+    graph = models.CharField(max_length=2000)
+    op = models.CharField(max_length=1, choices=OP_CHOICES)
+    triple = models.TextField()
+    timestamp = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return '%d %s %s in %s' % (self.sequence, self.op, self.triple, self.graph)
+
+# Versions of the data kept in these models, which views derived from them are conditional on (see versions.py)
+
+@receiver(post_save, sender=Text)
+@receiver(post_delete, sender=Text)
+def bump_text_version(sender, instance, **kwargs):
+    versions.bump([versions.model_identifier('text', instance.identifier)], sender=sender)
+
+    from semantic_store import change_log
+    change_log.record_text(instance, deleted=kwargs['signal'] is post_delete)
+
+@receiver(post_save, sender=ProjectPermission)
+@receiver(post_delete, sender=ProjectPermission)
+def bump_permission_versions(sender, instance, **kwargs):
+    versions.bump([versions.model_identifier('permissions', instance.identifier),
+                   versions.model_identifier('user', instance.user_id)], sender=sender)
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def bump_user_versions(sender, instance, **kwargs):
+    versions.bump([versions.model_identifier('user', instance.pk),
+                   versions.model_identifier('users')], sender=sender)
@@ -39,27 +39,67 @@ def bind_namespaces(g):
 OLD_OA_BASE = 'http://www.openannotation.org/ns/'
 NEW_OA_BASE = 'http://www.w3.org/ns/oa#'
 
-def update_oa(graph):
-    def update_term(term):
-        if isinstance(term, URIRef):
-            uri_string = unicode(term)
-            if uri_string.startswith(OLD_OA_BASE):
-                return URIRef(NEW_OA_BASE + uri_string[len(OLD_OA_BASE):])
-            else:
-                return term
-        else:
-            return term
+# (old base, new base) of each namespace which has been replaced
+OLD_NAMESPACES = (
+    (OLD_OA_BASE, NEW_OA_BASE),
+)
+
+def update_term(term):
+    if isinstance(term, URIRef):
+        uri_string = unicode(term)
+        for old_base, new_base in OLD_NAMESPACES:
+            if uri_string.startswith(old_base):
+                return URIRef(new_base + uri_string[len(old_base):])
+
+    return term
+
+def _uses_namespace(triple, base):
+    return any(isinstance(term, URIRef) and term.startswith(base) for term in triple)
+
+def _rewrites_namespaces(store):
+    from semantic_store.unit_of_work import BufferedStore
+
+    while isinstance(store, BufferedStore):
+        store = store.store
+
+    return hasattr(store, 'rewrite_namespace')
 
-    temp_graph = Graph()
-    temp_graph += graph
+def rewrite_namespace(graph, old_base, new_base):
+    """
+    Rewrites every URI starting with old_base in graph to start with new_base instead. Stores which can do this
+    themselves (FourStore with a SPARQL update, the SQLAlchemy store with SQL updates) are asked to; otherwise
+    only the triples which use the old namespace are removed and re-added.
+    """
+    if _rewrites_namespaces(graph.store):
+        graph.store.rewrite_namespace(old_base, new_base, graph)
+    else:
+        old_triples = [triple for triple in graph if _uses_namespace(triple, old_base)]
 
-    for triple in graph:
-        graph.remove(triple)
+        for triple in old_triples:
+            graph.remove(triple)
 
-    for s, p, o in temp_graph:
-        graph.add((update_term(s), update_term(p), update_term(o)))
+        graph.addN((s, p, o, graph) for s, p, o in
+                   ((update_term(s), update_term(p), update_term(o)) for s, p, o in old_triples))
 
     return graph
 
+def update_oa(graph):
+    return rewrite_namespace(graph, OLD_OA_BASE, NEW_OA_BASE)
+
 def update_old_namespaces(graph):
-    return update_oa(graph)
\ No newline at end of file
+    for old_base, new_base in OLD_NAMESPACES:
+        rewrite_namespace(graph, old_base, new_base)
+
+    return graph
+
+class NamespaceUpdatingGraph(Graph):
+    """
+    A graph which updates the old namespaces in every triple added to it. Parsing into one rewrites terms as
+    they are parsed, so newly fetched data never needs a second pass with update_old_namespaces.
+    """
+    def add(self, (s, p, o)):
+        return super(NamespaceUpdatingGraph, self).add((update_term(s), update_term(p), update_term(o)))
+
+    def addN(self, quads):
+        return super(NamespaceUpdatingGraph, self).addN(
+            (update_term(s), update_term(p), update_term(o), c) for s, p, o, c in quads)
@@ -0,0 +1,120 @@
+"""
+Garbage collection of orphaned resources in project graphs.
+
+Specific resources, selectors and annotations are left behind in a project graph when what they annotated is
+removed (or when a highlight is deleted from a text), and nothing else removes them. `collect_garbage` loads a
+project graph into an indexed in-memory graph with a single request to the store, finds everything reachable from
+the project with projects.clean_project_graph, and deletes the triples of those kinds of resource which
+can't be reached, in batches:
+
+    summary = project_gc.collect_garbage(project_uri, dry_run=True)
+
+Only resources of the types in COLLECTED_TYPES are ever deleted, so nothing else in the graph is lost if the
+traversal misses a link. Blank node resources are never collected, since a SPARQL store can't be asked to delete
+the triples of a particular blank node.
+"""
+from rdflib import Graph, URIRef, BNode
+
+from semantic_store import uris, graph_cache, project_metadata
+from semantic_store.models import Text
+from semantic_store.namespaces import NS
+from semantic_store.projects import clean_project_graph, TimeBudgetExceeded
+from semantic_store.rdfstore import rdfstore
+from semantic_store.specific_resources import SELECTOR_TYPES
+
+import itertools
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+COLLECTED_TYPES = [NS.oa.SpecificResource, NS.oa.Annotation] + SELECTOR_TYPES
+
+DEFAULT_BATCH_TRIPLES = 1000
+
+class MetadataNotUpdated(Exception):
+    """Raised when orphans have been deleted from a project graph, but its metadata graph couldn't be updated"""
+    def __init__(self, summary, error):
+        super(MetadataNotUpdated, self).__init__('%d orphaned resources deleted, but the metadata graph was not updated: %s' %
+                                                 (len(summary['orphans']), error))
+        self.summary = summary
+        self.error = error
+
+def orphaned_subjects(graph, clean_graph):
+    """
+    Returns the set of resources of the collected types in graph which have no triples in clean_graph, other than
+    blank nodes
+    """
+    orphans = set()
+    for resource_type in COLLECTED_TYPES:
+        for subject in graph.subjects(NS.rdf.type, resource_type):
+            if not isinstance(subject, BNode) and (subject, None, None) not in clean_graph:
+                orphans.add(subject)
+
+    return orphans
+
+def remove_triples(graph, triples, batch_size=DEFAULT_BATCH_TRIPLES):
+    """
+    Removes the triples of orphaned resources from a graph in the store, a batch at a time (as a single write each,
+    where the store allows). A triple with a blank node object can't be deleted by value from a SPARQL store, so
+    every value of its subject and predicate is removed as a pattern instead, which only removes garbage, since
+    all the triples of an orphan are.
+    """
+    triples = list(triples)
+    for pattern in set((s, p, None) for s, p, o in triples if isinstance(o, BNode)):
+        graph.remove(pattern)
+
+    triples = iter(t for t in triples if not isinstance(t[2], BNode))
+    while True:
+        batch = list(itertools.islice(triples, batch_size))
+        if not batch:
+            break
+
+        if hasattr(graph.store, 'apply_changes'):
+            graph.store.apply_changes([(s, p, o, graph) for s, p, o in batch], [])
+        else:
+            for t in batch:
+                graph.remove(t)
+
+        logger.debug('Removed %d orphaned triples from %s', len(batch), graph.identifier)
+
+def collect_garbage(project_uri, dry_run=False, batch_size=DEFAULT_BATCH_TRIPLES, time_budget=None):
+    """
+    Deletes the orphaned specific resources, selectors and annotations in a project (or just finds them, if dry_run
+    is True). If time_budget (in seconds) runs out before the orphans have been found, TimeBudgetExceeded is
+    raised and nothing is deleted.
+    Returns a dictionary with the number of triples in the project, and the orphaned resources and triples.
+    If the orphans are deleted but the metadata graph can't then be updated, MetadataNotUpdated is raised.
+    """
+    deadline = time.time() + time_budget if time_budget is not None else None
+
+    project_uri = URIRef(project_uri)
+    store = rdfstore()
+    identifier = uris.uri('semantic_store_projects', uri=project_uri)
+
+    graph = graph_cache.load_graph(store, identifier)
+    text_contents = dict(Text.objects.filter(project=project_uri, valid=True).values_list('identifier', 'content'))
+
+    clean_graph = clean_project_graph(graph, project_uri, text_contents, deadline)
+
+    orphans = orphaned_subjects(graph, clean_graph)
+    garbage = Graph()
+    for orphan in orphans:
+        garbage += graph.triples((orphan, None, None))
+
+    summary = {
+        'triples': len(graph),
+        'orphans': orphans,
+        'garbage': garbage,
+    }
+
+    if not dry_run and garbage:
+        remove_triples(Graph(store, identifier), garbage, batch_size)
+
+        try:
+            project_metadata.update_metadata(project_uri, garbage)
+        except Exception as e:
+            logger.exception('Updating the metadata graph of %s after collecting its garbage failed', project_uri)
+            raise MetadataNotUpdated(summary, e)
+
+    return summary
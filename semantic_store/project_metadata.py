@@ -0,0 +1,206 @@
+"""
+Maintenance of project metadata graphs, the cache kept alongside each project graph of just enough of the
+project to render its contents in a GUI (see projects.get_project_metadata_graph).
+
+Everything in a metadata graph is derived from the project graph, resource by resource:
+    the project             its metadata triples (see utils.METADATA_PREDICATES), and what it ore:aggregates
+    aggregated canvases     every triple about the canvas, its image annotations and their images
+    other aggregates        their metadata triples
+
+Rather than writing the same changes to both graphs, code which changes a project graph passes the triples it
+added or removed to `update_metadata`, which works out which resources they belong to, derives those resources
+again from the project graph, and applies the difference to the metadata graph:
+
+    project_graph += input_graph
+    project_metadata.update_metadata(project_uri, input_graph)
+
+`rebuild_metadata` derives a project's whole metadata graph in a fixed number of queries (whatever the number
+of canvases), and replaces anything which has drifted from it.
+
+Blank nodes can't be looked up in a SPARQL store, so resources are only ever found by their IRIs: a blank node
+resource (such as an annotation with a blank node subject) is never a candidate, although what it targets is.
+"""
+from rdflib import Graph, URIRef, BNode
+
+from semantic_store import uris, queries
+from semantic_store.namespaces import NS
+from semantic_store.rdfstore import rdfstore
+from semantic_store.utils import metadata_triples_multi, triples_multi
+
+import logging
+logger = logging.getLogger(__name__)
+
+CANVAS_TYPES = (NS.sc.Canvas, NS.dms.Canvas)
+
+def project_graphs(project_uri):
+    """Returns the project graph and the metadata graph of a project, in the current store"""
+    store = rdfstore()
+    return (Graph(store, identifier=uris.uri('semantic_store_projects', uri=project_uri)),
+            Graph(store, identifier=uris.project_metadata_graph_identifier(project_uri)))
+
+def _named(terms):
+    """Returns the set of the given terms which aren't blank nodes"""
+    return set(term for term in terms if not isinstance(term, BNode))
+
+def _canvas_images(project_graph, canvases):
+    """Yields (canvas, image annotation, image) for the given canvases, with a single query"""
+    if len(canvases) == 1:
+        canvas = iter(canvases).next()
+        for image_anno, image in queries.execute('canvas_images', project_graph, canvas=canvas):
+            yield canvas, image_anno, image
+    else:
+        for canvas, image_anno, image in queries.execute('all_canvas_images', project_graph):
+            if canvas in canvases:
+                yield canvas, image_anno, image
+
+def derive_metadata(project_graph, project_uri, resources=None):
+    """
+    Returns a graph of the metadata of the given resources (the project itself, and the resources it aggregates),
+    or of the whole project if resources is None, derived from the project graph.
+    A resource which the project no longer aggregates has no metadata.
+    """
+    project_uri = URIRef(project_uri)
+    graph = Graph()
+
+    aggregates = _named(project_graph.objects(project_uri, NS.ore.aggregates))
+    if resources is None:
+        resources = aggregates | set([project_uri])
+
+    members = aggregates & set(resources)
+    canvases = set(s for s, p, o in triples_multi(project_graph, [(member, NS.rdf.type, None) for member in members])
+                   if o in CANVAS_TYPES)
+
+    canvas_subjects = set(canvases)
+    if canvases:
+        for canvas, image_anno, image in _canvas_images(project_graph, canvases):
+            canvas_subjects.update((image_anno, image))
+
+    metadata_subjects = members - canvases
+    if project_uri in resources:
+        metadata_subjects.add(project_uri)
+        graph.addN((project_uri, NS.ore.aggregates, aggregate, graph) for aggregate in aggregates)
+
+    graph += triples_multi(project_graph, [(subject, None, None) for subject in _named(canvas_subjects)])
+    graph += metadata_triples_multi(project_graph, metadata_subjects)
+
+    return graph
+
+def current_metadata(metadata_graph, resources):
+    """
+    Returns a graph of the triples in the metadata graph which belong to the given resources: those about the
+    resources themselves, and about the image annotations targeting them and their images (unless an image
+    is also the body of an annotation belonging to some other resource)
+    """
+    resources = set(resources)
+
+    annotations = _named(s for s, p, o in triples_multi(metadata_graph, [(None, NS.oa.hasTarget, r) for r in resources]))
+    images = _named(o for s, p, o in triples_multi(metadata_graph, [(a, NS.oa.hasBody, None) for a in annotations]))
+    owned = resources | annotations
+
+    if images:
+        images -= set(o for s, p, o in triples_multi(metadata_graph, [(None, NS.oa.hasBody, i) for i in images])
+                      if s not in owned)
+
+    graph = Graph()
+    graph += triples_multi(metadata_graph, [(subject, None, None) for subject in owned | images])
+
+    return graph
+
+def affected_resources(project_graph, metadata_graph, project_uri, triples):
+    """
+    Returns the set of resources whose metadata may be changed by adding or removing the given triples to or
+    from the project graph. Image annotations and images belong to the canvases they're linked to, in
+    either the project graph (after the change) or the metadata graph (from before it).
+    A triple's object may be None, as in a pattern removed with Graph.remove.
+    """
+    project_uri = URIRef(project_uri)
+
+    resources = set()
+    candidates = set()
+    for s, p, o in triples:
+        if s == project_uri:
+            resources.add(project_uri)
+            if p in (None, NS.ore.aggregates) and o is not None:
+                resources.add(o)
+        elif s is not None:
+            candidates.add(s)
+            if p == NS.oa.hasTarget and o is not None:
+                candidates.add(o)
+
+    resources = _named(resources)
+    candidates = _named(candidates)
+
+    if not candidates:
+        return resources
+
+    aggregated = set()
+    for graph in (project_graph, metadata_graph):
+        annotations = candidates | _named(s for s, p, o in triples_multi(graph, [(None, NS.oa.hasBody, c) for c in candidates]))
+        candidates |= _named(o for s, p, o in triples_multi(graph, [(a, NS.oa.hasTarget, None) for a in annotations]))
+        aggregated |= set(graph.objects(project_uri, NS.ore.aggregates))
+
+    resources |= candidates & aggregated
+
+    return resources
+
+def apply_difference(metadata_graph, current, expected):
+    """
+    Changes the metadata graph's triples in current to those in expected, in a single write where the store
+    allows. Returns graphs of the triples removed and added.
+
+    A triple with a blank node object can't be deleted by value from a SPARQL store, so the values of each
+    subject and predicate with one to remove are all removed as a pattern, and those expected added again.
+    """
+    removed = current - expected
+    added = expected - current
+
+    blank_patterns = set((s, p, None) for s, p, o in removed if isinstance(o, BNode))
+    removals = [t for t in removed if (t[0], t[1], None) not in blank_patterns]
+    additions = list(added) + [t for t in expected if (t[0], t[1], None) in blank_patterns and t not in added]
+
+    for pattern in blank_patterns:
+        metadata_graph.remove(pattern)
+
+    if removals or additions:
+        store = metadata_graph.store
+        if hasattr(store, 'apply_changes'):
+            store.apply_changes([(s, p, o, metadata_graph) for s, p, o in removals],
+                                [(s, p, o, metadata_graph) for s, p, o in additions])
+        else:
+            for t in removals:
+                metadata_graph.remove(t)
+            metadata_graph.addN((s, p, o, metadata_graph) for s, p, o in additions)
+
+    return removed, added
+
+def update_metadata(project_uri, triples):
+    """
+    Brings a project's metadata graph up to date after the given triples have been added to or removed from
+    its project graph. Returns graphs of the metadata triples removed and added.
+    """
+    project_graph, metadata_graph = project_graphs(project_uri)
+
+    resources = affected_resources(project_graph, metadata_graph, project_uri, list(triples))
+    if not resources:
+        return Graph(), Graph()
+
+    expected = derive_metadata(project_graph, project_uri, resources)
+    current = current_metadata(metadata_graph, resources)
+
+    return apply_difference(metadata_graph, current, expected)
+
+def rebuild_metadata(project_uri, dry_run=False):
+    """
+    Derives a project's whole metadata graph from its project graph, and replaces any triples which differ
+    (unless dry_run is True). Returns graphs of the metadata triples which were (or would be) removed and added.
+    """
+    project_graph, metadata_graph = project_graphs(project_uri)
+
+    expected = derive_metadata(project_graph, project_uri)
+    current = Graph()
+    current += metadata_graph
+
+    if dry_run:
+        return current - expected, expected - current
+    else:
+        return apply_difference(metadata_graph, current, expected)
@@ -1,6 +1,5 @@
 from django.db import transaction
 from django.http import HttpResponse, HttpResponseForbidden
-from django.core.exceptions import ObjectDoesNotExist
 
 from rdflib.graph import Graph
 from rdflib.exceptions import ParserError
@@ -8,7 +7,7 @@ from rdflib import Literal, URIRef
 
 from semantic_store.rdfstore import rdfstore
 from semantic_store.namespaces import NS, ns, bind_namespaces
-from semantic_store import uris
+from semantic_store import uris, result_cache, graph_cache, project_metadata, versions
 from semantic_store.utils import parse_request_into_graph, NegotiatedGraphResponse
 from semantic_store.models import Text
 from semantic_store.users import has_permission_over
@@ -22,6 +21,17 @@ from bs4 import BeautifulSoup, Comment
 import logging
 logger = logging.getLogger(__name__)
 
+# The class of the elements the text editor wraps highlighted passages in; each has the uri of the highlight's
+# oa:TextQuoteSelector as its "about" attribute
+HIGHLIGHT_CLASS = 'atb-editor-textannotation'
+
+def selector_uris_in_text_content(content):
+    """Yields the uris of the selectors highlighted in a text's html content"""
+    soup = BeautifulSoup(content)
+
+    for element in soup.find_all(class_=HIGHLIGHT_CLASS, about=True):
+        yield URIRef(element['about'])
+
 def sanitized_content(content):
     soup = BeautifulSoup(content)
 
@@ -80,47 +90,98 @@ def create_project_text_from_request(request, project_uri, request_text_uri):
     else:
         return HttpResponse(status=401)
 
-def overwrite_text_graph_from_model(text_uri, project_uri, text_g):
-    try:
-        text = Text.objects.get(identifier=text_uri, valid=True, project=project_uri)
-    except ObjectDoesNotExist:
-        pass
+# Triples about a text which are taken from its Text model rather than the project graph
+TEXT_MODEL_PREDICATES = set([NS.dc.title, NS.rdfs.label, NS.cnt.chars, NS.dc.modified])
+
+def text_model_triples(text_uri, title, content, timestamp):
+    """The triples about a text written from its Text model"""
+    return [
+        (text_uri, NS.rdf.type, NS.dctypes.Text),
+        (text_uri, NS.rdf.type, NS.cnt.ContentAsChars),
+        (text_uri, NS.dc.title, Literal(title)),
+        (text_uri, NS.rdfs.label, Literal(title)),
+        (text_uri, NS.cnt.chars, Literal(content)),
+        (text_uri, NS.dc.modified, Literal(timestamp)),
+    ]
+
+def project_text_models(project_uri, text_uri=None, with_content=True):
+    """
+    Returns an iterator over the valid Text models of a project (or just of one text), fetched with a single query
+    and read off the cursor a row at a time, oldest first. Unless with_content is True, the content of each text is
+    deferred, and only read (with a query of its own) if it is used.
+    """
+    texts = Text.objects.filter(project=project_uri, valid=True)
+    if text_uri is not None:
+        texts = texts.filter(identifier=text_uri)
+    if not with_content:
+        texts = texts.defer('content')
+
+    return texts.order_by('timestamp').iterator()
+
+def overwrite_text_graphs_from_models(project_uri, graph, text_uris=None):
+    """
+    Replaces the triples about each of the given texts (by default, every dctypes:Text in the graph) which come from
+    their Text models with those in the models, reading all of the project's texts in a single query.
+    """
+    if text_uris is None:
+        text_uris = graph.subjects(NS.rdf.type, NS.dctypes.Text)
+    text_uris = set(unicode(uri) for uri in text_uris)
+
+    if len(text_uris) == 1:
+        models = project_text_models(project_uri, iter(text_uris).next())
     else:
-        text_g.add((text_uri, NS.rdf.type, NS.dctypes.Text))
-        text_g.add((text_uri, NS.rdf.type, NS.cnt.ContentAsChars))
+        models = project_text_models(project_uri)
 
-        text_g.set((text_uri, NS.dc.title, Literal(text.title)))
-        text_g.set((text_uri, NS.rdfs.label, Literal(text.title)))
-        text_g.set((text_uri, NS.cnt.chars, Literal(text.content)))
+    for text in models:
+        if text.identifier in text_uris:
+            text_uri = URIRef(text.identifier)
+            for p in TEXT_MODEL_PREDICATES:
+                graph.remove((text_uri, p, None))
+            graph += text_model_triples(text_uri, text.title, text.content, text.timestamp)
 
-        text_g.set((text_uri, NS.dc.modified, Literal(text.timestamp)))
+    return graph
 
-    return text_g
+def overwrite_text_graph_from_model(text_uri, project_uri, text_g):
+    return overwrite_text_graphs_from_models(project_uri, text_g, [text_uri])
 
 def text_graph_from_model(text_uri, project_uri):
     text_g = Graph()
 
     return overwrite_text_graph_from_model(text_uri, project_uri, text_g)
 
+def text_identifiers(project_uri, text_uri):
+    """Returns the identifiers of the graph and model data a project text is read from (see versions.py)"""
+    return [uris.uri('semantic_store_projects', uri=project_uri), versions.model_identifier('text', text_uri)]
+
 # Returns serialized data about a given text in a given project
 # Although intended to be used with a GET request, works independent of a request
-def read_project_text(project_uri, text_uri):
+# (project_graph is the project graph to read from, when one has already been loaded, and the text's triples from
+# its Text model are only added if from_model is True)
+def read_project_text(project_uri, text_uri, project_graph=None, from_model=True):
     # Correctly format project uri and get project graph
     project_identifier = uris.uri('semantic_store_projects', uri=project_uri)
-    project_g = Graph(rdfstore(), identifier=project_identifier)
 
     # Make text uri URIRef (so Graph will understand)
     text_uri = URIRef(text_uri)
 
-    # Create an empty graph and bind namespaces
-    text_g = Graph()
-    bind_namespaces(text_g)
+    def text_annotations_graph():
+        project_g = project_graph if project_graph is not None else graph_cache.readable_graph(project_identifier)
+
+        # Create an empty graph and bind namespaces
+        text_g = Graph()
+        bind_namespaces(text_g)
+
+        text_g += resource_annotation_subgraph(project_g, text_uri)
 
-    text_g += resource_annotation_subgraph(project_g, text_uri)
+        text_g += specific_resources_subgraph(project_g, text_uri, project_uri)
 
-    text_g += specific_resources_subgraph(project_g, text_uri, project_uri)
+        return text_g
 
-    overwrite_text_graph_from_model(text_uri, project_uri, text_g)
+    # The text's annotations come from the store, so can be cached, but its content comes from the Text model
+    text_g = result_cache.cached_graph('text_annotations', [project_identifier], (project_uri, text_uri), text_annotations_graph)
+
+    if from_model:
+        overwrite_text_graph_from_model(text_uri, project_uri, text_g)
 
     # Return graph about text
     return text_g
@@ -135,8 +196,6 @@ def update_project_text(g, p_uri, t_uri, user):
     logger.debug("!!!!!!!!!!!!!! Here 1")
     project_g = Graph(rdfstore(), identifier=project_uri)
     logger.debug("!!!!!!!!!!!!!! Here 2")
-    project_metadata_g = Graph(rdfstore(), identifier=uris.project_metadata_graph_identifier(p_uri))
-    logger.debug("!!!!!!!!!!!!!! Here 3")
     text_uri = URIRef(t_uri)
     logger.debug("!!!!!!!!!!!!!! Here 4")
 
@@ -183,14 +242,8 @@ def update_project_text(g, p_uri, t_uri, user):
         project_g.set((text_uri, NS.ore.isDescribedBy, text_url))
         logger.debug("!!!!!!!!!!!!!! Here 16")
 
-        if (URIRef(p_uri), NS.ore.aggregates, text_uri) in project_metadata_g:
-            logger.debug("!!!!!!!!!!!!!! Here 16.1")
-            project_metadata_g.add((text_uri, NS.rdf.type, NS.dctypes.Text))
-            logger.debug("!!!!!!!!!!!!!! Here 16.2")
-            project_metadata_g.set((text_uri, NS.dc.title, title))
-            logger.debug("!!!!!!!!!!!!!! Here 16.3")
-            project_metadata_g.set((text_uri, NS.rdfs.label, title))
-            logger.debug("!!!!!!!!!!!!!! Here 16.4")
+        project_metadata.update_metadata(p_uri, project_g.triples((text_uri, None, None)))
+        logger.debug("!!!!!!!!!!!!!! Here 16.1")
 
     logger.debug("!!!!!!!!!!!!!! Here 17")
     specific_resource_triples = specific_resources_subgraph(g, text_uri, p_uri)
@@ -235,9 +288,9 @@ def update_project_text_from_request(request, project_uri, text_uri):
 # Although intended to be user with a DELETE request, works independently of a request
 def remove_project_text(project_uri, text_uri):
     # Correctly format project uri and get project graph
+    p_uri = project_uri
     project_uri = uris.uri('semantic_store_projects', uri=project_uri)
     project_g = Graph(rdfstore(), identifier=project_uri)
-    project_metadata_g = Graph(rdfstore(), identifier=uris.project_metadata_graph_identifier(p_uri))
 
     # Make text uri a URIRef (so Graph will understand)
     text_uri = URIRef(text_uri)
@@ -246,12 +299,15 @@ def remove_project_text(project_uri, text_uri):
         for t in specific_resources_subgraph(project_g, text_uri, project_uri):
             project_g.remove(t)
 
-        for t in project_g.triples((text_uri, None, None)):
+        removed = list(project_g.triples((text_uri, None, None)))
+        for t in removed:
             # Delete triple about text from project graph
             project_g.remove(t)
-            project_metadata_g.remove(t)
 
-        project_g.remove((URIRef(project_uri), NS.ore.aggregates, text_uri))
+        project_g.remove((URIRef(p_uri), NS.ore.aggregates, text_uri))
+        removed.append((URIRef(p_uri), NS.ore.aggregates, text_uri))
+
+        project_metadata.update_metadata(p_uri, removed)
 
         for text in Text.objects.filter(identifier=text_uri, valid=True).only('valid'):
             text.valid = False
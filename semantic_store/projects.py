@@ -4,18 +4,19 @@ from django.contrib.auth.models import User
 
 from rdflib.graph import Graph
 from rdflib.exceptions import ParserError
-from rdflib import URIRef, Literal
+from rdflib import URIRef, Literal, BNode
 
 from semantic_store.rdfstore import rdfstore
 from semantic_store.namespaces import NS, ns, bind_namespaces
-from semantic_store import uris
-from semantic_store.utils import NegotiatedGraphResponse, parse_request_into_graph, metadata_triples, print_triples
+from semantic_store import uris, result_cache, graph_cache, queries, project_metadata, versions, conditional, serialization_cache
+from semantic_store.utils import NegotiatedGraphResponse, parse_request_into_graph, print_triples
 from semantic_store.users import PERMISSION_PREDICATES, user_graph, user_metadata_graph
-from semantic_store.project_texts import sanitized_content, text_graph_from_model
+from semantic_store.project_texts import sanitized_content, overwrite_text_graphs_from_models
 from semantic_store import project_texts, canvases, permissions, manuscripts
 from semantic_store.models import ProjectPermission
 
 from datetime import datetime
+import time
 import itertools
 
 import logging
@@ -27,6 +28,13 @@ def get_project_graph(project_uri):
     """Returns the database graph used to store general information about the project with the given uri"""
     return Graph(store=rdfstore(), identifier=uris.uri('semantic_store_projects', uri=project_uri))
 
+def get_readable_project_graph(project_uri):
+    """
+    Returns the project graph for reading only, which is an in-memory copy from the graph cache when that
+    is enabled (see semantic_store.graph_cache)
+    """
+    return graph_cache.readable_graph(uris.uri('semantic_store_projects', uri=project_uri))
+
 def get_project_metadata_graph(project_uri):
     """
     Returns the database graph used as a cache to be returned when just the project contents overview is requested
@@ -50,14 +58,6 @@ def create_project(g):
     """Creates a project in the database (and the metadata cache) from an input graph"""
     print "Here 1"
 
-    query = g.query("""SELECT ?uri ?user
-                    WHERE {
-                        ?user perm:hasPermissionOver ?uri .
-                        ?user rdf:type foaf:Agent .
-                    }""", initNs=ns)
-
-    print "Here 2"
-
     for uri in g.subjects(NS.rdf.type, NS.dm.Project):
         print "Here 3"
         user = g.value(None, NS.perm.hasPermissionOver, uri)
@@ -80,8 +80,7 @@ def create_project(g):
 
         print "Here 5"
 
-        for t in g:
-            project_g.add(t)
+        project_g.addN((s, p, o, project_g) for s, p, o in g)
 
         for text_uri in g.subjects(NS.rdf.type, NS.dcmitype.Text):
             project_g.remove((text_uri, NS.cnt.chars, None))
@@ -102,46 +101,74 @@ def create_project(g):
 
         print "Successfully created project with uri " + uri
 
+# The view describing each type of project resource, and the name of its uri argument
+DESCRIBED_BY_VIEWS = {
+    NS.dcmitype.Text: ("semantic_store_project_texts", 'text_uri'),
+    NS.sc.Canvas: ("semantic_store_project_canvases", 'canvas_uri'),
+    NS.sc.Manifest: ("semantic_store_project_manuscripts", 'manuscript_uri'),
+}
+
 def add_is_described_bys(request, project_uri, graph):
-    for text in graph.subjects(NS.rdf.type, NS.dcmitype.Text):
-        text_url = uris.url("semantic_store_project_texts", project_uri=project_uri, text_uri=text)
-        graph.add((text, NS.ore.isDescribedBy, text_url))
+    for resource, resource_type in list(graph.subject_objects(NS.rdf.type)):
+        if resource_type in DESCRIBED_BY_VIEWS:
+            viewname, argument = DESCRIBED_BY_VIEWS[resource_type]
+            resource_url = uris.url(viewname, **{'project_uri': project_uri, argument: resource})
+            graph.add((resource, NS.ore.isDescribedBy, resource_url))
+
+def add_permission_holders(project_uri, graph):
+    """Adds the metadata of each user with permissions over the project, and their permissions, to graph"""
+    for permission in ProjectPermission.objects.filter(identifier=project_uri).select_related('user'):
+        user = permission.user
+        user_uri = uris.uri('semantic_store_users', username=user.username)
+        perm_uri = permissions.PERMISSION_URIS_BY_MODEL_VALUE[permission.permission]
+
+        graph += user_metadata_graph(user=user)
+        graph.add((user_uri, NS.perm.hasPermissionOver, project_uri))
+        graph.add((user_uri, perm_uri, project_uri))
+
+def _project_metadata_snapshot(project_uri):
+    metadata_graph = get_project_metadata_graph(project_uri)
 
-    for canvas in graph.subjects(NS.rdf.type, NS.sc.Canvas):
-        canvas_url = uris.url("semantic_store_project_canvases", project_uri=project_uri, canvas_uri=canvas)
-        graph.add((canvas, NS.ore.isDescribedBy, canvas_url))
+    graph = Graph()
+    for prefix, namespace in metadata_graph.namespaces():
+        graph.bind(prefix, namespace)
+    graph.addN((s, p, o, graph) for s, p, o in queries.execute('graph_snapshot', metadata_graph))
 
-    for manuscript in graph.subjects(NS.rdf.type, NS.sc.Manifest):
-        manuscript_url = uris.url("semantic_store_project_manuscripts", project_uri=project_uri, manuscript_uri=manuscript)
-        graph.add((manuscript, NS.ore.isDescribedBy, manuscript_url))
+    add_is_described_bys(None, project_uri, graph)
+
+    return graph
+
+def project_snapshot(project_uri):
+    """
+    Returns a new graph with everything needed to open a project: its metadata graph (fetched with a single
+    CONSTRUCT query, or from the result cache) with ore:isDescribedBy links for its texts, canvases and manuscripts,
+    and the users with permissions over it.
+    """
+    metadata_identifier = uris.project_metadata_graph_identifier(project_uri)
+    graph = result_cache.cached_graph('project_snapshot', [metadata_identifier], (project_uri,),
+                                      lambda: _project_metadata_snapshot(project_uri))
+
+    add_permission_holders(project_uri, graph)
+
+    return graph
+
+def project_snapshot_identifiers(project_uri):
+    """Returns the identifiers of the graphs and model data a project snapshot is derived from (see versions.py)"""
+    user_ids = ProjectPermission.objects.filter(identifier=project_uri).values_list('user_id', flat=True).distinct()
+
+    return ([uris.project_metadata_graph_identifier(project_uri), versions.model_identifier('permissions', project_uri)] +
+            [versions.model_identifier('user', user_id) for user_id in user_ids])
 
 def build_project_metadata_graph(project_uri):
     """
     Takes an entire project graph (with every triple in the project in it), and builds out the metadata cache graph with just
     enough information to render the project in a GUI.
     This should really only be called when importing a full project from a file, or to rebuild the cache. The cache should otherwise
-    be maintained with each update, as it is very expensive to rebuild this cache.
+    be maintained with each update (see project_metadata.update_metadata).
     """
-    metadata_graph = get_project_metadata_graph(project_uri)
-    project_graph = get_project_graph(project_uri)
-
-    metadata_graph += metadata_triples(project_graph, project_uri)
+    project_metadata.rebuild_metadata(project_uri)
 
-    for aggregate_uri in project_graph.objects(project_uri, NS.ore.aggregates):
-        metadata_graph.add((project_uri, NS.ore.aggregates, aggregate_uri))
-
-        if ((aggregate_uri, NS.rdf.type, NS.sc.Canvas) in project_graph or
-            (aggregate_uri, NS.rdf.type, NS.dms.Canvas) in project_graph):
-            for t in canvases.canvas_and_images_graph(project_graph, aggregate_uri):
-                metadata_graph.add(t)
-        elif (aggregate_uri, NS.rdf.type, NS.dcmitype.Text) in project_graph:
-            for t in metadata_triples(project_graph, aggregate_uri):
-                metadata_graph.add(t)
-        else:
-            for t in metadata_triples(project_graph, aggregate_uri):
-                metadata_graph.add(t)
-
-    return metadata_graph
+    return get_project_metadata_graph(project_uri)
 
 def read_project(request, project_uri):
     """Returns a HttpResponse of the cached project metadata graph"""
@@ -149,26 +176,18 @@ def read_project(request, project_uri):
 
     if request.user.is_authenticated():
         if permissions.has_permission_over(project_uri, user=request.user, permission=NS.perm.mayRead):
-            identifier = uris.uri('semantic_store_projects', uri=project_uri)
-            store_metadata_graph = get_project_metadata_graph(project_uri)
-            ret_graph = Graph()
-            ret_graph += store_metadata_graph
+            identifiers = project_snapshot_identifiers(project_uri)
 
-            add_is_described_bys(request, project_uri, ret_graph)
+            def response():
+                serialization = serialization_cache.cached_serialization(request, 'project_snapshot', identifiers,
+                                                                         (project_uri,), lambda: project_snapshot(project_uri))
 
-            for permission in ProjectPermission.objects.filter(identifier=project_uri):
-                user = permission.user
-                user_uri = uris.uri('semantic_store_users', username=user.username)
-                perm_uri = permissions.PERMISSION_URIS_BY_MODEL_VALUE[permission.permission]
+                if serialization.triples > 0:
+                    return NegotiatedGraphResponse(request, None, serialization)
+                else:
+                    return HttpResponseNotFound()
 
-                ret_graph += user_metadata_graph(user=user)
-                ret_graph.add((user_uri, NS.perm.hasPermissionOver, project_uri))
-                ret_graph.add((user_uri, perm_uri, project_uri))
-            
-            if len(ret_graph) > 0:
-                return NegotiatedGraphResponse(request, ret_graph)
-            else:
-                return HttpResponseNotFound()
+            return conditional.graph_response(request, identifiers, response)
         else:
             return HttpResponseForbidden('User "%s" does not have read permissions over project "%s"' % (request.user.username, project_uri))
     else:
@@ -203,32 +222,18 @@ def update_project_graph(g, identifier):
     uri = uris.uri('semantic_store_projects', uri=identifier)
 
     project_g = get_project_graph(identifier)
-    project_metadata_g = get_project_metadata_graph(identifier)
 
     #Prevent duplicate metadata
-    if (URIRef(identifier), NS.dc.title, None) in g:
-        project_g.remove((URIRef(identifier), NS.dc.title, None))
-        project_metadata_g.remove((URIRef(identifier), NS.dc.title, None))
-    if (URIRef(identifier), NS.rdfs.label, None) in g:
-        project_g.remove((URIRef(identifier), NS.rdfs.label, None))
-        project_metadata_g.remove((URIRef(identifier), NS.rdfs.label, None))
-    if (URIRef(identifier), NS.dcterms.description, None) in g:
-        project_g.remove((URIRef(identifier), NS.dcterms.description, None))
-        project_metadata_g.remove((URIRef(identifier), NS.dcterms.description, None))
+    removed = []
+    for predicate in (NS.dc.title, NS.rdfs.label, NS.dcterms.description):
+        if (URIRef(identifier), predicate, None) in g:
+            project_g.remove((URIRef(identifier), predicate, None))
+            removed.append((URIRef(identifier), predicate, None))
 
     for triple in g:
         project_g.add(triple)
 
-    for triple in metadata_triples(g, identifier):
-        project_metadata_g.add(triple)
-
-    for triple in g.triples((identifier, NS.ore.aggregates, None)):
-        project_metadata_g.add(triple)
-
-        aggregate_uri = triple[2]
-
-        project_metadata_g += metadata_triples(project_g, aggregate_uri)
-        project_metadata_g += metadata_triples(g, aggregate_uri)
+    project_metadata.update_metadata(identifier, itertools.chain(removed, g))
 
 def delete_project(uri):
     """Deletes a project with the given URI. (Cascades project permissions as well)"""
@@ -256,13 +261,13 @@ def delete_triples_from_project(request, uri):
                 return HttpResponse(status=400, content="Unable to parse serialization.\n%s" % e)
 
             project_g = get_project_graph(uri)
-            project_metadata_g = get_project_metadata_graph(uri)
 
             for t in g:
                 if t in project_g:
                     project_g.remove(t)
                     removed.add(t)
-                project_metadata_g.remove(t)
+
+            project_metadata.update_metadata(uri, removed)
 
             return NegotiatedGraphResponse(request, removed)
         else:
@@ -305,8 +310,7 @@ def project_export_graph(project_uri):
     export_graph += db_project_graph
     export_graph += db_metadata_graph
 
-    for text_uri in export_graph.subjects(NS.rdf.type, NS.dcmitype.Text):
-        export_graph += text_graph_from_model(text_uri, project_uri)
+    overwrite_text_graphs_from_models(project_uri, export_graph)
 
     return export_graph
 
@@ -314,59 +318,67 @@ def is_top_level_project_resource(project_uri, uri):
     db_project_graph = get_project_graph(project_uri)
     return (URIRef(project_uri), NS.ore.aggregates, uri) in db_project_graph
 
-def clean_project_graph(graph, project_uri):
+class TimeBudgetExceeded(Exception):
+    pass
+
+def clean_project_graph(graph, project_uri, text_contents=None, deadline=None):
     """
-    Returns a set of all non-orphaned resource uris in a project (i.e., resources which are top level or linked by an annotation).
-    (Does a complete graph traversal)
+    Returns a graph of all non-orphaned triples in a project (i.e., about resources which are top level, or linked from
+    one by an annotation or any other triple). Specific resources of a canvas are kept, but those of a text only if
+    the text's content still highlights their selector.
+    (Does a complete graph traversal, so graph should be an in-memory copy of the project graph; see project_gc)
+
+    The html contents of texts are looked up in text_contents (a dictionary of text uri to content) if it is given,
+    rather than in the graph. If the time.time() deadline passes during the traversal, TimeBudgetExceeded is raised.
     """
     clean_graph = Graph()
     clean_graph += graph.triples((project_uri, None, None))
 
-    visited = set()
+    visited = set([project_uri])
     frontier = set(graph.objects(project_uri, NS.ore.aggregates))
 
     def enqueue(o):
-        if isinstance(o, URIRef):
+        if isinstance(o, (URIRef, BNode)):
             if o not in visited:
                 frontier.add(o)
-        else:
+        elif not isinstance(o, Literal):
             for i in o:
                 enqueue(i)
 
     while len(frontier) > 0:
+        if deadline is not None and time.time() > deadline:
+            raise TimeBudgetExceeded('Traversal of %s stopped after visiting %d resources' % (project_uri, len(visited)))
+
         visited_resource = frontier.pop()
         visited.add(visited_resource)
 
         if (visited_resource, NS.rdf.type, NS.sc.Canvas) in graph:
-            # Visiting a Canvas
-            clean_graph += canvases.canvas_and_images_graph(graph, visited_resource)
+            # Visiting a Canvas (its image annotations are found below, as annotations targeting it)
             enqueue(graph.subjects(NS.oa.hasSource, visited_resource))
 
         elif (visited_resource, NS.rdf.type, NS.dctypes.Text) in graph:
             # Visiting a Text
-            clean_graph += graph.triples((visited_resource, None, None))
-            content = graph.value(visited_resource, NS.cnt.chars)
+            if text_contents is not None:
+                content = text_contents.get(unicode(visited_resource))
+            else:
+                content = graph.value(visited_resource, NS.cnt.chars)
             if content:
                 for selector in project_texts.selector_uris_in_text_content(unicode(content)):
                     specific_resource = graph.value(None, NS.oa.hasSelector, selector)
                     if specific_resource:
                         enqueue(specific_resource)
 
-        elif (visited_resource, NS.rdf.type, NS.oa.SpecificResource) in graph:
-            # Visiting a Specific Resource
-            clean_graph += graph.triples((visited_resource, None, None))
-            selector = graph.value(visited_resource, NS.oa.hasSelector)
-            if selector:
-                clean_graph += graph.triples((selector, None, None))
-
-
         for anno in itertools.chain(
                 graph.subjects(NS.oa.hasTarget, visited_resource),
                 graph.subjects(NS.oa.hasBody, visited_resource)
             ):
-            clean_graph += graph.triples((anno, None, None))
-            for s, p, linked_resource in graph.triples_choices((anno, [NS.oa.hasBody, NS.oa.hasTarget], None)):
-                enqueue(linked_resource)
+            enqueue(anno)
+
+        # Anything the resource links to (its selector, an annotation's body and targets, list nodes, ...) is kept too
+        for t in graph.triples((visited_resource, None, None)):
+            clean_graph.add(t)
+            if t[1] != NS.rdf.type:
+                enqueue(t[2])
 
     return clean_graph
 
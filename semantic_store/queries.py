@@ -0,0 +1,189 @@
+"""
+A registry of the fixed SPARQL queries used by semantic_store.
+
+Each query is registered once by name, with its parameters written as ordinary variables, and is executed with
+those variables bound to terms:
+
+    for image_anno, image in queries.execute('canvas_images', graph, canvas=canvas_uri):
+        ...
+
+Against local graphs (in-memory, or the SQLAlchemy store), the query is parsed and translated to algebra the first
+time it is used, and the prepared query is evaluated with initBindings from then on. Stores which send query text to
+a SPARQL endpoint (i.e. FourStore) are sent the cached query text with the parameters substituted as validated
+n3 terms, rather than a string built with % interpolation.
+
+Execution counts and timings are kept for each query, and are available from `stats()`.
+"""
+from rdflib import URIRef, Literal
+from rdflib.term import Node
+from rdflib.plugins.sparql import prepareQuery
+from rdflib.plugins.stores.sparqlstore import SPARQLStore
+
+from semantic_store.namespaces import ns
+from semantic_store.unit_of_work import BufferedStore
+
+import re
+import threading
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Characters which may not appear in an IRI written in a SPARQL query (see the IRIREF production)
+_INVALID_IRI_CHARACTERS = re.compile(u'[<>"{}|^`\\\\\x00-\x20]')
+
+class QueryParameterError(ValueError):
+    pass
+
+def parameter_n3(name, value):
+    """Returns the n3 form of a parameter value, refusing anything which could change the meaning of the query"""
+    if not isinstance(value, Node):
+        raise QueryParameterError('Parameter "%s" must be an rdflib term, not %r' % (name, value))
+
+    if isinstance(value, URIRef):
+        if _INVALID_IRI_CHARACTERS.search(value):
+            raise QueryParameterError('Parameter "%s" is not a valid IRI: %r' % (name, value))
+    elif not isinstance(value, Literal):
+        raise QueryParameterError('Parameter "%s" must be a URIRef or Literal, not %r' % (name, value))
+
+    return value.n3()
+
+def _sends_query_text(store):
+    while isinstance(store, BufferedStore):
+        store = store.store
+
+    return isinstance(store, SPARQLStore)
+
+class PreparedQuery(object):
+    def __init__(self, name, text, parameters=(), initNs=ns):
+        self.name = name
+        self.text = text
+        self.parameters = tuple(parameters)
+        self.initNs = initNs
+
+        # Stores keep the namespaces they are given for later queries, so they are passed plain URIRefs rather
+        # than namespace objects (a ClosedNamespace such as RDF can't be turned back into a URIRef by rdflib)
+        self._text_ns = dict((prefix, URIRef(unicode(namespace))) for prefix, namespace in initNs.iteritems())
+
+        self._prepared = None
+        self._lock = threading.Lock()
+
+        self.executions = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+        body_start = text.index('{')
+        self._head, self._body = text[:body_start], text[body_start:]
+
+    def prepared(self):
+        """Returns the parsed and translated query, preparing it the first time it is needed"""
+        if self._prepared is None:
+            with self._lock:
+                if self._prepared is None:
+                    self._prepared = prepareQuery(self.text, initNs=self.initNs)
+
+        return self._prepared
+
+    def bound_text(self, bindings):
+        """Returns the query text with each parameter variable in the query body replaced by its value"""
+        body = self._body
+        for name, value in bindings.iteritems():
+            body = re.sub(r'[?$]%s\b' % re.escape(name), lambda match: parameter_n3(name, value), body)
+
+        return self._head + body
+
+    def _check_bindings(self, bindings):
+        unknown = set(bindings) - set(self.parameters)
+        if unknown:
+            raise QueryParameterError('Unknown parameters for query "%s": %s' % (self.name, ', '.join(sorted(unknown))))
+
+        missing = set(self.parameters) - set(bindings)
+        if missing:
+            raise QueryParameterError('Missing parameters for query "%s": %s' % (self.name, ', '.join(sorted(missing))))
+
+        for name, value in bindings.iteritems():
+            parameter_n3(name, value)
+
+    def execute(self, graph, **bindings):
+        """Runs the query against graph with the given parameter values, and returns a list of the result rows"""
+        self._check_bindings(bindings)
+
+        start = time.time()
+
+        if _sends_query_text(graph.store):
+            rows = list(graph.query(self.bound_text(bindings), initNs=self._text_ns))
+        else:
+            rows = list(graph.query(self.prepared(), initNs=self.initNs, initBindings=bindings))
+
+        elapsed = time.time() - start
+        with self._lock:
+            self.executions += 1
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+
+        logger.debug('Query "%s" returned %d rows in %.4fs', self.name, len(rows), elapsed)
+
+        return rows
+
+    def stats(self):
+        with self._lock:
+            return {
+                'executions': self.executions,
+                'total_time': self.total_time,
+                'mean_time': self.total_time / self.executions if self.executions else 0.0,
+                'max_time': self.max_time,
+            }
+
+registry = {}
+
+def register(name, text, parameters=(), initNs=ns):
+    if name in registry:
+        raise ValueError('A query named "%s" is already registered' % name)
+
+    registry[name] = PreparedQuery(name, text, parameters, initNs)
+    return registry[name]
+
+def execute(name, graph, **bindings):
+    return registry[name].execute(graph, **bindings)
+
+def stats():
+    """Returns a dictionary of execution counts and timings by query name"""
+    return dict((name, query.stats()) for name, query in registry.iteritems())
+
+register('canvas_images', """SELECT ?image_anno ?image WHERE {
+    ?image_anno a oa:Annotation .
+    ?image_anno oa:hasTarget ?canvas .
+    ?image_anno oa:hasBody ?image .
+    ?image a ?type .
+    FILTER(?type = dcmitype:Image || ?type = dms:Image || ?type = dms:ImageChoice) .
+}""", parameters=('canvas',))
+
+register('all_canvas_images', """SELECT DISTINCT ?canvas ?image_anno ?image WHERE {
+    ?canvas a ?canvasType .
+    ?image a ?imageType .
+    FILTER(?canvasType = sc:Canvas || ?canvasType = dms:Canvas) .
+    FILTER(?imageType = dcmitype:Image || ?imageType = dms:Image || ?imageType = dms:ImageChoice) .
+    ?image_anno a oa:Annotation .
+    ?image_anno oa:hasTarget ?canvas .
+    ?image_anno oa:hasBody ?image .
+}""")
+
+register('aggregated_uris_urls', """SELECT DISTINCT ?resource_uri ?resource_url WHERE {
+    ?uri ore:aggregates ?resource_uri .
+    OPTIONAL { ?resource_url ore:describes ?resource_uri } .
+    OPTIONAL { ?resource_uri ore:isDescribedBy ?resource_url }
+}""", parameters=('uri',))
+
+register('page_attributes', """SELECT DISTINCT ?res_title ?title ?width ?height ?image WHERE {
+    {?res_uri dc:title ?res_title} UNION {?res_uri rdfs:label ?res_title} .
+    {?page_uri dc:title ?title} UNION {?page_uri rdfs:label ?title} .
+    ?page_uri exif:width ?width .
+    ?page_uri exif:height ?height .
+    ?anno oa:hasTarget ?page_uri .
+    ?anno oa:hasBody ?image .
+    ?image rdf:type dcmitype:Image .
+}""", parameters=('res_uri', 'page_uri'))
+
+register('graph_snapshot', """CONSTRUCT { ?s ?p ?o } WHERE {
+    ?s ?p ?o
+}""")
@@ -1,35 +1,264 @@
 from rdflib import plugin, URIRef, Literal, Graph, BNode, Variable
 from rdflib.store import Store
 from rdflib.query import Result
-from rdflib.plugins.stores.sparqlstore import SPARQLUpdateStore, TraverseSPARQLResultDOM
+from rdflib.plugins.stores.sparqlstore import SPARQLUpdateStore
 from django.conf import settings
+from collections import OrderedDict
+import itertools
 import re
 import urllib
-import httplib, requests
+import urlparse
+import requests
+
+from semantic_store import utils, sparql_results, versions, graph_cache, change_log, instrumentation
+from semantic_store.connection_pool import ConnectionPool
+from semantic_store.unit_of_work import active_store
+from rdflib_sqlalchemy.SQLAlchemy import (SQLAlchemy, unionSELECT, extractTriple, TRIPLE_SELECT_NO_ORDER,
+                                          ASSERTED_LITERAL_PARTITION, ASSERTED_NON_TYPE_PARTITION,
+                                          ASSERTED_TYPE_PARTITION, QUOTED_PARTITION)
+from sqlalchemy.sql import expression
+from sqlalchemy import and_, func, types, literal as sql_literal
+from rdflib.namespace import RDF
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Upper bounds on the size of a single update request sent by FourStore.addN
+# (these can be overridden with FOUR_STORE_UPDATE_BATCH_QUADS and FOUR_STORE_UPDATE_BATCH_BYTES)
+DEFAULT_UPDATE_BATCH_QUADS = 5000
+DEFAULT_UPDATE_BATCH_BYTES = 1024 * 1024
+
+# Connection pool bounds for each of the FourStore endpoints
+# (these can be overridden with FOUR_STORE_POOL_SIZE and FOUR_STORE_POOL_MAX_IDLE)
+DEFAULT_POOL_SIZE = 10
+DEFAULT_POOL_MAX_IDLE = 60
+
+# Maximum number of patterns answered by a single triples_multi query, and whether the patterns are written as
+# a UNION of bound patterns (SPARQL 1.0, understood by 4store) or as VALUES blocks (SPARQL 1.1)
+# (these can be overridden with FOUR_STORE_MULTI_PATTERN_LIMIT and FOUR_STORE_MULTI_PATTERN_SYNTAX)
+DEFAULT_MULTI_PATTERN_LIMIT = 100
+DEFAULT_MULTI_PATTERN_SYNTAX = 'union'
+
+_MULTI_PATTERN_VARIABLE = re.compile(r'^([spo])(\d+)$')
+
+def _blank_nodes(quad):
+    return [term for term in quad[:3] if isinstance(term, BNode)]
+
+def blank_node_components(quads):
+    """
+    Groups quads holding blank nodes into lists, so that quads which share a blank node (directly, or through
+    other quads) are always in the same list
+    """
+    parent = {}
+
+    def find(node):
+        root = node
+        while parent[root] != root:
+            root = parent[root]
+        while parent[node] != root:
+            parent[node], node = root, parent[node]
+        return root
+
+    for quad in quads:
+        nodes = _blank_nodes(quad)
+        for node in nodes:
+            parent.setdefault(node, node)
+        for node in nodes[1:]:
+            parent[find(node)] = find(nodes[0])
+
+    components = OrderedDict()
+    for quad in quads:
+        components.setdefault(find(_blank_nodes(quad)[0]), []).append(quad)
+
+    return components.values()
+
+def data_update_batches(quads, operation='INSERT DATA', max_quads=None, max_bytes=None):
+    """
+    Groups an iterable of quads by named graph, and yields (update string, quad count) tuples.
+    Each update contains one `operation` block per graph, and carries at most max_quads quads and
+    (approximately) max_bytes bytes of triple data, so arbitrarily large imports are split into
+    several reasonably sized requests rather than one enormous one.
+
+    A blank node label stands for a new blank node in each INSERT DATA operation, so quads with blank nodes are
+    held back until the others have been batched, and then each set of quads which share blank nodes is written
+    in a single INSERT DATA operation (with a GRAPH block for each graph it touches), never split across
+    operations or requests, even if it is larger than the batch limits. Blank nodes are only the same node within
+    one call, though: the same blank node added in two calls (e.g. two addN calls) becomes two nodes in the store.
+    DELETE DATA can't match blank nodes at all, so they can't be deleted this way.
+    """
+    if max_quads is None:
+        max_quads = getattr(settings, 'FOUR_STORE_UPDATE_BATCH_QUADS', DEFAULT_UPDATE_BATCH_QUADS)
+    if max_bytes is None:
+        max_bytes = getattr(settings, 'FOUR_STORE_UPDATE_BATCH_BYTES', DEFAULT_UPDATE_BATCH_BYTES)
+
+    def build_update(triples_by_graph, components):
+        update = ''.join('%s { GRAPH %s { %s } };\n' % (operation, graph_n3, ' '.join(triples))
+                         for graph_n3, triples in triples_by_graph.iteritems())
+        for component in components:
+            update += '%s { %s };\n' % (operation, ' '.join('GRAPH %s { %s }' % (graph_n3, ' '.join(triples))
+                                                             for graph_n3, triples in component.iteritems()))
+        return update
+
+    def quad_lines(quads):
+        """Returns the triples of quads grouped by graph, and their (approximate) size"""
+        triples_by_graph = OrderedDict()
+        size = 0
+        for subject, predicate, obj, context in quads:
+            graph_n3 = getattr(context, 'identifier', context).n3()
+            triple = u"%s %s %s ." % (subject.n3(), predicate.n3(), obj.n3())
+            if graph_n3 not in triples_by_graph:
+                triples_by_graph[graph_n3] = []
+                size += len(graph_n3) + len(operation) + 16
+            triples_by_graph[graph_n3].append(triple)
+            size += len(triple.encode('utf-8')) + 1
+
+        return triples_by_graph, size
+
+    triples_by_graph = OrderedDict()
+    components = []
+    count = 0
+    size = 0
+    blank_quads = []
+
+    for quad in quads:
+        if _blank_nodes(quad):
+            if operation == 'DELETE DATA':
+                raise Exception("SPARQLStore does not support Bnodes! "
+                                "See http://www.w3.org/TR/sparql11-query/#BGPsparqlBNodes")
+            blank_quads.append(quad)
+            continue
 
-from semantic_store import utils
+        subject, predicate, obj, context = quad
+        graph_n3 = getattr(context, 'identifier', context).n3()
+        triple = u"%s %s %s ." % (subject.n3(), predicate.n3(), obj.n3())
+        triple_size = len(triple.encode('utf-8')) + 1
 
-import sys
-if getattr(sys, 'pypy_version_info', None) is not None \
-    or sys.platform.startswith('java') \
-        or sys.version_info[:2] < (2, 6):
-    # import elementtree as etree
-    from elementtree import ElementTree
-    assert ElementTree
-else:
-    try:
-        from xml.etree import ElementTree
-        assert ElementTree
-    except ImportError:
-        from elementtree import ElementTree
+        if count > 0 and (count >= max_quads or size + triple_size > max_bytes):
+            yield build_update(triples_by_graph, components), count
+            triples_by_graph = OrderedDict()
+            count = 0
+            size = 0
+
+        if graph_n3 not in triples_by_graph:
+            triples_by_graph[graph_n3] = []
+            size += len(graph_n3) + len(operation) + 16
+
+        triples_by_graph[graph_n3].append(triple)
+        count += 1
+        size += triple_size
+
+    for component in blank_node_components(blank_quads):
+        component_triples, component_size = quad_lines(component)
+
+        if count > 0 and (count + len(component) > max_quads or size + component_size > max_bytes):
+            yield build_update(triples_by_graph, components), count
+            triples_by_graph = OrderedDict()
+            components = []
+            count = 0
+            size = 0
+
+        components.append(component_triples)
+        count += len(component)
+        size += component_size
+
+    if count > 0:
+        yield build_update(triples_by_graph, components), count
+
+_UPDATE_GRAPH_PATTERN = re.compile(r'\b(?:GRAPH|WITH|INTO)\s+(\S+)', re.I)
+
+def updated_graph_identifiers(update):
+    """
+    Returns the identifiers of the named graphs a SPARQL update writes to, or [versions.ALL_GRAPHS] if it
+    can't tell (e.g. if graphs are given as prefixed names, or not named at all).
+    """
+    graphs = _UPDATE_GRAPH_PATTERN.findall(update)
+    if graphs and all(graph.startswith('<') and graph.endswith('>') for graph in graphs):
+        return [URIRef(graph[1:-1]) for graph in graphs]
+    else:
+        return [versions.ALL_GRAPHS]
+
+class VersionedWritesMixin(object):
+    """
+    Bumps the version of each named graph touched by a write to the store (see semantic_store.versions),
+    once the write has succeeded, and logs the changes to project graphs (see semantic_store.change_log).
+    Stores which implement addN or apply_changes themselves call _bump directly.
+    """
+    def _bump(self, contexts, removals=None, additions=None):
+        """
+        Bumps the versions of contexts, dropping cached copies of the graphs (see semantic_store.graph_cache).
+        removals and additions are the quads written, when they are known, for the change log.
+        """
+        identifiers = set(getattr(context, 'identifier', context) for context in contexts)
+        new_versions = versions.bump([versions.ALL_GRAPHS if i is None else i for i in identifiers], sender=self.__class__)
+        graph_cache.apply_changes(new_versions, removals, additions)
+        change_log.record(removals, additions)
+
+    def _keeps_written_quads(self):
+        return graph_cache.enabled() or change_log.enabled()
+
+    def _recording_contexts(self, quads, contexts):
+        for s, p, o, context in quads:
+            contexts.add(getattr(context, 'identifier', context))
+            yield s, p, o, context
+
+    def add(self, triple, context=None, quoted=False):
+        super(VersionedWritesMixin, self).add(triple, context, quoted)
+        self._bump([context], additions=[tuple(triple) + (context,)])
+
+    def addN(self, quads):
+        contexts = set()
+        # The quads are only kept for the graph cache and change log, since they may be a long stream
+        additions = list(quads) if self._keeps_written_quads() else None
+        result = super(VersionedWritesMixin, self).addN(
+            self._recording_contexts(additions if additions is not None else quads, contexts))
+        self._bump(contexts, additions=additions)
+        return result
+
+    def remove(self, triple, context=None):
+        if None in triple and change_log.is_logged(context):
+            # The change log needs the triples a pattern matches
+            removals = [t + (context,) for t, contexts in self.triples(triple, context)]
+        else:
+            removals = [tuple(triple) + (context,)]
 
-from SPARQLWrapper import SPARQLWrapper
+        super(VersionedWritesMixin, self).remove(triple, context)
+        self._bump([context], removals=removals)
 
-class FourStore(SPARQLUpdateStore):
+class FourStore(VersionedWritesMixin, SPARQLUpdateStore):
     """
     An RDFLib store based around the rdflib 4.0.0 implementation of a SPARQLUpdateStore
     to deal with issues with named graphs
+
+    Queries and updates are sent over pooled keep-alive connections (see semantic_store.connection_pool),
+    so a single store instance can be shared between threads.
     """
+    query_headers = {
+        'Content-type': 'application/x-www-form-urlencoded',
+        'Accept': 'application/sparql-results+xml, application/rdf+xml;q=0.9',
+    }
+
+    def __init__(self, queryEndpoint=None, update_endpoint=None, pool_size=None, pool_max_idle=None, result_format=None, **kwargs):
+        super(FourStore, self).__init__(queryEndpoint, update_endpoint, **kwargs)
+
+        # Format requested for SELECT results (one of sparql_results.MIMETYPES_BY_FORMAT); XML is always accepted as a fallback
+        self.result_format = result_format or getattr(settings, 'FOUR_STORE_RESULT_FORMAT', 'xml')
+
+        if pool_size is None:
+            pool_size = getattr(settings, 'FOUR_STORE_POOL_SIZE', DEFAULT_POOL_SIZE)
+        if pool_max_idle is None:
+            pool_max_idle = getattr(settings, 'FOUR_STORE_POOL_MAX_IDLE', DEFAULT_POOL_MAX_IDLE)
+
+        self.query_path = urlparse.urlparse(queryEndpoint).path
+        self.query_pool = ConnectionPool.for_url(queryEndpoint, max_size=pool_size, max_idle=pool_max_idle)
+        self.update_pool = ConnectionPool.for_url(update_endpoint, max_size=pool_size, max_idle=pool_max_idle)
+
+    def pool_stats(self):
+        """Returns the usage counters of the query and update connection pools"""
+        return {
+            'query': self.query_pool.stats(),
+            'update': self.update_pool.stats(),
+        }
+
     def inject_sparql_bindings(self, query, initBindings):
         binds = ['BIND (%s AS ?%s)' % (value.n3(), var) for var, value in initBindings.items()]
 
@@ -49,47 +278,58 @@ class FourStore(SPARQLUpdateStore):
         if initBindings:
             query = self.inject_sparql_bindings(query, initBindings)
 
-        self.resetQuery()
-
         if self.context_aware and queryGraph and queryGraph != '__UNION__':
             # we care about context
 
             if not re.search('[\s{]GRAPH[{\s]', query, flags=re.I):
                 # if a GRAPH clause was already specified, move on...
 
-                # insert GRAPH clause after/before first/last { }
+                # insert GRAPH clause after/before first/last { } of the WHERE clause
+                # (skipping the template of a CONSTRUCT query)
                 # not 100% sure how rock-steady this is
-                i1 = query.index("{") + 1
+                where = re.search(r'\bWHERE\s*{', query, flags=re.I)
+                i1 = where.end() if where else query.index("{") + 1
                 i2 = query.rindex("}")
                 query = query[:i1] + ' GRAPH %s { ' % queryGraph.n3() + \
                     query[i1:i2] + ' } ' + query[i2:]
 
-        self.setQuery(query)
+        return Result.parse(self._send_query(query).as_file())
 
-        return Result.parse(SPARQLWrapper.query(self).response)
+    def _query_body(self, query):
+        # The query string is built locally rather than with setQuery, since the store is shared between threads
+        return urllib.urlencode({'query': unicode(self.injectPrefixes(query)).encode('utf-8')})
 
-    def _run_query(self, query):
-        self.setQuery(query)
-        response = SPARQLWrapper.query(self).response
+    def _send_query(self, query):
+        """Posts a query to the SPARQL endpoint over a pooled connection, and returns the fully read PooledResponse"""
+        response = self.query_pool.request('POST', self.query_path, self._query_body(query), self.query_headers)
+        if response.status != 200:
+            raise FourStoreException("Query failed: %d %s\nQuery: %s\nResponse:\n%s" % (response.status, response.reason, query, response.read()))
 
-        try:
-            doc = ElementTree.parse(response)
-        except Exception as e:
-            if settings.DEBUG:
-                readable_response = requests.post(settings.FOUR_STORE_URIS['SPARQL'], data={'query': query})
+        return response
 
-                response_text = utils.line_numbered_string(readable_response.text)
+    def _run_query(self, query):
+        """
+        Runs a SELECT query, and yields (bindings dictionary, variables) tuples as results are read off the connection,
+        rather than parsing (and holding) the whole response first.
+        """
+        headers = dict(self.query_headers, Accept=sparql_results.accept_header(self.result_format))
 
-                raise FourStoreException("Parsing Exception \"%s\"\nQuery: %s\nResponse:\n%s" % (e, query, response_text))
-            else:
-                raise FourStoreException("Parsing Exception \"%s\"\nQuery: %s" % (e, query))
+        with self.query_pool.stream('POST', self.query_path, self._query_body(query), headers) as response:
+            if response.status != 200:
+                raise FourStoreException("Query failed: %d %s\nQuery: %s\nResponse:\n%s" % (response.status, response.reason, query, response.read()))
 
-        try:
-            dom = TraverseSPARQLResultDOM(doc, asDictionary=True)
-        except Exception as e:
-            raise FourStoreException("SPARQL DOM Traversal Exception \"%s\"" % e)
+            try:
+                for result in sparql_results.iter_results(response, response.getheader('content-type')):
+                    yield result
+            except sparql_results.SPARQLResultsParseError as e:
+                if settings.DEBUG:
+                    readable_response = requests.post(settings.FOUR_STORE_URIS['SPARQL'], data={'query': query})
+
+                    response_text = utils.line_numbered_string(readable_response.text)
 
-        return TraverseSPARQLResultDOM(doc, asDictionary=True)
+                    raise FourStoreException("Parsing Exception \"%s\"\nQuery: %s\nResponse:\n%s" % (e, query, response_text))
+                else:
+                    raise FourStoreException("Parsing Exception \"%s\"\nQuery: %s" % (e, query))
 
     def triples(self, (s, p, o), context=None):
         if ( isinstance(s, BNode) or
@@ -128,51 +368,106 @@ class FourStore(SPARQLUpdateStore):
                    rt.get(o, o)), None
 
     def triples_choices(self, (s, p, o), context=None):
-        if ( isinstance(s, BNode) or
-             isinstance(p, BNode) or 
-             isinstance(o, BNode) ): 
-            raise Exception("SPARQLStore does not support Bnodes! See http://www.w3.org/TR/sparql11-query/#BGPsparqlBNodes")
+        """
+        Expands each list of choices into its own bound pattern, and fetches them all with triples_multi,
+        so that every choice is answered with an index lookup rather than by filtering a scan of the graph.
+        """
+        choices = [term if isinstance(term, list) else [term] for term in (s, p, o)]
+
+        for triple, pattern in self.triples_multi(itertools.product(*choices), context):
+            yield triple, None
+
+    def _union_pattern_query(self, patterns):
+        """
+        Returns the WHERE body and decoder for a UNION of one group per pattern. Each group names its variables
+        after the pattern's index (?s0, ?o12, ...), so that results can be matched back to their pattern.
+        """
+        groups = []
+        for i, (s, p, o) in enumerate(patterns):
+            if s is not None and p is not None and o is not None:
+                # A fully bound pattern would bind no variables, so fetch the objects and check locally
+                o = None
+
+            terms = [term.n3() if term is not None else '?%s%d' % (position, i) for position, term in zip('spo', (s, p, o))]
+            groups.append('{ %s %s %s }' % tuple(terms))
+
+        def decode(index, bindings):
+            pattern = patterns[index]
+            triple = tuple(bindings.get(Variable('%s%d' % (position, index)), term) for position, term in zip('spo', pattern))
+
+            if pattern[2] is None or triple[2] == pattern[2]:
+                return triple, pattern
+
+        return ' UNION '.join(groups), decode
+
+    def _values_pattern_query(self, patterns):
+        """
+        Returns the WHERE body and decoder for a UNION of one VALUES block per shape of pattern
+        (i.e. per combination of bound and unbound positions).
+        """
+        shapes = OrderedDict()
+        for pattern in patterns:
+            shape = tuple(term is not None for term in pattern)
+            shapes.setdefault(shape, []).append(pattern)
+
+        shape_list = shapes.items()
+        lookups = []
+        groups = []
+        for i, (shape, shape_patterns) in enumerate(shape_list):
+            variables = ['?%s%d' % (position, i) for position in 'spo']
+            bound_variables = [v for v, bound in zip(variables, shape) if bound]
+
+            if bound_variables:
+                rows = ' '.join('(%s)' % ' '.join(term.n3() for term in pattern if term is not None) for pattern in shape_patterns)
+                groups.append('{ VALUES (%s) { %s } %s }' % (' '.join(bound_variables), rows, ' '.join(variables)))
+            else:
+                groups.append('{ %s }' % ' '.join(variables))
 
-        vars = []
-        filter_bodies = []
-        if not s:
-            s = Variable('s')
-            vars.append(s)
-        elif isinstance(s, list):
-            filter_bodies.append(' || '.join('?s = %s' % s_choice.n3() for s_choice in s))
-            s = Variable('s')
-            vars.append(s)
+            lookups.append(dict((tuple(term for term in pattern if term is not None), pattern) for pattern in shape_patterns))
 
-        if not p:
-            p = Variable('p')
-            vars.append(p)
-        elif isinstance(p, list):
-            filter_bodies.append(' || '.join('?p = %s' % p_choice.n3() for p_choice in p))
-            p = Variable('p')
-            vars.append(p)
+        def decode(index, bindings):
+            triple = tuple(bindings.get(Variable('%s%d' % (position, index))) for position in 'spo')
+            shape = shape_list[index][0]
+            key = tuple(term for term, bound in zip(triple, shape) if bound)
 
-        if not o:
-            o = Variable('o')
-            vars.append(o)
-        elif isinstance(o, list):
-            filter_bodies.append(' || '.join('?o = %s' % o_choice.n3() for o_choice in o))
-            o = Variable('o')
-            vars.append(o)
+            return triple, lookups[index][key]
 
-        if vars:
-            v = ' '.join([term.n3() for term in vars])
-        else:
-            v = '*'
+        return ' UNION '.join(groups), decode
 
-        query = "SELECT ?s ?p ?o WHERE { GRAPH %s { %s %s %s . %s} }" % \
-            (context.identifier.n3() if context else Variable('context').n3(),
-             s.n3(), p.n3(), o.n3(),
-             ''.join('FILTER(%s) .' % f for f in filter_bodies))
+    def triples_multi(self, patterns, context=None):
+        """
+        Answers many (s, p, o) patterns (with None as a wildcard) in as few round trips as possible;
+        up to FOUR_STORE_MULTI_PATTERN_LIMIT patterns are sent in each query.
+        Yields (triple, pattern) tuples, where pattern is the input pattern the triple matched.
+        """
+        patterns = list(OrderedDict.fromkeys(tuple(pattern) for pattern in patterns))
 
-        for rt, vars in self._run_query(query):
-            yield (rt.get(s, s),
-                   rt.get(p, p),
-                   rt.get(o, o)), None
+        for pattern in patterns:
+            if any(isinstance(term, BNode) for term in pattern):
+                raise Exception("SPARQLStore does not support Bnodes! See http://www.w3.org/TR/sparql11-query/#BGPsparqlBNodes")
+
+        limit = getattr(settings, 'FOUR_STORE_MULTI_PATTERN_LIMIT', DEFAULT_MULTI_PATTERN_LIMIT)
+        syntax = getattr(settings, 'FOUR_STORE_MULTI_PATTERN_SYNTAX', DEFAULT_MULTI_PATTERN_SYNTAX)
+
+        for offset in xrange(0, len(patterns), limit):
+            chunk = patterns[offset:offset + limit]
+
+            if syntax == 'values':
+                where, decode = self._values_pattern_query(chunk)
+            else:
+                where, decode = self._union_pattern_query(chunk)
+
+            graph = context.identifier if context is not None else Variable('context')
+            query = "SELECT * WHERE { GRAPH %s { %s } }" % (graph.n3(), where)
+
+            for rt, vars in self._run_query(query):
+                for var in rt:
+                    match = _MULTI_PATTERN_VARIABLE.match(var)
+                    if match:
+                        result = decode(int(match.group(2)), rt)
+                        if result is not None:
+                            yield result
+                        break
 
     def __len__(self, context=None):
         if not self.sparql11:
@@ -203,20 +498,10 @@ class FourStore(SPARQLUpdateStore):
 
         return (rt.get(Variable("name")) for rt, vars in self._run_query(query))
 
-    def reset_connection(self):
-        self.connection = httplib.HTTPConnection(self.host, self.port)
-
     def _do_update(self, update):
         update = urllib.urlencode({'update': unicode(update).encode('utf-8')})
 
-        # Trying to deal with inexplicable CannotSendRequest errors
-        try:
-            self.connection.request('POST', self.path, update, self.headers)
-            return self.connection.getresponse()
-        except httplib.ImproperConnectionState as e:
-            self.reset_connection()
-            self.connection.request('POST', self.path, update, self.headers)
-            return self.connection.getresponse()
+        return self.update_pool.request('POST', self.path, update, self.headers)
 
     def update(self, query,
                initNs={},
@@ -232,41 +517,281 @@ class FourStore(SPARQLUpdateStore):
             query = self.inject_sparql_bindings(query, initBindings)
             print query
 
-        r = self._do_update(query)
+        self._send_update(query)
+        self._bump(updated_graph_identifiers(query))
+
+    def _send_update(self, update):
+        r = self._do_update(update)
         content = r.read()
         if r.status not in (200, 204):
             raise Exception("Could not update: %d %s\n%s" % (r.status, r.reason, content))
 
-    def addN(self, quads):
-        """ Add a list of quads to the store. """
-        if not self.connection:
-            raise Exception("UpdateEndpoint is not set - call 'open'")
+    def add(self, triple, context=None, quoted=False):
+        """
+        Adds a triple to a named graph with the same INSERT DATA as addN, so the two accept the same triples (a
+        triple with blank nodes included). Triples without a named graph go through SPARQLUpdateStore.add.
+        """
+        if context is None or quoted:
+            super(FourStore, self).add(triple, context, quoted)
+        else:
+            self.addN([tuple(triple) + (context,)])
+
+    def remove(self, triple, context=None):
+        """
+        Removes a triple, or the triples matching a pattern. A blank node can't be matched by its id (DELETE
+        templates can't hold blank nodes, and 4store doesn't keep the ids it returns), so a blank node in the
+        triple stands for any blank node in its place: removing (s, p, _:b) removes every triple of s and p whose
+        object is a blank node.
+        """
+        if not any(isinstance(term, BNode) for term in triple) or context is None:
+            return super(FourStore, self).remove(triple, context)
+
+        terms = []
+        filters = []
+        for name, term in zip('spo', triple):
+            if term is None or isinstance(term, BNode):
+                terms.append(Variable(name))
+                if term is not None:
+                    filters.append('FILTER(isBlank(?%s))' % name)
+            else:
+                terms.append(term)
 
-        data = list()
-        for subject, predicate, obj, context in quads:
-            if ( isinstance(subject, BNode) or
-                 isinstance(predicate, BNode) or
-                 isinstance(obj, BNode) ):
-                raise Exception("SPARQLStore does not support Bnodes! "
-                                "See http://www.w3.org/TR/sparql11-query/#BGPsparqlBNodes")
+        graph_n3 = getattr(context, 'identifier', context).n3()
+        pattern = '%s %s %s .' % tuple(term.n3() for term in terms)
+        self._send_update('DELETE { GRAPH %s { %s } } WHERE { GRAPH %s { %s %s } }' % (
+            graph_n3, pattern, graph_n3, pattern, ' '.join(filters)))
+        self._bump([context], removals=[tuple(triple) + (context,)])
 
-            triple = "%s %s %s ." % (subject.n3(), predicate.n3(), obj.n3())
-            data.append("INSERT DATA { GRAPH <%s> { %s } };\n" % (context.identifier, triple))
-        r = self._do_update(''.join(data))
-        if r.status not in (200, 204):
-            raise Exception("Could not update: %d %s\n%s" % (
-                r.status, r.reason, r.read()))
+    def addN(self, quads):
+        """
+        Add an iterable of quads to the store.
+        Quads are grouped into one INSERT DATA block per named graph, and sent in size bounded batches
+        (see `data_update_batches`). Quads which share blank nodes are always sent in the same INSERT DATA
+        operation, but a blank node is only the same node within one call. Returns a list of the number of
+        quads carried by each request.
+        """
+        sent = []
+        contexts = set()
+        additions = list(quads) if self._keeps_written_quads() else None
+        written = False
+        try:
+            for update, count in data_update_batches(self._recording_contexts(additions if additions is not None else quads, contexts)):
+                self._send_update(update)
+
+                logger.debug('FourStore.addN inserted %d quads in one request', count)
+                sent.append(count)
+
+            written = True
+        finally:
+            # Earlier batches may have been written even if a later one failed, in which case which quads
+            # were written isn't known
+            self._bump(contexts, additions=additions if written else None)
+
+        return sent
+
+    def apply_changes(self, removals, additions):
+        """
+        Removes and then adds lists of quads, packing the DELETE DATA and INSERT DATA blocks into as few
+        update requests as the batch limits allow (usually just one). Added quads which share blank nodes are
+        kept in one INSERT DATA operation (see `data_update_batches`); removed quads can't hold blank nodes.
+        """
+        max_quads = getattr(settings, 'FOUR_STORE_UPDATE_BATCH_QUADS', DEFAULT_UPDATE_BATCH_QUADS)
+        max_bytes = getattr(settings, 'FOUR_STORE_UPDATE_BATCH_BYTES', DEFAULT_UPDATE_BATCH_BYTES)
+
+        batches = itertools.chain(data_update_batches(removals, 'DELETE DATA', max_quads, max_bytes),
+                                  data_update_batches(additions, 'INSERT DATA', max_quads, max_bytes))
+
+        pending = []
+        count = 0
+        size = 0
+        written = False
+        try:
+            for update, update_count in batches:
+                if pending and (count + update_count > max_quads or size + len(update) > max_bytes):
+                    self._send_update(''.join(pending))
+                    pending = []
+                    count = 0
+                    size = 0
+
+                pending.append(update)
+                count += update_count
+                size += len(update)
+
+            if pending:
+                self._send_update(''.join(pending))
+
+            written = True
+        finally:
+            contexts = [context for s, p, o, context in itertools.chain(removals, additions)]
+            if written:
+                self._bump(contexts, removals, additions)
+            else:
+                self._bump(contexts)
+
+        logger.debug('FourStore.apply_changes removed %d and added %d quads', len(removals), len(additions))
+
+    def rewrite_namespace(self, old, new, context=None):
+        """
+        Rewrites every IRI starting with old (in any position of a triple) to start with new instead, in a single
+        update which only matches the triples holding such IRIs. The graph name itself is left alone.
+        """
+        graph = context.identifier.n3() if context is not None else '?g'
+        old_n3, new_n3 = Literal(old).n3(), Literal(new).n3()
+
+        matches = []
+        binds = []
+        for var in ('s', 'p', 'o'):
+            match = 'isIRI(?%s) && STRSTARTS(STR(?%s), %s)' % (var, var, old_n3)
+            matches.append('(%s)' % match)
+            binds.append('BIND(IF(%s, IRI(CONCAT(%s, SUBSTR(STR(?%s), %d))), ?%s) AS ?new_%s)' %
+                         (match, new_n3, var, len(old) + 1, var, var))
+
+        self.update('DELETE { GRAPH %(graph)s { ?s ?p ?o } }\n'
+                    'INSERT { GRAPH %(graph)s { ?new_s ?new_p ?new_o } }\n'
+                    'WHERE { GRAPH %(graph)s { ?s ?p ?o } FILTER(%(matches)s) %(binds)s }' % {
+                        'graph': graph,
+                        'matches': ' || '.join(matches),
+                        'binds': ' '.join(binds),
+                    })
 
 class FourStoreException(Exception):
     pass
 
+class SQLAlchemyStore(VersionedWritesMixin, SQLAlchemy):
+    """
+    The rdflib_sqlalchemy store, with an apply_changes method which writes a set of removals and additions
+    in a single transaction (rather than one transaction per removed triple).
+    """
+    def _removal_statements(self, (subject, predicate, obj), context):
+        """Yields the delete statements which remove a single triple, as in SQLAlchemy.remove"""
+        quoted_table = self.tables['quoted_statements']
+        asserted_table = self.tables['asserted_statements']
+        asserted_type_table = self.tables['type_statements']
+        literal_table = self.tables['literal_statements']
+
+        if predicate != RDF.type:
+            if isinstance(obj, Literal):
+                yield literal_table.delete(self.buildClause(literal_table, subject, predicate, obj, context))
+            else:
+                yield asserted_table.delete(self.buildClause(asserted_table, subject, predicate, obj, context))
+            yield quoted_table.delete(self.buildClause(quoted_table, subject, predicate, obj, context))
+        else:
+            yield asserted_type_table.delete(self.buildClause(asserted_type_table, subject, RDF.type, obj, context, True))
+            yield quoted_table.delete(self.buildClause(quoted_table, subject, predicate, obj, context))
+
+    def _insert_command(self, (subject, predicate, obj), context):
+        if predicate == RDF.type:
+            return 'type', self.buildTypeSQLCommand(subject, obj, context)
+        elif isinstance(obj, Literal):
+            return 'literal', self.buildLiteralTripleSQLCommand(subject, predicate, obj, context)
+        else:
+            return 'other', self.buildTripleSQLCommand(subject, predicate, obj, context, False)
+
+    def apply_changes(self, removals, additions):
+        commands = OrderedDict()
+        for subject, predicate, obj, context in additions:
+            command_type, (command, params) = self._insert_command((subject, predicate, obj), context)
+            commands.setdefault(command_type, (command, []))[1].append(params)
+
+        with self.engine.connect() as connection:
+            trans = connection.begin()
+            try:
+                for subject, predicate, obj, context in removals:
+                    for statement in self._removal_statements((subject, predicate, obj), context):
+                        connection.execute(statement)
+
+                for command, params in commands.values():
+                    connection.execute(command, params)
+
+                trans.commit()
+            except Exception:
+                trans.rollback()
+                raise
+
+        self._bump((context for s, p, o, context in itertools.chain(removals, additions)), removals, additions)
+
+        logger.debug('SQLAlchemyStore.apply_changes removed %d and added %d quads', len(removals), len(additions))
+
+    def stream_triples(self, context):
+        """
+        Yields the triples of a named graph as their rows are read, where triples((None, None, None), context)
+        fetches every row, and groups the rows by triple, before yielding anything. The rows are read off a
+        server side cursor where the database driver has one (psycopg2; sqlite reads them as they are stepped
+        through anyway), so memory use doesn't grow with the graph. A triple held in more than one of the
+        statement tables is yielded once for each.
+        """
+        selects = []
+        for name, alias, partition in (('literal_statements', 'literal', ASSERTED_LITERAL_PARTITION),
+                                       ('asserted_statements', 'asserted', ASSERTED_NON_TYPE_PARTITION),
+                                       ('type_statements', 'typetable', ASSERTED_TYPE_PARTITION),
+                                       ('quoted_statements', 'quoted', QUOTED_PARTITION)):
+            table = expression.alias(self.tables[name], alias)
+            if partition == ASSERTED_TYPE_PARTITION:
+                clause = self.buildClause(table, None, RDF.type, None, context, True)
+            else:
+                clause = self.buildClause(table, None, None, None, context)
+            selects.append((table, clause, partition))
+
+        query = unionSELECT(selects, selectType=TRIPLE_SELECT_NO_ORDER)
+        with self.engine.connect() as connection:
+            for row in connection.execution_options(stream_results=True).execute(query):
+                s, p, o, graph = extractTriple(row, self, context)
+                yield s, p, o
+
+    # The columns of each statement table which hold IRIs (a literal statement's object is the literal's value)
+    _TERM_COLUMNS = (
+        ('asserted_statements', ('subject', 'predicate', 'object')),
+        ('type_statements', ('member', 'klass')),
+        ('literal_statements', ('subject', 'predicate')),
+    )
+
+    def rewrite_namespace(self, old, new, context=None):
+        """
+        Rewrites every IRI starting with old (in any position of a triple) to start with new instead, with an
+        UPDATE of each term column in a single transaction, so only the rows holding such IRIs are touched.
+        The graph name itself is left alone. Returns the number of terms rewritten.
+        """
+        rewritten = 0
+
+        # The LIKE pattern (with old's wildcards escaped) lets the database use an index on the column, and the
+        # comparison of the prefix makes the match exact, since LIKE ignores case on some databases (e.g. sqlite)
+        pattern = old.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+        with self.engine.connect() as connection:
+            trans = connection.begin()
+            try:
+                for table_name, columns in self._TERM_COLUMNS:
+                    table = self.tables[table_name]
+                    for column_name in columns:
+                        column = table.c[column_name]
+                        condition = and_(column.like(pattern, escape='\\'), func.substr(column, 1, len(old)) == old)
+                        if context is not None:
+                            condition = and_(condition, table.c.context == unicode(context.identifier))
+
+                        statement = table.update().where(condition).values(
+                            {column: sql_literal(new, types.Text) + func.substr(column, len(old) + 1)})
+                        rewritten += connection.execute(statement).rowcount
+
+                trans.commit()
+            except Exception:
+                trans.rollback()
+                raise
+
+        self._bump([context])
+
+        logger.debug('SQLAlchemyStore.rewrite_namespace rewrote %d terms', rewritten)
+
+        return rewritten
+
+instrumentation.instrument_store(FourStore)
+instrumentation.instrument_store(SQLAlchemyStore)
 
 plugin.register('SQLAlchemy', Store, 'rdflib_sqlalchemy.SQLAlchemy', 'SQLAlchemy')
 
 default_identifier = URIRef(settings.RDFLIB_STORE_GRAPH_URI)
 
 if not (hasattr(settings, 'FOUR_STORE_URIS') and 'SPARQL' in settings.FOUR_STORE_URIS and 'UPDATE' in settings.FOUR_STORE_URIS):
-    store = plugin.get('SQLAlchemy', Store)(identifier=default_identifier)
+    store = SQLAlchemyStore(identifier=default_identifier)
     store.open(Literal(settings.RDFLIB_DB_URI))
 else:
     store = FourStore(settings.FOUR_STORE_URIS['SPARQL'], settings.FOUR_STORE_URIS['UPDATE'])
@@ -275,11 +800,11 @@ else:
     sqlalchemy_store.open(URIRef(settings.RDFLIB_DB_URI))
 
 def rdfstore():
-    return store
-
-def copy_to_store(old_store, new_store):
-    for context in old_store.contexts():
-        old_graph = Graph(old_store, context)
-        new_graph = Graph(new_store, context)
-        for t in old_graph:
-            new_graph.add(t)
+    """Returns the store, or the buffered store of the unit of work active on this thread (see unit_of_work)"""
+    buffered = active_store()
+    return buffered if buffered is not None else store
+
+def copy_to_store(old_store, new_store, **kwargs):
+    """Copies every graph in old_store to new_store (see migration.copy_store for the options)"""
+    from semantic_store.migration import copy_store
+    return copy_store(old_store, new_store, **kwargs)
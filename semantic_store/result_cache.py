@@ -0,0 +1,184 @@
+"""
+A cache of graphs built from the store, keyed on the versions of the named graphs they were built from.
+
+    graph = result_cache.cached_graph('canvas', [project_identifier], (project_uri, canvas_uri),
+                                      lambda: canvas_subgraph(project_graph, canvas_uri, project_uri))
+
+Since every write to a named graph bumps its version (see semantic_store.versions), an entry can never be
+returned after one of its graphs has changed, and there is nothing to invalidate explicitly.
+
+Entries are held in a per-process LRU, bounded by number of entries and total number of triples, in front of the
+django cache named by SEMANTIC_STORE_CACHE, which lets processes share results. Caching is only enabled when
+SEMANTIC_STORE_RESULT_CACHE is True, since it is only correct across processes if that cache is shared.
+"""
+from django.conf import settings
+from django.core.cache import get_cache
+from rdflib import Graph
+
+from semantic_store import versions
+from semantic_store.unit_of_work import active_store
+
+from collections import OrderedDict
+from functools import wraps
+import hashlib
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Bounds on the per process cache, and on the size of a single cached result
+# (these can be overridden with SEMANTIC_STORE_RESULT_CACHE_ENTRIES, SEMANTIC_STORE_RESULT_CACHE_TRIPLES
+# and SEMANTIC_STORE_RESULT_CACHE_MAX_RESULT_TRIPLES)
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_MAX_TRIPLES = 1000000
+DEFAULT_MAX_RESULT_TRIPLES = 100000
+
+RESULT_TIMEOUT = 60 * 60 * 24
+
+class LRUCache(object):
+    """
+    A thread safe least recently used cache, bounded by a number of entries and by the total of the sizes
+    given for them.
+    """
+    def __init__(self, max_entries, max_size=None):
+        self.max_entries = max_entries
+        self.max_size = max_size
+
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self._entries[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size=1):
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[1]
+
+            if self.max_size is not None and size > self.max_size:
+                return
+
+            self._entries[key] = (value, size)
+            self._size += size
+
+            while len(self._entries) > self.max_entries or (self.max_size is not None and self._size > self.max_size):
+                evicted_key, (evicted_value, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'size': self._size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+_local_cache = LRUCache(getattr(settings, 'SEMANTIC_STORE_RESULT_CACHE_ENTRIES', DEFAULT_MAX_ENTRIES),
+                        getattr(settings, 'SEMANTIC_STORE_RESULT_CACHE_TRIPLES', DEFAULT_MAX_TRIPLES))
+_shared_cache = None
+
+def enabled():
+    return getattr(settings, 'SEMANTIC_STORE_RESULT_CACHE', False)
+
+def shared_cache():
+    global _shared_cache
+    if _shared_cache is None:
+        _shared_cache = get_cache(getattr(settings, 'SEMANTIC_STORE_CACHE', 'default'))
+
+    return _shared_cache
+
+def stats():
+    return _local_cache.stats()
+
+def _entry_graph(entry):
+    namespaces, triples = entry
+
+    graph = Graph()
+    for prefix, namespace in namespaces:
+        graph.bind(prefix, namespace)
+    graph.addN((s, p, o, graph) for s, p, o in triples)
+
+    return graph
+
+def _has_pending_changes(identifiers):
+    buffered = active_store()
+    return buffered is not None and any(buffered.is_dirty(identifier) for identifier in identifiers)
+
+def cached_graph(name, identifiers, args, builder):
+    """
+    Returns the graph built by builder() from the named graphs with the given identifiers, from the cache if
+    it has already been built from the current versions of those graphs with the same name and arguments.
+    The graph returned is always a new in-memory graph, so callers are free to modify it.
+    """
+    if not enabled() or _has_pending_changes(identifiers):
+        return builder()
+
+    graph_versions = versions.graph_versions(identifiers)
+    key_parts = (name, tuple(unicode(arg) for arg in args), sorted((unicode(i), v) for i, v in graph_versions.iteritems()))
+    key = 'semantic_store:result:%s' % hashlib.md5(repr(key_parts)).hexdigest()
+
+    entry = _local_cache.get(key)
+    if entry is None:
+        entry = shared_cache().get(key)
+        if entry is not None:
+            _local_cache.set(key, entry, len(entry[1]))
+
+    if entry is not None:
+        logger.debug('Result cache hit for %s%r', name, tuple(args))
+        return _entry_graph(entry)
+
+    graph = builder()
+
+    triples = tuple(graph)
+    if len(triples) <= getattr(settings, 'SEMANTIC_STORE_RESULT_CACHE_MAX_RESULT_TRIPLES', DEFAULT_MAX_RESULT_TRIPLES):
+        entry = (tuple(graph.namespaces()), triples)
+        _local_cache.set(key, entry, len(triples))
+        shared_cache().set(key, entry, RESULT_TIMEOUT)
+
+    return graph
+
+def cached_graph_builder(name, depends_on):
+    """
+    Decorates a function which builds a graph from the store, caching its results with cached_graph.
+    depends_on is called with the same arguments, and returns the identifiers of the named graphs the result
+    is built from.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args):
+            return cached_graph(name, depends_on(*args), args, lambda: f(*args))
+        return wrapper
+    return decorator
@@ -0,0 +1,98 @@
+"""
+A cache of serialized graph responses, keyed on the versions of what the graphs were built from and on the format
+and content encoding negotiated for the request, so a hit skips building and serializing the graph altogether:
+
+    serialization = serialization_cache.cached_serialization(request, 'project_snapshot', identifiers,
+                                                             (project_uri,), lambda: project_snapshot(project_uri))
+    return NegotiatedGraphResponse(request, None, serialization)
+
+As in result_cache, the identifiers are named graphs (or model data, see versions.model_identifier) whose versions
+are bumped by every write to them, so an entry is never returned after what it was built from has changed.
+
+Entries (see utils.GraphSerialization) are held in a per-process LRU, bounded by number of entries and total
+bytes, in front of the django cache named by SEMANTIC_STORE_SERIALIZATION_CACHE_BACKEND (or SEMANTIC_STORE_CACHE),
+which lets processes share them. Caching is only enabled when SEMANTIC_STORE_SERIALIZATION_CACHE is True.
+"""
+from django.conf import settings
+from django.core.cache import get_cache
+
+from semantic_store import versions
+from semantic_store.result_cache import LRUCache
+from semantic_store.unit_of_work import active_store
+from semantic_store.utils import negotiated_format, negotiated_serialization, accepts_gzip
+
+import hashlib
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Bounds on the per process cache, and on the size of a single cached serialization
+# (these can be overridden with SEMANTIC_STORE_SERIALIZATION_CACHE_ENTRIES, SEMANTIC_STORE_SERIALIZATION_CACHE_BYTES
+# and SEMANTIC_STORE_SERIALIZATION_CACHE_MAX_RESULT_BYTES)
+DEFAULT_MAX_ENTRIES = 200
+DEFAULT_MAX_BYTES = 100 * 1024 * 1024
+DEFAULT_MAX_RESULT_BYTES = 10 * 1024 * 1024
+
+SERIALIZATION_TIMEOUT = 60 * 60 * 24
+
+_local_cache = LRUCache(getattr(settings, 'SEMANTIC_STORE_SERIALIZATION_CACHE_ENTRIES', DEFAULT_MAX_ENTRIES),
+                        getattr(settings, 'SEMANTIC_STORE_SERIALIZATION_CACHE_BYTES', DEFAULT_MAX_BYTES))
+_shared_cache = None
+
+def enabled():
+    return getattr(settings, 'SEMANTIC_STORE_SERIALIZATION_CACHE', False)
+
+def shared_cache():
+    global _shared_cache
+    if _shared_cache is None:
+        _shared_cache = get_cache(getattr(settings, 'SEMANTIC_STORE_SERIALIZATION_CACHE_BACKEND',
+                                          getattr(settings, 'SEMANTIC_STORE_CACHE', 'default')))
+
+    return _shared_cache
+
+def stats():
+    return _local_cache.stats()
+
+def clear():
+    _local_cache.clear()
+
+def _has_pending_changes(identifiers):
+    buffered = active_store()
+    return buffered is not None and any(buffered.is_dirty(identifier) for identifier in identifiers)
+
+def serialization_key(request, name, identifiers, args):
+    format, mimetype = negotiated_format(request)
+    key_parts = (name, tuple(unicode(arg) for arg in args), versions.version_token(identifiers), format,
+                 'gzip' if accepts_gzip(request) else '')
+
+    return 'semantic_store:serialization:%s' % hashlib.md5(repr(key_parts)).hexdigest()
+
+def cached_serialization(request, name, identifiers, args, builder):
+    """
+    Returns the GraphSerialization of the graph built by builder() from the given identifiers, negotiated for
+    the request, from the cache if the same name and arguments have already been serialized in the same format
+    and encoding from the current versions of the identifiers.
+    """
+    identifiers = list(identifiers)
+    if not enabled() or _has_pending_changes(identifiers):
+        return negotiated_serialization(request, builder())
+
+    key = serialization_key(request, name, identifiers, args)
+
+    serialization = _local_cache.get(key)
+    if serialization is None:
+        serialization = shared_cache().get(key)
+        if serialization is not None:
+            _local_cache.set(key, serialization, len(serialization.content))
+
+    if serialization is not None:
+        logger.debug('Serialization cache hit for %s%r', name, tuple(args))
+        return serialization
+
+    serialization = negotiated_serialization(request, builder())
+
+    if len(serialization.content) <= getattr(settings, 'SEMANTIC_STORE_SERIALIZATION_CACHE_MAX_RESULT_BYTES', DEFAULT_MAX_RESULT_BYTES):
+        _local_cache.set(key, serialization, len(serialization.content))
+        shared_cache().set(key, serialization, SERIALIZATION_TIMEOUT)
+
+    return serialization
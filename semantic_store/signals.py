@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+# Sent by the store after every write, with the identifiers of the named graphs it changed
+# (versions.ALL_GRAPHS if the write wasn't limited to a named graph), and a dictionary of their new versions
+graph_changed = Signal(providing_args=['identifiers', 'versions'])
@@ -0,0 +1,366 @@
+"""
+A local stand-in for a 4store SPARQL endpoint, for integration tests and benchmarks.
+
+LocalSPARQLEndpoint serves the SPARQL 1.1 protocol over HTTP from an in-memory rdflib Dataset, at the same paths
+as 4store (/sparql/ for queries and /update/ for updates), so FourStore and its connection pool can be exercised
+without a real triplestore:
+
+    with LocalSPARQLEndpoint(latency=0.005, jitter=0.002) as endpoint:
+        store = FourStore(endpoint.query_url, endpoint.update_url)
+        ...
+
+Each request can be delayed by a fixed latency plus random jitter (applied outside the dataset lock, so concurrent
+requests overlap as they would over a network), and failures can be injected, either at random with error_rate
+and drop_rate, or deterministically with fail_next and drop_next. A dropped request has its connection closed
+without a response, as happens when a kept-alive connection is closed by the server.
+
+The endpoint can also be run from the command line with the sparql_endpoint management command.
+"""
+from rdflib import Dataset, URIRef, Graph, BNode
+from rdflib.plugins.sparql.parser import parseUpdate
+from rdflib.plugins.sparql.algebra import translateUpdate
+
+from semantic_store import sparql_results, backup
+
+from collections import deque
+import BaseHTTPServer
+import SocketServer
+import random
+import socket
+import sys
+import threading
+import time
+import traceback
+import urlparse
+
+import logging
+logger = logging.getLogger(__name__)
+
+QUERY_PATH = '/sparql/'
+UPDATE_PATH = '/update/'
+
+# rdflib's SPARQL parser recurses deeply on large updates, so requests are handled on threads with a large stack
+# (and the sparql_endpoint command, which has the process to itself, raises the recursion limit to this)
+HANDLER_STACK_SIZE = 256 * 1024 * 1024
+MIN_RECURSION_LIMIT = 100000
+
+GRAPH_MIMETYPES = (
+    ('application/rdf+xml', 'xml'),
+    ('text/turtle', 'turtle'),
+    ('text/plain', 'nt'),
+    ('application/n-triples', 'nt'),
+)
+
+_stack_size_lock = threading.Lock()
+
+def _fresh_blank_nodes(operation):
+    """
+    Gives the blank nodes of a parsed INSERT DATA operation new ids, as 4store does: each label stands for a new
+    blank node in each operation. (rdflib keeps the label, "_:" and all, as the node's id, so the same label would
+    be the same node in every update, and would come back in results as "_:_:label".)
+    """
+    fresh = {}
+    def term(t):
+        return fresh.setdefault(t, BNode()) if isinstance(t, BNode) else t
+
+    operation['triples'] = [tuple(term(t) for t in triple) for triple in operation.triples]
+    operation['quads'] = dict((graph, [tuple(term(t) for t in triple) for triple in triples])
+                              for graph, triples in operation.quads.iteritems())
+
+def _preferred(accept, available):
+    """Returns the first of the (mimetype, format) pairs in available which is accepted, by order of quality"""
+    accepted = []
+    for i, part in enumerate((accept or '').split(',')):
+        fields = [field.strip() for field in part.split(';')]
+        quality = 1.0
+        for field in fields[1:]:
+            if field.startswith('q='):
+                try:
+                    quality = float(field[2:])
+                except ValueError:
+                    pass
+        accepted.append((-quality, i, fields[0]))
+
+    for quality, i, mimetype in sorted(accepted):
+        for available_mimetype, format in available:
+            if mimetype in (available_mimetype, '*/*'):
+                return available_mimetype, format
+
+    return available[0]
+
+class EndpointStats(object):
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.updates = 0
+        self.errors = 0
+        self.drops = 0
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug('%s %s', self.address_string(), format % args)
+
+    def do_GET(self):
+        self._handle(urlparse.parse_qs(urlparse.urlparse(self.path).query))
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        body = self.rfile.read(length)
+        content_type = (self.headers.getheader('content-type') or '').split(';')[0].strip()
+
+        if content_type == 'application/sparql-query':
+            params = {'query': [body]}
+        elif content_type == 'application/sparql-update':
+            params = {'update': [body]}
+        else:
+            params = urlparse.parse_qs(body)
+
+        self._handle(params)
+
+    def _handle(self, params):
+        endpoint = self.server.endpoint
+        path = urlparse.urlparse(self.path).path
+
+        failure = endpoint._next_failure()
+        endpoint._delay()
+
+        if failure == 'drop':
+            self.close_connection = 1
+            return
+        elif failure is not None:
+            self._respond(failure, 'Injected failure', 'text/plain')
+            return
+
+        try:
+            if 'update' in params and path == endpoint.update_path:
+                endpoint._update(params['update'][0].decode('utf-8'))
+                self._respond(200, '', 'text/plain')
+            elif 'query' in params and path == endpoint.query_path:
+                body, content_type = endpoint._query(params['query'][0].decode('utf-8'), self.headers.getheader('accept'))
+                self._respond(200, body, content_type)
+            else:
+                self._respond(400, 'Expected a query to %s or an update to %s' % (endpoint.query_path, endpoint.update_path),
+                              'text/plain')
+        except Exception:
+            with endpoint._lock:
+                endpoint.stats.errors += 1
+            self._respond(500, traceback.format_exc(), 'text/plain')
+
+    def _respond(self, status, body, content_type):
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, *args, **kwargs):
+        BaseHTTPServer.HTTPServer.__init__(self, *args, **kwargs)
+        self.open_requests = set()
+
+    def process_request(self, request, client_address):
+        self.open_requests.add(request)
+
+        # threading.stack_size applies to every thread started afterwards, so it is only changed while
+        # the handler thread is created
+        with _stack_size_lock:
+            previous = threading.stack_size(HANDLER_STACK_SIZE)
+            try:
+                SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+            finally:
+                threading.stack_size(previous)
+
+    def shutdown_request(self, request):
+        self.open_requests.discard(request)
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+    def close_open_requests(self):
+        """Closes kept-alive connections, so that their handler threads finish"""
+        for request in list(self.open_requests):
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+class LocalSPARQLEndpoint(object):
+    """
+    An HTTP SPARQL endpoint backed by an rdflib Dataset, served from a background thread.
+
+    latency and jitter are in seconds; each request is delayed by latency plus a random amount of up to jitter
+    either way. error_rate and drop_rate are the probabilities that a request fails with error_status, or has its
+    connection dropped.
+
+    rdflib's SPARQL parser recurses deeply on large updates. Requests are handled on threads with a large stack,
+    but the recursion limit is process wide, so it is only raised (to recursion_limit) when one is given.
+    """
+    def __init__(self, dataset=None, host='127.0.0.1', port=0, latency=0, jitter=0, error_rate=0, drop_rate=0,
+                 error_status=500, query_path=QUERY_PATH, update_path=UPDATE_PATH, recursion_limit=None):
+        if dataset is None:
+            # Like 4store, queries without a GRAPH clause are answered from the union of all the named graphs
+            dataset = Dataset(default_union=True)
+
+        self.dataset = dataset
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.error_status = error_status
+        self.query_path = query_path
+        self.update_path = update_path
+        self.recursion_limit = recursion_limit
+
+        self.stats = EndpointStats()
+
+        self._server = None
+        self._thread = None
+        self._failures = deque()
+        self._lock = threading.Lock()
+        self._random = random.Random()
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % (self.host, self.port)
+
+    @property
+    def query_url(self):
+        return self.url + self.query_path
+
+    @property
+    def update_url(self):
+        return self.url + self.update_path
+
+    def start(self):
+        """Starts serving on a daemon thread; if port was 0, self.port is set to the port chosen"""
+        if self._server is not None:
+            return self
+
+        if self.recursion_limit:
+            sys.setrecursionlimit(max(sys.getrecursionlimit(), self.recursion_limit))
+
+        self._server = _Server((self.host, self.port), _RequestHandler)
+        self._server.endpoint = self
+        self.port = self._server.server_address[1]
+
+        self._thread = threading.Thread(target=self._server.serve_forever, name='LocalSPARQLEndpoint:%d' % self.port)
+        self._thread.daemon = True
+        self._thread.start()
+
+        logger.info('Serving SPARQL endpoint at %s', self.url)
+        return self
+
+    def serve_forever(self):
+        """Serves on the calling thread until interrupted"""
+        self.start()
+        try:
+            while self._thread.is_alive():
+                self._thread.join(1)
+        finally:
+            self.stop()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server.close_open_requests()
+            self._thread.join()
+            self._server = None
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def fail_next(self, count=1, status=None):
+        """Makes the next count requests fail with the given http status (error_status by default)"""
+        with self._lock:
+            self._failures.extend([status or self.error_status] * count)
+
+    def drop_next(self, count=1):
+        """Makes the next count requests have their connection closed without a response"""
+        with self._lock:
+            self._failures.extend(['drop'] * count)
+
+    def load_backup(self, directory):
+        """
+        Loads a directory written by the backup_rdf command (an archive or a file per graph, with or without a
+        manifest), each graph into the named graph it came from
+        """
+        checksums = backup.manifest_checksums(directory)
+        for path, identifiers in backup.backup_files(directory):
+            for identifier, triples in backup.iter_backup_file(path, identifiers, checksums):
+                with self._lock:
+                    graph = self.dataset.graph(URIRef(identifier))
+                    for triple in triples:
+                        graph.add(triple)
+
+    def _next_failure(self):
+        with self._lock:
+            self.stats.requests += 1
+
+            if self._failures:
+                failure = self._failures.popleft()
+            elif self._random.random() < self.drop_rate:
+                failure = 'drop'
+            elif self._random.random() < self.error_rate:
+                failure = self.error_status
+            else:
+                failure = None
+
+            if failure == 'drop':
+                self.stats.drops += 1
+            elif failure is not None:
+                self.stats.errors += 1
+
+            return failure
+
+    def _delay(self):
+        delay = self.latency
+        if self.jitter:
+            delay += self._random.uniform(-self.jitter, self.jitter)
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def _query(self, query, accept):
+        """Returns the serialized results of a query, and their content type"""
+        with self._lock:
+            self.stats.queries += 1
+            result = self.dataset.query(query)
+
+            if result.type == 'CONSTRUCT' or result.type == 'DESCRIBE':
+                mimetype, format = _preferred(accept, GRAPH_MIMETYPES)
+                graph = Graph()
+                graph += result.graph
+                return graph.serialize(format=format), mimetype
+            else:
+                mimetype, format = _preferred(accept, [
+                    (sparql_results.XML_MIMETYPE, 'xml'),
+                    (sparql_results.JSON_MIMETYPE, 'json'),
+                ])
+                return result.serialize(format=format), mimetype
+
+    def _update(self, update):
+        with self._lock:
+            self.stats.updates += 1
+
+            operations = translateUpdate(parseUpdate(update))
+            for operation in operations:
+                if operation.name == 'InsertData':
+                    _fresh_blank_nodes(operation)
+
+            self.dataset.update(operations)
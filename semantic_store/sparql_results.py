@@ -0,0 +1,205 @@
+"""
+Incremental readers for SPARQL SELECT results.
+
+Each reader takes a file-like object (typically an unread httplib response), and yields
+(bindings dictionary, list of variables) tuples as results are read, in the same shape as
+rdflib's TraverseSPARQLResultDOM(doc, asDictionary=True), without holding the whole document in memory.
+"""
+from rdflib import URIRef, Literal, BNode, Variable
+from rdflib.namespace import XSD
+from rdflib.plugins.stores.sparqlstore import CastToTerm
+from django.utils import simplejson
+
+import re
+
+import sys
+if getattr(sys, 'pypy_version_info', None) is not None \
+    or sys.platform.startswith('java') \
+        or sys.version_info[:2] < (2, 6):
+    from elementtree import ElementTree
+    assert ElementTree
+else:
+    try:
+        from xml.etree import cElementTree as ElementTree
+        assert ElementTree
+    except ImportError:
+        from xml.etree import ElementTree
+
+XML_MIMETYPE = 'application/sparql-results+xml'
+JSON_MIMETYPE = 'application/sparql-results+json'
+TSV_MIMETYPE = 'text/tab-separated-values'
+
+MIMETYPES_BY_FORMAT = {
+    'xml': XML_MIMETYPE,
+    'json': JSON_MIMETYPE,
+    'tsv': TSV_MIMETYPE,
+}
+
+SPARQL_RESULTS_NS = 'http://www.w3.org/2005/sparql-results#'
+_VARIABLE_TAG = '{%s}variable' % SPARQL_RESULTS_NS
+_RESULT_TAG = '{%s}result' % SPARQL_RESULTS_NS
+_BINDING_TAG = '{%s}binding' % SPARQL_RESULTS_NS
+_RESULTS_TAG = '{%s}results' % SPARQL_RESULTS_NS
+
+class SPARQLResultsParseError(Exception):
+    pass
+
+def iter_xml_results(stream):
+    """
+    Yields results from a SPARQL XML results document as each <result> element is closed.
+    Processed elements are cleared as soon as they have been converted, so memory use does not grow
+    with the size of the result set.
+    """
+    variables = []
+    results_element = None
+
+    try:
+        for event, element in ElementTree.iterparse(stream, events=('start', 'end')):
+            if event == 'start':
+                if element.tag == _RESULTS_TAG:
+                    results_element = element
+            elif element.tag == _VARIABLE_TAG:
+                variables.append(Variable(element.attrib['name']))
+            elif element.tag == _RESULT_TAG:
+                bindings = {}
+                for binding in element.findall(_BINDING_TAG):
+                    bindings[Variable(binding.attrib['name'])] = CastToTerm(binding[0])
+
+                yield bindings, variables
+
+                element.clear()
+                if results_element is not None:
+                    results_element.clear()
+    except SyntaxError as e:
+        raise SPARQLResultsParseError(e)
+
+def _json_term(value):
+    term_type = value['type']
+
+    if term_type == 'uri':
+        return URIRef(value['value'])
+    elif term_type == 'bnode':
+        return BNode(value['value'])
+    elif term_type in ('literal', 'typed-literal'):
+        if 'datatype' in value:
+            return Literal(value['value'], datatype=URIRef(value['datatype']))
+        else:
+            return Literal(value['value'], lang=value.get('xml:lang'))
+    else:
+        raise SPARQLResultsParseError('Unknown term type "%s"' % term_type)
+
+def iter_json_results(stream):
+    """
+    Yields results from a SPARQL JSON results document.
+    (The standard library has no incremental JSON parser, so the document is decoded in one go, but the
+    bindings are still converted to rdflib terms lazily.)
+    """
+    try:
+        doc = simplejson.load(stream)
+    except ValueError as e:
+        raise SPARQLResultsParseError(e)
+
+    variables = [Variable(v) for v in doc.get('head', {}).get('vars', [])]
+
+    for row in doc.get('results', {}).get('bindings', []):
+        yield dict((Variable(name), _json_term(value)) for name, value in row.iteritems()), variables
+
+_TSV_ESCAPES = {'t': u'\t', 'n': u'\n', 'r': u'\r', 'b': u'\b', 'f': u'\f', '"': u'"', "'": u"'", '\\': u'\\'}
+_TSV_ESCAPE_PATTERN = re.compile(r'\\(u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|.)')
+_TSV_LITERAL_PATTERN = re.compile(r'^"(?P<value>(?:[^"\\]|\\.)*)"(?:@(?P<lang>[A-Za-z0-9\-]+)|\^\^<(?P<datatype>[^>]*)>)?$')
+_INTEGER_PATTERN = re.compile(r'^[+-]?\d+$')
+_DECIMAL_PATTERN = re.compile(r'^[+-]?\d*\.\d+$')
+_DOUBLE_PATTERN = re.compile(r'^[+-]?(\d+\.?\d*|\.\d+)[eE][+-]?\d+$')
+
+def _unescape(s):
+    def replace(match):
+        escape = match.group(1)
+        if escape[0] in 'uU' and len(escape) > 1:
+            return unichr(int(escape[1:], 16))
+        else:
+            return _TSV_ESCAPES.get(escape, escape)
+
+    return _TSV_ESCAPE_PATTERN.sub(replace, s)
+
+def parse_tsv_term(s):
+    """Parses a single RDF term as written in a SPARQL TSV results document"""
+    if not s:
+        return None
+    elif s.startswith('<') and s.endswith('>'):
+        return URIRef(_unescape(s[1:-1]))
+    elif s.startswith('_:'):
+        return BNode(s[2:])
+    elif s.startswith('"'):
+        match = _TSV_LITERAL_PATTERN.match(s)
+        if not match:
+            raise SPARQLResultsParseError('Malformed literal %s' % s)
+
+        value = _unescape(match.group('value'))
+        if match.group('datatype'):
+            return Literal(value, datatype=URIRef(match.group('datatype')))
+        else:
+            return Literal(value, lang=match.group('lang'))
+    elif s in ('true', 'false'):
+        return Literal(s, datatype=XSD.boolean)
+    elif _INTEGER_PATTERN.match(s):
+        return Literal(s, datatype=XSD.integer)
+    elif _DECIMAL_PATTERN.match(s):
+        return Literal(s, datatype=XSD.decimal)
+    elif _DOUBLE_PATTERN.match(s):
+        return Literal(s, datatype=XSD.double)
+    else:
+        raise SPARQLResultsParseError('Unrecognized term %s' % s)
+
+def iter_tsv_results(stream):
+    """Yields results from a SPARQL TSV results document, one line at a time"""
+    header = stream.readline()
+    if not header:
+        return
+
+    variables = [Variable(v.strip().lstrip('?$')) for v in header.decode('utf-8').rstrip('\r\n').split('\t') if v.strip()]
+
+    while True:
+        line = stream.readline()
+        if not line:
+            break
+
+        line = line.decode('utf-8').rstrip('\r\n')
+        if not line:
+            continue
+
+        bindings = {}
+        for var, value in zip(variables, line.split('\t')):
+            term = parse_tsv_term(value.strip())
+            if term is not None:
+                bindings[var] = term
+
+        yield bindings, variables
+
+READERS_BY_MIMETYPE = {
+    XML_MIMETYPE: iter_xml_results,
+    'application/xml': iter_xml_results,
+    'text/xml': iter_xml_results,
+    JSON_MIMETYPE: iter_json_results,
+    'application/json': iter_json_results,
+    TSV_MIMETYPE: iter_tsv_results,
+}
+
+def iter_results(stream, content_type=None):
+    """Yields results from a SPARQL results document, choosing a reader by the response's content type"""
+    mimetype = (content_type or XML_MIMETYPE).split(';')[0].strip().lower()
+
+    try:
+        reader = READERS_BY_MIMETYPE[mimetype]
+    except KeyError:
+        raise SPARQLResultsParseError('Unsupported SPARQL results format "%s"' % mimetype)
+
+    return reader(stream)
+
+def accept_header(preferred_format='xml'):
+    """Returns an Accept header asking for the preferred results format, falling back to XML"""
+    preferred = MIMETYPES_BY_FORMAT[preferred_format]
+
+    if preferred == XML_MIMETYPE:
+        return XML_MIMETYPE
+    else:
+        return '%s, %s;q=0.9' % (preferred, XML_MIMETYPE)
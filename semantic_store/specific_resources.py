@@ -1,13 +1,12 @@
 from django.db import transaction
 
 from rdflib import Literal, URIRef, Graph
-from rdflib.plugins.sparql import prepareQuery
 
 from semantic_store.rdfstore import rdfstore
 from semantic_store.namespaces import NS, ns, bind_namespaces
 from semantic_store.utils import metadata_triples
 from semantic_store.annotations import resource_annotation_subgraph
-from semantic_store import uris
+from semantic_store import uris, graph_cache
 
 import itertools
 
@@ -51,13 +50,12 @@ def specific_resources_subgraph(graph, source_uri, project_uri):
 
     return specific_resources_graph
 
-def read_specific_resource(project_uri, specific_resource, source):
+def read_specific_resource(project_uri, specific_resource, source, project_graph=None):
     specific_resource = URIRef(specific_resource)
 
-    project_identifier = uris.uri('semantic_store_projects', uri=project_uri)
-    db_project_graph = Graph(store=rdfstore(), identifier=project_identifier)
-
-    project_graph = db_project_graph
+    if project_graph is None:
+        project_identifier = uris.uri('semantic_store_projects', uri=project_uri)
+        project_graph = graph_cache.readable_graph(project_identifier)
 
     return_graph = Graph()
 
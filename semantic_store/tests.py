@@ -10,6 +10,18 @@ from rdflib.graph import ConjunctiveGraph, Graph
 from rdflib import URIRef, Literal, BNode, Namespace
 from .namespaces import NS, ns, bind_namespaces
 import rdfstore
+import sparql_results
+import utils
+import unit_of_work
+import queries
+import result_cache
+import versions
+import instrumentation
+import sparql_endpoint
+import backup
+import migration
+import uris
+from StringIO import StringIO
 from semantic_store.namespaces import update_oa
 
 annotations_url = reverse('semantic_store_annotations', kwargs=dict())
@@ -327,3 +339,1345 @@ class TestDataUpdate(unittest.TestCase):
         new_graph = update_oa(old_graph)
 
         self.assertTrue(new_graph.isomorphic(correct_graph))
+
+class TestUpdateBatching(unittest.TestCase):
+    def setUp(self):
+        self.graphs = [URIRef('http://example.org/graphs/%d' % i) for i in range(3)]
+        self.quads = [(URIRef('http://example.org/s/%d' % i), NS.dc.title, Literal('Title %d' % i), self.graphs[i % 3])
+                      for i in range(10)]
+
+    def test_groups_quads_by_graph(self):
+        batches = list(rdfstore.data_update_batches(self.quads, max_quads=100, max_bytes=1024 * 1024))
+
+        self.assertEqual(len(batches), 1)
+        update, count = batches[0]
+        self.assertEqual(count, 10)
+        self.assertEqual(update.count('INSERT DATA'), 3)
+        for graph in self.graphs:
+            self.assertEqual(update.count(graph.n3()), 1)
+
+    def test_batches_are_bounded(self):
+        counts = [count for update, count in rdfstore.data_update_batches(self.quads, max_quads=4, max_bytes=1024 * 1024)]
+        self.assertEqual(counts, [4, 4, 2])
+
+        for update, count in rdfstore.data_update_batches(self.quads, max_quads=100, max_bytes=200):
+            self.assertTrue(count >= 1)
+            self.assertTrue(len(update) < 400)
+
+    def test_bnodes_inserted_but_not_deleted(self):
+        bnode = BNode()
+        quads = [(bnode, NS.dc.title, Literal('Title'), self.graphs[0])]
+        update, count = iter(rdfstore.data_update_batches(quads)).next()
+        self.assertTrue(bnode.n3() in update)
+        self.assertRaises(Exception, list, rdfstore.data_update_batches(quads, 'DELETE DATA'))
+
+    def test_shared_bnodes_are_never_split(self):
+        shared, other, linked = BNode(), BNode(), BNode()
+        quads = [
+            (shared, NS.dc.title, Literal('Shared'), self.graphs[0]),
+            (other, NS.dc.title, Literal('Other'), self.graphs[0]),
+            (linked, NS.dc.title, Literal('Linked'), self.graphs[1]),
+            (shared, NS.dc.description, Literal('Shared'), self.graphs[1]),
+            (shared, NS.dc.relation, linked, self.graphs[2]),
+        ] + self.quads
+
+        batches = list(rdfstore.data_update_batches(quads, max_quads=2, max_bytes=1024 * 1024))
+        self.assertEqual(sum(count for update, count in batches), 15)
+
+        # shared and linked are written in a single operation, even though it goes over max_quads
+        operations = [operation for update, count in batches for operation in update.split(';\n') if shared.n3() in operation]
+        self.assertEqual(len(operations), 1)
+        self.assertEqual(operations[0].count('INSERT DATA'), 1)
+        self.assertEqual(operations[0].count('GRAPH'), 3)
+        self.assertTrue(linked.n3() in operations[0])
+        self.assertFalse(other.n3() in operations[0])
+
+class TestSPARQLResultReaders(unittest.TestCase):
+    def setUp(self):
+        self.s = URIRef('http://example.org/s')
+        self.label = Literal(u'caf\xe9 "one"\ttwo', lang='fr')
+        self.count = Literal('12', datatype=URIRef('http://www.w3.org/2001/XMLSchema#integer'))
+
+    def check(self, results):
+        self.assertEqual(len(results), 2)
+        bindings, variables = results[0]
+        self.assertEqual(variables, [rdfstore.Variable('s'), rdfstore.Variable('o')])
+        self.assertEqual(bindings[rdfstore.Variable('s')], self.s)
+        self.assertEqual(bindings[rdfstore.Variable('o')], self.label)
+        self.assertEqual(results[1][0], {rdfstore.Variable('o'): self.count})
+
+    def test_xml(self):
+        doc = u"""<?xml version="1.0"?>
+        <sparql xmlns="http://www.w3.org/2005/sparql-results#">
+            <head><variable name="s"/><variable name="o"/></head>
+            <results>
+                <result>
+                    <binding name="s"><uri>http://example.org/s</uri></binding>
+                    <binding name="o"><literal xml:lang="fr">caf\xe9 "one"\ttwo</literal></binding>
+                </result>
+                <result>
+                    <binding name="o"><literal datatype="http://www.w3.org/2001/XMLSchema#integer">12</literal></binding>
+                </result>
+            </results>
+        </sparql>""".encode('utf-8')
+        self.check(list(sparql_results.iter_results(StringIO(doc), 'application/sparql-results+xml')))
+
+    def test_json(self):
+        doc = """{"head": {"vars": ["s", "o"]}, "results": {"bindings": [
+            {"s": {"type": "uri", "value": "http://example.org/s"},
+             "o": {"type": "literal", "value": "caf\\u00e9 \\"one\\"\\ttwo", "xml:lang": "fr"}},
+            {"o": {"type": "typed-literal", "value": "12", "datatype": "http://www.w3.org/2001/XMLSchema#integer"}}
+        ]}}"""
+        self.check(list(sparql_results.iter_results(StringIO(doc), 'application/sparql-results+json; charset=utf-8')))
+
+    def test_tsv(self):
+        doc = u'?s\t?o\n<http://example.org/s>\t"caf\xe9 \\"one\\"\\ttwo"@fr\n\t12\n'.encode('utf-8')
+        self.check(list(sparql_results.iter_results(StringIO(doc), 'text/tab-separated-values')))
+
+    def test_unknown_format(self):
+        self.assertRaises(sparql_results.SPARQLResultsParseError, sparql_results.iter_results, StringIO(''), 'text/html')
+
+class TestTriplesMulti(unittest.TestCase):
+    def test_matches_any_pattern(self):
+        g = graph()
+        a, b, c = [URIRef('http://example.org/%s' % name) for name in 'abc']
+        g.add((a, NS.dc.title, Literal('A')))
+        g.add((a, NS.rdf.type, NS.sc.Canvas))
+        g.add((b, NS.rdfs.label, Literal('B')))
+        g.add((c, NS.dc.title, Literal('C')))
+
+        triples = set(utils.triples_multi(g, [(a, NS.dc.title, None), (None, NS.rdfs.label, None), (c, NS.rdf.type, None)]))
+        self.assertEqual(triples, set([(a, NS.dc.title, Literal('A')), (b, NS.rdfs.label, Literal('B'))]))
+
+        self.assertEqual(len(list(utils.metadata_triples_multi(g, [a, b]))), 3)
+
+class TestUnitOfWork(unittest.TestCase):
+    def setUp(self):
+        self.backing = ConjunctiveGraph().store
+        self.a = URIRef('http://example.org/a')
+        self.identifier = URIRef('http://example.org/graph')
+
+        g = Graph(store=self.backing, identifier=self.identifier)
+        g.add((self.a, NS.dc.title, Literal('Old title')))
+        g.add((self.a, NS.rdf.type, NS.dctypes.Text))
+
+    def test_buffers_until_exit(self):
+        with unit_of_work.unit_of_work(self.backing) as buffered:
+            self.assertTrue(rdfstore.rdfstore() is buffered)
+
+            g = Graph(store=rdfstore.rdfstore(), identifier=self.identifier)
+            g.set((self.a, NS.dc.title, Literal('New title')))
+            g.add((self.a, NS.rdfs.label, Literal('Label')))
+            g.remove((self.a, NS.rdf.type, None))
+
+            self.assertEqual(g.value(self.a, NS.dc.title), Literal('New title'))
+            self.assertEqual(len(g), 2)
+            self.assertEqual(Graph(store=self.backing, identifier=self.identifier).value(self.a, NS.dc.title), Literal('Old title'))
+
+            removals, additions = buffered.pending_changes()
+            self.assertEqual(len(removals), 2)
+            self.assertEqual(len(additions), 2)
+
+        self.assertTrue(rdfstore.rdfstore() is rdfstore.store)
+        g = Graph(store=self.backing, identifier=self.identifier)
+        self.assertEqual(set(g), set([(self.a, NS.dc.title, Literal('New title')), (self.a, NS.rdfs.label, Literal('Label'))]))
+
+    def test_cancels_add_and_remove_pairs(self):
+        with unit_of_work.unit_of_work(self.backing) as buffered:
+            g = Graph(store=buffered, identifier=self.identifier)
+            g.set((self.a, NS.dc.title, Literal('Old title')))
+            g.add((self.a, NS.rdfs.label, Literal('Label')))
+            g.remove((self.a, NS.rdfs.label, Literal('Label')))
+            self.assertEqual(buffered.pending_changes(), ([], []))
+
+            # The triple was in the store before it was added, so removing it again isn't a no-op
+            g.add((self.a, NS.rdf.type, NS.dctypes.Text))
+            g.remove((self.a, NS.rdf.type, NS.dctypes.Text))
+
+            removals, additions = buffered.pending_changes()
+            self.assertEqual(additions, [])
+            self.assertEqual([(s, p, o) for s, p, o, c in removals], [(self.a, NS.rdf.type, NS.dctypes.Text)])
+
+    def test_discards_on_exception(self):
+        def fail():
+            with unit_of_work.unit_of_work(self.backing) as buffered:
+                Graph(store=buffered, identifier=self.identifier).remove((self.a, None, None))
+                raise ValueError()
+
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(len(Graph(store=self.backing, identifier=self.identifier)), 2)
+
+    def test_removes_blank_nodes_by_pattern(self):
+        with sparql_endpoint.LocalSPARQLEndpoint() as endpoint:
+            store = rdfstore.FourStore(endpoint.query_url, endpoint.update_url)
+            g = Graph(store=store, identifier=self.identifier)
+            g.addN([(self.a, NS.oa.hasBody, BNode(), g), (self.a, NS.oa.hasTarget, BNode(), g),
+                    (self.a, NS.dc.title, Literal('Title'), g)])
+
+            with unit_of_work.unit_of_work(store) as buffered:
+                buffered_graph = Graph(store=buffered, identifier=self.identifier)
+                buffered_graph.set((self.a, NS.dc.title, Literal('New title')))
+                buffered_graph.remove((self.a, NS.oa.hasBody, None))
+                buffered_graph.remove((None, NS.oa.hasTarget, None))
+
+            self.assertEqual(set(g), set([(self.a, NS.dc.title, Literal('New title'))]))
+
+            # A fully bound triple with a blank node is removed by the backing store too, rather than in a
+            # DELETE DATA, which can't match it
+            g.addN([(self.a, NS.oa.hasBody, BNode(), g), (self.a, NS.oa.hasBody, self.identifier, g)])
+            with unit_of_work.unit_of_work(store) as buffered:
+                buffered_graph = Graph(store=buffered, identifier=self.identifier)
+                for body in list(buffered_graph.objects(self.a, NS.oa.hasBody)):
+                    buffered_graph.remove((self.a, NS.oa.hasBody, body))
+                buffered_graph.add((self.a, NS.oa.hasTarget, self.identifier))
+
+            self.assertEqual(set(g), set([(self.a, NS.dc.title, Literal('New title')), (self.a, NS.oa.hasTarget, self.identifier)]))
+
+    def test_middleware_reports_failed_writes(self):
+        from django.http import HttpResponse
+        from django.test.client import RequestFactory
+
+        class FailingStore(object):
+            def apply_changes(self, removals, additions):
+                raise IOError('The store is down')
+
+        middleware = unit_of_work.UnitOfWorkMiddleware()
+        request = RequestFactory().post('/')
+        unit_of_work._local.store = unit_of_work.BufferedStore(FailingStore())
+        Graph(store=unit_of_work.active_store(), identifier=self.identifier).add((self.a, NS.dc.title, Literal('Title')))
+
+        response = middleware.process_response(request, HttpResponse('Saved'))
+        self.assertEqual(response.status_code, 500)
+        self.assertTrue(unit_of_work.active_store() is None)
+
+        # Without pending changes, the view's response is returned as it was
+        unit_of_work._local.store = unit_of_work.BufferedStore(FailingStore())
+        self.assertEqual(middleware.process_response(request, HttpResponse('Read')).content, 'Read')
+
+class TestPreparedQueries(unittest.TestCase):
+    def setUp(self):
+        self.g = graph()
+        self.canvas = URIRef('http://example.org/canvas')
+        self.anno = URIRef('http://example.org/anno')
+        self.image = URIRef('http://example.org/image')
+
+        self.g.add((self.anno, NS.rdf.type, NS.oa.Annotation))
+        self.g.add((self.anno, NS.oa.hasTarget, self.canvas))
+        self.g.add((self.anno, NS.oa.hasBody, self.image))
+        self.g.add((self.image, NS.rdf.type, NS.dcmitype.Image))
+
+    def test_execute_with_bindings(self):
+        self.assertEqual(queries.execute('canvas_images', self.g, canvas=self.canvas), [(self.anno, self.image)])
+        self.assertEqual(queries.execute('canvas_images', self.g, canvas=URIRef('http://example.org/other')), [])
+        self.assertTrue(queries.stats()['canvas_images']['executions'] >= 2)
+
+    def test_bound_text(self):
+        text = queries.registry['canvas_images'].bound_text({'canvas': self.canvas})
+        self.assertTrue('oa:hasTarget <http://example.org/canvas>' in text)
+        self.assertFalse('?canvas' in text)
+
+    def test_rejects_unsafe_parameters(self):
+        self.assertRaises(queries.QueryParameterError, queries.execute, 'canvas_images', self.g, canvas='http://example.org/canvas')
+        self.assertRaises(queries.QueryParameterError, queries.execute, 'canvas_images', self.g, canvas=URIRef('http://example.org/a> } #'))
+        self.assertRaises(queries.QueryParameterError, queries.execute, 'canvas_images', self.g)
+
+class TestResultCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = result_cache.LRUCache(max_entries=2, max_size=10)
+        cache.set('a', 1, size=4)
+        cache.set('b', 2, size=4)
+        cache.get('a')
+        cache.set('c', 3, size=4)
+
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertTrue('c' in cache)
+
+        cache.set('d', 4, size=11)
+        self.assertFalse('d' in cache)
+
+    def test_writes_bump_graph_versions(self):
+        identifier = URIRef('http://example.org/graphs/%s' % uuid.uuid4())
+        g = Graph(store=rdfstore.rdfstore(), identifier=identifier)
+
+        before = versions.graph_versions([identifier])
+        g.add((URIRef('http://example.org/s'), NS.dc.title, Literal('Title')))
+        after_add = versions.graph_versions([identifier])
+        g.remove((None, None, None))
+        after_remove = versions.graph_versions([identifier])
+
+        self.assertTrue(before[identifier] < after_add[identifier] < after_remove[identifier])
+
+class TestStoreInstrumentation(unittest.TestCase):
+    def setUp(self):
+        from rdflib.plugins.memory import IOMemory
+
+        class InstrumentedMemory(IOMemory):
+            pass
+        instrumentation.instrument_store(InstrumentedMemory)
+
+        self.graph = Graph(store=InstrumentedMemory(), identifier=URIRef('http://example.org/graph'))
+        self.stats = instrumentation.RequestStats('/test')
+        instrumentation._local.stats = self.stats
+
+    def tearDown(self):
+        instrumentation._local.stats = None
+
+    def test_counts_store_calls(self):
+        a = URIRef('http://example.org/a')
+        self.graph.add((a, NS.dc.title, Literal('A')))
+        self.graph.addN([(a, NS.rdfs.label, Literal('A'), self.graph)])
+        self.assertEqual(len(list(self.graph.triples((a, None, None)))), 2)
+        list(self.graph.triples_choices((a, [NS.dc.title, NS.rdfs.label], None)))
+
+        operations = self.stats.as_dict()['operations']
+        self.assertEqual(operations['add']['count'], 1)
+        self.assertEqual(operations['addN']['count'], 1)
+        self.assertEqual(operations['triples']['count'], 1)
+        # The triples calls made by triples_choices are not counted separately
+        self.assertEqual(operations['triples_choices']['count'], 1)
+
+        headers = self.stats.headers()
+        self.assertEqual(headers['X-Store-Calls'], '4')
+
+class TestFourStore(unittest.TestCase):
+    def setUp(self):
+        self.endpoint = sparql_endpoint.LocalSPARQLEndpoint().start()
+        self.store = rdfstore.FourStore(self.endpoint.query_url, self.endpoint.update_url)
+        self.graph = Graph(store=self.store, identifier=URIRef('http://example.org/graph'))
+        self.a = URIRef('http://example.org/a')
+
+    def tearDown(self):
+        self.endpoint.stop()
+
+    def test_reads_and_writes(self):
+        self.graph.add((self.a, NS.dc.title, Literal(u'Caf\xe9')))
+        self.graph.addN([(self.a, NS.rdfs.label, Literal('A'), self.graph),
+                         (self.a, NS.rdf.type, NS.sc.Canvas, self.graph)])
+        self.assertEqual(len(self.graph), 3)
+        self.assertEqual(self.graph.value(self.a, NS.dc.title), Literal(u'Caf\xe9'))
+
+        choices = set(self.graph.triples_choices((self.a, [NS.dc.title, NS.rdfs.label], None)))
+        self.assertEqual(set(p for s, p, o in choices), set([NS.dc.title, NS.rdfs.label]))
+
+        self.store.apply_changes([(self.a, NS.rdfs.label, Literal('A'), self.graph)],
+                                 [(self.a, NS.rdfs.label, Literal('B'), self.graph)])
+        self.assertEqual(self.graph.value(self.a, NS.rdfs.label), Literal('B'))
+
+        constructed = self.graph.query('CONSTRUCT { ?s ?p ?o } WHERE { ?s ?p ?o }').graph
+        self.assertEqual(len(constructed), 3)
+
+    def test_recovers_from_failures(self):
+        self.graph.add((self.a, NS.dc.title, Literal('A')))
+
+        self.endpoint.drop_next()
+        self.assertEqual(len(list(self.graph.triples((self.a, None, None)))), 1)
+        self.assertEqual(self.store.pool_stats()['query']['retries'], 1)
+
+        self.endpoint.fail_next(status=503)
+        self.assertRaises(rdfstore.FourStoreException, lambda: list(self.graph.triples((self.a, None, None))))
+        self.assertEqual(len(list(self.graph.triples((self.a, None, None)))), 1)
+
+    def test_blank_nodes(self):
+        # As in 4store, a blank node is the same node within one INSERT DATA operation, and a new one in the next
+        body = BNode()
+        self.graph.addN([(self.a, NS.oa.hasBody, body, self.graph), (body, NS.dc.title, Literal('Body'), self.graph)])
+        bodies = list(self.graph.objects(self.a, NS.oa.hasBody))
+        self.assertEqual(len(bodies), 1)
+        self.assertNotEqual(bodies[0], body)
+        self.assertEqual(list(self.graph.subjects(NS.dc.title, Literal('Body'))), bodies)
+
+        self.graph.add((self.a, NS.oa.hasBody, body))
+        self.assertEqual(len(list(self.graph.objects(self.a, NS.oa.hasBody))), 2)
+
+    def test_load_backup(self):
+        import shutil
+        import tempfile
+
+        source = ConjunctiveGraph().store
+        Graph(store=source, identifier=self.graph.identifier).add((self.a, NS.dc.title, Literal('A')))
+        Graph(store=source, identifier=URIRef('http://example.org/other')).add((self.a, NS.dc.title, Literal('B')))
+
+        directory = tempfile.mkdtemp()
+        try:
+            backup.write_archive(source, directory, shards=1)
+            self.endpoint.load_backup(directory)
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual(self.graph.value(self.a, NS.dc.title), Literal('A'))
+        self.assertEqual(len(self.endpoint.dataset), 2)
+
+class TestBackup(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+
+        self.store = ConjunctiveGraph().store
+        self.a = URIRef('http://example.org/a')
+        self.identifiers = [URIRef('http://example.org/graph/%d' % i) for i in range(5)]
+        for i, identifier in enumerate(self.identifiers):
+            g = Graph(store=self.store, identifier=identifier)
+            for j in range(i + 1):
+                g.add((URIRef('http://example.org/%d' % j), NS.dc.title, Literal(u'Title\n%d \xe9' % j)))
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def test_archive(self):
+        full = os.path.join(self.directory, 'full')
+        os.mkdir(full)
+        manifest = backup.write_archive(self.store, full, shards=2, workers=2)
+
+        self.assertEqual(manifest, backup.read_manifest(full))
+        self.assertEqual(len(manifest['graphs']), 5)
+        self.assertEqual(manifest['graphs'][unicode(self.identifiers[4])]['triples'], 5)
+
+        restored = ConjunctiveGraph()
+        for filename in manifest['files']:
+            with backup.open_compressed(os.path.join(full, filename)) as f:
+                restored.parse(data=f.read(), format='nquads')
+        self.assertEqual(sum(len(context) for context in restored.contexts()), 15)
+        self.assertEqual(set(restored.get_context(self.identifiers[2])), set(Graph(store=self.store, identifier=self.identifiers[2])))
+
+        versions.bump([self.identifiers[0]])
+        incremental = os.path.join(self.directory, 'incremental')
+        os.mkdir(incremental)
+        manifest = backup.write_archive(self.store, incremental, since=full)
+
+        self.assertEqual(manifest['graphs'][unicode(self.identifiers[0])]['file'],
+                         backup.shard_filename(self.identifiers[0], backup.DEFAULT_SHARDS, 'gzip'))
+        for identifier in self.identifiers[1:]:
+            self.assertTrue(manifest['graphs'][unicode(identifier)]['file'].startswith('../full/'))
+
+    def test_restore(self):
+        backup.write_archive(self.store, self.directory, shards=2)
+
+        target = ConjunctiveGraph().store
+        summary = backup.restore(target, self.directory, workers=2, batch_size=4, verify=True)
+        self.assertEqual((summary['graphs'], summary['triples'], summary['mismatches']), (5, 15, []))
+        self.assertFalse(os.path.exists(os.path.join(self.directory, backup.CHECKPOINT_FILENAME)))
+
+        # Resume a restore which finished the first graph, and was part way through the second
+        target = ConjunctiveGraph().store
+        Graph(store=target, identifier=self.identifiers[1]).add((self.a, NS.dc.title, Literal('Partial')))
+        with open(os.path.join(self.directory, backup.CHECKPOINT_FILENAME), 'w') as f:
+            f.write('started %s\nfinished %s\nstarted %s\n' % (self.identifiers[0], self.identifiers[0], self.identifiers[1]))
+
+        summary = backup.restore(target, self.directory, workers=1)
+        self.assertEqual((summary['graphs'], summary['skipped']), (4, 1))
+        self.assertEqual(len(Graph(store=target, identifier=self.identifiers[0])), 0)
+        self.assertEqual(set(Graph(store=target, identifier=self.identifiers[1])), set(Graph(store=self.store, identifier=self.identifiers[1])))
+
+    def test_restore_single_file(self):
+        manifest = backup.write_archive(self.store, self.directory, shards=1)
+        path = os.path.join(self.directory, manifest['files'][0])
+        missing = u'http://example.org/graph/missing'
+
+        # The graphs of a file are read one at a time, in the order they were written
+        parsed = backup.iter_backup_file(path, [unicode(identifier) for identifier in self.identifiers] + [missing])
+        identifier, triples = parsed.next()
+        self.assertEqual(set(triples), set(Graph(store=self.store, identifier=URIRef(identifier))))
+        self.assertEqual(sorted(identifier for identifier, triples in parsed), sorted([missing] + [unicode(i) for i in self.identifiers if unicode(i) != identifier]))
+
+        target = ConjunctiveGraph().store
+        summary = backup.restore(target, self.directory, workers=4, batch_size=4, verify=True)
+        self.assertEqual((summary['graphs'], summary['triples'], summary['mismatches']), (5, 15, []))
+
+    def test_restore_checks_checksums(self):
+        manifest = backup.write_archive(self.store, self.directory, shards=2)
+        manifest['graphs'][unicode(self.identifiers[3])]['sha1'] = backup.checksum(['corrupted'])
+        backup.write_manifest(self.directory, manifest)
+
+        for workers in (1, 2):
+            self.assertRaises(backup.BackupError, backup.restore, ConjunctiveGraph().store, self.directory, workers=workers)
+            if os.path.exists(os.path.join(self.directory, backup.CHECKPOINT_FILENAME)):
+                os.remove(os.path.join(self.directory, backup.CHECKPOINT_FILENAME))
+
+        files = os.path.join(self.directory, 'files')
+        os.mkdir(files)
+        backup.write_graph_files(self.store, files)
+        summary = backup.restore(ConjunctiveGraph().store, files, workers=1, verify=True)
+        self.assertEqual((summary['graphs'], summary['triples'], summary['mismatches']), (5, 15, []))
+
+class TestStoreCopy(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.log_path = tempfile.mktemp()
+
+        self.old_store = ConjunctiveGraph().store
+        self.identifiers = [URIRef('http://example.org/graph/%d' % i) for i in range(4)]
+        for i, identifier in enumerate(self.identifiers):
+            g = Graph(store=self.old_store, identifier=identifier)
+            for j in range(i + 3):
+                g.add((URIRef('http://example.org/%d' % j), NS.dc.title, Literal('Title %d' % j)))
+
+        self.endpoint = sparql_endpoint.LocalSPARQLEndpoint().start()
+        self.new_store = rdfstore.FourStore(self.endpoint.query_url, self.endpoint.update_url)
+
+    def tearDown(self):
+        self.endpoint.stop()
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+
+    def test_copies_in_batches(self):
+        reports = []
+        summary = rdfstore.copy_to_store(self.old_store, self.new_store, workers=2, batch_size=2, log_path=self.log_path,
+                                         report=lambda progress: reports.append(unicode(progress)))
+
+        self.assertEqual((summary['graphs'], summary['triples'], summary['mismatches']), (4, 18, []))
+        self.assertEqual(len(Graph(store=self.new_store, identifier=self.identifiers[3])), 6)
+        self.assertTrue(reports[-1].startswith('4/4 graphs, 18 triples copied'))
+        self.assertFalse(os.path.exists(self.log_path))
+
+    def test_resumes_from_log(self):
+        Graph(store=self.new_store, identifier=self.identifiers[1]).add((URIRef('http://example.org/a'), NS.dc.title, Literal('Partial')))
+        with open(self.log_path, 'w') as f:
+            f.write('started %s\nfinished %s\nstarted %s\n' % (self.identifiers[0], self.identifiers[0], self.identifiers[1]))
+
+        summary = migration.copy_store(self.old_store, self.new_store, workers=1, log_path=self.log_path, verify=False)
+        self.assertEqual((summary['graphs'], summary['skipped']), (3, 1))
+        self.assertEqual(len(Graph(store=self.new_store, identifier=self.identifiers[0])), 0)
+        self.assertEqual(len(Graph(store=self.new_store, identifier=self.identifiers[1])), 4)
+
+class TestNamespaceRewrite(unittest.TestCase):
+    old_oa = Namespace('http://www.openannotation.org/ns/')
+
+    def check_rewrite(self, store):
+        identifier = URIRef('http://example.org/graph')
+        other = Graph(store=store, identifier=URIRef('http://example.org/other'))
+        g = Graph(store=store, identifier=identifier)
+        anno = URIRef('http://example.org/anno')
+
+        g.add((anno, NS.rdf.type, self.old_oa.Annotation))
+        g.add((anno, self.old_oa.hasBody, URIRef('http://example.org/body')))
+        g.add((anno, NS.rdfs.label, Literal(unicode(self.old_oa.Annotation))))
+        other.add((anno, NS.rdf.type, self.old_oa.Annotation))
+
+        update_oa(g)
+
+        self.assertEqual(set(g), set([
+            (anno, NS.rdf.type, NS.oa.Annotation),
+            (anno, NS.oa.hasBody, URIRef('http://example.org/body')),
+            (anno, NS.rdfs.label, Literal(unicode(self.old_oa.Annotation))),
+        ]))
+        self.assertEqual(set(other), set([(anno, NS.rdf.type, self.old_oa.Annotation)]))
+
+    def test_memory_store(self):
+        self.check_rewrite(ConjunctiveGraph().store)
+
+    def test_sqlalchemy_store(self):
+        store = rdfstore.SQLAlchemyStore(identifier=URIRef('http://example.org/store'))
+        store.open(Literal('sqlite://'), create=True)
+        self.check_rewrite(store)
+
+        # LIKE wildcards in the old namespace match only themselves, and case matters
+        g = Graph(store=store, identifier=URIRef('http://example.org/wildcards'))
+        unrelated = [URIRef('http://example.org/aXb/1'), URIRef('http://example.org/A_B/2'),
+                     URIRef('http://example.org/a%b/3')]
+        for uri in unrelated + [URIRef('http://example.org/a_b/4')]:
+            g.add((uri, NS.rdf.type, NS.sc.Canvas))
+        self.assertEqual(store.rewrite_namespace(u'http://example.org/a_b/', u'http://example.org/new/', g), 1)
+        self.assertEqual(set(g.subjects()), set(unrelated + [URIRef('http://example.org/new/4')]))
+
+    def test_four_store(self):
+        with sparql_endpoint.LocalSPARQLEndpoint() as endpoint:
+            store = rdfstore.FourStore(endpoint.query_url, endpoint.update_url)
+            self.check_rewrite(store)
+            self.assertEqual(endpoint.stats.updates, 5)
+
+    def test_rewrites_while_parsing(self):
+        data = '<http://example.org/anno> a <http://www.openannotation.org/ns/Annotation> .'
+        g = utils.parse_into_graph(data=data, format='turtle', update_namespaces=True)
+        self.assertEqual(list(g), [(URIRef('http://example.org/anno'), NS.rdf.type, NS.oa.Annotation)])
+
+class TestProjectSnapshot(unittest.TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from semantic_store.models import ProjectPermission
+
+        self.project_uri = URIRef(uuid.uuid4().urn)
+        self.user = User.objects.create(username='snapshot-%s' % uuid.uuid4().hex[:8], first_name='Snap')
+        ProjectPermission.objects.create(identifier=self.project_uri, user=self.user, permission='r')
+
+        self.text = URIRef('http://example.org/text')
+        self.canvas = URIRef('http://example.org/canvas')
+
+    def tearDown(self):
+        self.user.delete()
+
+    def test_snapshot(self):
+        import projects
+
+        with sparql_endpoint.LocalSPARQLEndpoint() as endpoint:
+            store = rdfstore.FourStore(endpoint.query_url, endpoint.update_url)
+            metadata = Graph(store=store, identifier=uris.project_metadata_graph_identifier(self.project_uri))
+            metadata.addN([(self.project_uri, NS.ore.aggregates, self.text, metadata),
+                           (self.text, NS.rdf.type, NS.dcmitype.Text, metadata),
+                           (self.canvas, NS.rdf.type, NS.sc.Canvas, metadata)])
+
+            queries_before = endpoint.stats.queries
+            with unit_of_work.unit_of_work(store):
+                snapshot = projects.project_snapshot(self.project_uri)
+            self.assertEqual(endpoint.stats.queries - queries_before, 1)
+
+        self.assertTrue((self.project_uri, NS.ore.aggregates, self.text) in snapshot)
+        self.assertEqual(len(list(snapshot.objects(self.text, NS.ore.isDescribedBy))), 1)
+        self.assertEqual(len(list(snapshot.objects(self.canvas, NS.ore.isDescribedBy))), 1)
+
+        user_uri = uris.uri('semantic_store_users', username=self.user.username)
+        self.assertTrue((user_uri, NS.perm.mayRead, self.project_uri) in snapshot)
+        self.assertEqual(snapshot.value(user_uri, NS.foaf.firstName), Literal('Snap'))
+
+    def test_read_user_with_permissions(self):
+        import users
+        from django.test.client import RequestFactory
+
+        response = users.read_user(RequestFactory().get('/', HTTP_ACCEPT='text/turtle'), self.user.username)
+        self.assertEqual(response.status_code, 200)
+
+        user_uri = uris.uri('semantic_store_users', username=self.user.username)
+        graph = Graph().parse(data=response.content, format='turtle')
+        self.assertTrue((user_uri, NS.perm.hasPermissionOver, self.project_uri) in graph)
+
+class TestGraphCache(unittest.TestCase):
+    def setUp(self):
+        from django.conf import settings
+        from semantic_store import graph_cache
+
+        self.settings = settings
+        self.enabled = getattr(settings, 'SEMANTIC_STORE_GRAPH_CACHE', False)
+        settings.SEMANTIC_STORE_GRAPH_CACHE = True
+
+        self.graph_cache = graph_cache
+        graph_cache.clear()
+
+        self.identifier = URIRef(uuid.uuid4().urn)
+        self.canvas = URIRef('http://example.org/canvas')
+
+    def tearDown(self):
+        self.settings.SEMANTIC_STORE_GRAPH_CACHE = self.enabled
+        self.graph_cache.clear()
+
+    def test_cached_reads(self):
+        with sparql_endpoint.LocalSPARQLEndpoint() as endpoint:
+            store = rdfstore.FourStore(endpoint.query_url, endpoint.update_url)
+            store_graph = Graph(store=store, identifier=self.identifier)
+            store_graph.add((self.canvas, NS.rdf.type, NS.sc.Canvas))
+
+            with unit_of_work.unit_of_work(store):
+                graph = self.graph_cache.readable_graph(self.identifier)
+                queries_before = endpoint.stats.queries
+                self.assertTrue((self.canvas, NS.rdf.type, NS.sc.Canvas) in self.graph_cache.readable_graph(self.identifier))
+                self.assertEqual(graph.value(self.canvas, NS.rdf.type), NS.sc.Canvas)
+                self.assertEqual(endpoint.stats.queries, queries_before)
+
+                # Graphs with pending changes are read through the unit of work
+                unit_of_work.active_store().add((self.canvas, NS.dc.title, Literal('Pending')), store_graph)
+                self.assertTrue((self.canvas, NS.dc.title, Literal('Pending')) in self.graph_cache.readable_graph(self.identifier))
+
+            # The write made when the unit of work ended dropped the cached copy, which is loaded again once, and
+            # a copy already handed to a reader isn't changed underneath it
+            self.assertFalse((self.canvas, NS.dc.title, Literal('Pending')) in graph)
+            queries_before = endpoint.stats.queries
+            with unit_of_work.unit_of_work(store):
+                graph = self.graph_cache.readable_graph(self.identifier)
+                self.graph_cache.readable_graph(self.identifier)
+            self.assertTrue((self.canvas, NS.dc.title, Literal('Pending')) in graph)
+            self.assertEqual(endpoint.stats.queries, queries_before + 1)
+
+            store_graph.remove((self.canvas, NS.dc.title, None))
+            with unit_of_work.unit_of_work(store):
+                self.assertFalse((self.canvas, NS.dc.title, None) in self.graph_cache.readable_graph(self.identifier))
+            self.assertTrue((self.canvas, NS.dc.title, Literal('Pending')) in graph)
+            self.assertEqual(endpoint.stats.queries, queries_before + 2)
+
+            # As does a SPARQL update, which could have changed any graph
+            store.update(u'INSERT DATA { GRAPH <%s> { <%s> <%s> "Updated" } }' % (self.identifier, self.canvas, NS.dc.title))
+            with unit_of_work.unit_of_work(store):
+                self.assertEqual(self.graph_cache.readable_graph(self.identifier).value(self.canvas, NS.dc.title), Literal('Updated'))
+            self.assertEqual(endpoint.stats.queries, queries_before + 3)
+
+            # And a write made by another process, which bumps the graph's shared version
+            versions.bump([self.identifier])
+            with unit_of_work.unit_of_work(store):
+                self.graph_cache.readable_graph(self.identifier)
+            self.assertEqual(endpoint.stats.queries, queries_before + 4)
+
+class TestProjectMetadata(unittest.TestCase):
+    def setUp(self):
+        self.project_uri = URIRef(uuid.uuid4().urn)
+        self.canvas = URIRef('http://example.org/canvas')
+        self.image_anno = URIRef('http://example.org/image-anno')
+        self.image = URIRef('http://example.org/image')
+        self.text = URIRef('http://example.org/text')
+
+    def project_triples(self):
+        return [
+            (self.project_uri, NS.dc.title, Literal('Project')),
+            (self.project_uri, NS.ore.aggregates, self.canvas),
+            (self.project_uri, NS.ore.aggregates, self.text),
+            (self.canvas, NS.rdf.type, NS.sc.Canvas),
+            (self.canvas, NS.dc.title, Literal('Canvas')),
+            (self.image_anno, NS.rdf.type, NS.oa.Annotation),
+            (self.image_anno, NS.oa.hasTarget, self.canvas),
+            (self.image_anno, NS.oa.hasBody, self.image),
+            (self.image, NS.rdf.type, NS.dcmitype.Image),
+            (self.text, NS.rdf.type, NS.dcmitype.Text),
+            (self.text, NS.dc.title, Literal('Text')),
+            (self.text, NS.cnt.chars, Literal('Not metadata')),
+        ]
+
+    def test_rebuild_and_update(self):
+        import project_metadata
+
+        with sparql_endpoint.LocalSPARQLEndpoint() as endpoint:
+            store = rdfstore.FourStore(endpoint.query_url, endpoint.update_url)
+            project_graph = Graph(store, identifier=uris.uri('semantic_store_projects', uri=self.project_uri))
+            metadata_graph = Graph(store, identifier=uris.project_metadata_graph_identifier(self.project_uri))
+            project_graph.addN((s, p, o, project_graph) for s, p, o in self.project_triples())
+
+            queries_before = endpoint.stats.queries
+            with unit_of_work.unit_of_work(store):
+                removed, added = project_metadata.rebuild_metadata(self.project_uri)
+            self.assertTrue(endpoint.stats.queries - queries_before <= 6)
+
+            self.assertEqual(len(removed), 0)
+            self.assertEqual(len(added), 11)
+            self.assertTrue((self.image, NS.rdf.type, NS.dcmitype.Image) in metadata_graph)
+            self.assertFalse((self.text, NS.cnt.chars, None) in metadata_graph)
+
+            # Drift is reported, and fixed
+            metadata_graph.set((self.canvas, NS.dc.title, Literal('Stale')))
+            with unit_of_work.unit_of_work(store):
+                removed, added = project_metadata.rebuild_metadata(self.project_uri, dry_run=True)
+            self.assertEqual((len(removed), len(added)), (1, 1))
+            with unit_of_work.unit_of_work(store):
+                project_metadata.rebuild_metadata(self.project_uri)
+            self.assertEqual(metadata_graph.value(self.canvas, NS.dc.title), Literal('Canvas'))
+
+            # Changes to the project graph are carried over to the metadata graph
+            with unit_of_work.unit_of_work(store) as buffered:
+                buffered_graph = Graph(buffered, identifier=project_graph.identifier)
+                buffered_graph.set((self.image, NS.exif.width, Literal(100)))
+                buffered_graph.remove((self.project_uri, NS.ore.aggregates, self.text))
+                removed, added = project_metadata.update_metadata(self.project_uri, [
+                    (self.image, NS.exif.width, Literal(100)),
+                    (self.project_uri, NS.ore.aggregates, self.text),
+                ])
+
+            self.assertEqual(len(added), 1)
+            self.assertEqual(metadata_graph.value(self.image, NS.exif.width), Literal(100))
+            self.assertFalse((self.text, None, None) in metadata_graph)
+            self.assertFalse((self.project_uri, NS.ore.aggregates, self.text) in metadata_graph)
+            self.assertEqual(len(metadata_graph), 9)
+
+    def test_update_queries_with_pending_changes(self):
+        import project_metadata
+
+        canvases = [URIRef('http://example.org/canvas/%d' % i) for i in range(20)]
+
+        with sparql_endpoint.LocalSPARQLEndpoint() as endpoint:
+            store = rdfstore.FourStore(endpoint.query_url, endpoint.update_url)
+            project_graph = Graph(store, identifier=uris.uri('semantic_store_projects', uri=self.project_uri))
+            metadata_graph = Graph(store, identifier=uris.project_metadata_graph_identifier(self.project_uri))
+            for canvas in canvases:
+                project_graph.addN([(self.project_uri, NS.ore.aggregates, canvas, project_graph),
+                                    (canvas, NS.rdf.type, NS.sc.Canvas, project_graph)])
+
+            # The project graph is written through the unit of work, so it has pending changes while the metadata
+            # is derived, but the reads of many resources are still batched
+            with unit_of_work.unit_of_work(store) as buffered:
+                buffered_graph = Graph(buffered, identifier=project_graph.identifier)
+                titles = [(canvas, NS.dc.title, Literal('Canvas')) for canvas in canvases]
+                buffered_graph.addN(t + (buffered_graph,) for t in titles)
+
+                queries_before = endpoint.stats.queries
+                project_metadata.update_metadata(self.project_uri, titles)
+                self.assertTrue(endpoint.stats.queries - queries_before <= 12)
+
+            self.assertEqual(len(list(metadata_graph.triples((None, NS.dc.title, None)))), len(canvases))
+
+    def test_blank_nodes(self):
+        import project_metadata
+
+        with sparql_endpoint.LocalSPARQLEndpoint() as endpoint:
+            store = rdfstore.FourStore(endpoint.query_url, endpoint.update_url)
+            project_graph = Graph(store, identifier=uris.uri('semantic_store_projects', uri=self.project_uri))
+            metadata_graph = Graph(store, identifier=uris.project_metadata_graph_identifier(self.project_uri))
+            project_graph.addN((s, p, o, project_graph) for s, p, o in self.project_triples())
+
+            anno = BNode()
+            input_graph = Graph()
+            input_graph.add((anno, NS.rdf.type, NS.oa.Annotation))
+            input_graph.add((anno, NS.oa.hasTarget, self.canvas))
+            input_graph.add((anno, NS.oa.hasBody, BNode()))
+            input_graph.add((self.canvas, NS.dc.description, BNode()))
+
+            with unit_of_work.unit_of_work(store):
+                project_metadata.rebuild_metadata(self.project_uri)
+            with unit_of_work.unit_of_work(store):
+                project_graph += input_graph
+                project_metadata.update_metadata(self.project_uri, input_graph)
+
+            self.assertEqual(len(list(metadata_graph.objects(self.canvas, NS.dc.description))), 1)
+
+            with unit_of_work.unit_of_work(store) as buffered:
+                Graph(buffered, identifier=project_graph.identifier).remove((self.canvas, NS.dc.description, None))
+                project_metadata.update_metadata(self.project_uri, [(self.canvas, NS.dc.description, None)])
+
+            self.assertFalse((self.canvas, NS.dc.description, None) in metadata_graph)
+            self.assertEqual(metadata_graph.value(self.canvas, NS.dc.title), Literal('Canvas'))
+
+class TestProjectGC(unittest.TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import User
+
+        self.project_uri = URIRef(uuid.uuid4().urn)
+        self.user = User.objects.create(username='gc-%s' % uuid.uuid4().hex[:8])
+
+    def tearDown(self):
+        self.user.delete()
+
+    def test_collect_garbage(self):
+        import project_gc
+        from semantic_store.models import Text
+
+        ex = Namespace('http://example.org/')
+        Text.objects.create(identifier=unicode(ex.text), project=unicode(self.project_uri), title='Text', last_user=self.user,
+                            content='<p>A <span class="atb-editor-textannotation" about="%s">highlight</span></p>' % ex.kept_selector)
+
+        triples = [
+            (self.project_uri, NS.ore.aggregates, ex.canvas),
+            (self.project_uri, NS.ore.aggregates, ex.text),
+            (self.project_uri, NS.ore.aggregates, ex.manifest),
+            (ex.canvas, NS.rdf.type, NS.sc.Canvas),
+            (ex.text, NS.rdf.type, NS.dcmitype.Text),
+            (ex.manifest, NS.rdf.type, NS.sc.Manifest),
+            (ex.manifest, NS.sc.hasCanvases, ex.manifest_canvas),
+            (ex.canvas_resource, NS.rdf.type, NS.oa.SpecificResource),
+            (ex.canvas_resource, NS.oa.hasSource, ex.canvas),
+            (ex.canvas_resource, NS.oa.hasSelector, ex.svg_selector),
+            (ex.svg_selector, NS.rdf.type, NS.oa.SVGSelector),
+            (ex.manifest_anno, NS.rdf.type, NS.oa.Annotation),
+            (ex.manifest_anno, NS.oa.hasTarget, ex.manifest_canvas),
+            (ex.kept_resource, NS.rdf.type, NS.oa.SpecificResource),
+            (ex.kept_resource, NS.oa.hasSource, ex.text),
+            (ex.kept_resource, NS.oa.hasSelector, ex.kept_selector),
+            (ex.kept_selector, NS.rdf.type, NS.oa.TextQuoteSelector),
+            # A highlight which has been deleted from the text, and an empty annotation
+            (ex.deleted_resource, NS.rdf.type, NS.oa.SpecificResource),
+            (ex.deleted_resource, NS.oa.hasSource, ex.text),
+            (ex.deleted_resource, NS.oa.hasSelector, ex.deleted_selector),
+            (ex.deleted_selector, NS.rdf.type, NS.oa.TextQuoteSelector),
+            (ex.deleted_selector, NS.oa.exact, Literal('gone')),
+            (ex.blank_anno, NS.rdf.type, NS.oa.Annotation),
+            # An orphaned annotation with a blank node body, and a blank node annotation (which isn't collected)
+            (ex.bnode_body_anno, NS.rdf.type, NS.oa.Annotation),
+            (ex.bnode_body_anno, NS.oa.hasBody, BNode()),
+            (BNode(), NS.rdf.type, NS.oa.Annotation),
+        ]
+
+        with sparql_endpoint.LocalSPARQLEndpoint() as endpoint:
+            store = rdfstore.FourStore(endpoint.query_url, endpoint.update_url)
+            project_graph = Graph(store, identifier=uris.uri('semantic_store_projects', uri=self.project_uri))
+            project_graph.addN((s, p, o, project_graph) for s, p, o in triples)
+
+            orphans = set([ex.deleted_resource, ex.deleted_selector, ex.blank_anno, ex.bnode_body_anno])
+
+            with unit_of_work.unit_of_work(store):
+                summary = project_gc.collect_garbage(self.project_uri, dry_run=True)
+            self.assertEqual(summary['orphans'], orphans)
+            self.assertEqual(len(summary['garbage']), 8)
+            self.assertEqual(len(project_graph), len(triples))
+
+            with unit_of_work.unit_of_work(store):
+                self.assertRaises(project_gc.TimeBudgetExceeded, project_gc.collect_garbage, self.project_uri, time_budget=-1)
+            self.assertEqual(len(project_graph), len(triples))
+
+            with unit_of_work.unit_of_work(store):
+                project_gc.collect_garbage(self.project_uri, batch_size=2)
+            self.assertEqual(len(project_graph), len(triples) - 8)
+            for orphan in orphans:
+                self.assertFalse((orphan, None, None) in project_graph)
+
+    def test_metadata_failure_reported_after_deletes(self):
+        import project_gc
+
+        orphan = URIRef('http://example.org/orphan')
+
+        with sparql_endpoint.LocalSPARQLEndpoint() as endpoint:
+            store = rdfstore.FourStore(endpoint.query_url, endpoint.update_url)
+            project_graph = Graph(store, identifier=uris.uri('semantic_store_projects', uri=self.project_uri))
+            project_graph.add((orphan, NS.rdf.type, NS.oa.Annotation))
+
+            def fail(project_uri, triples):
+                raise ValueError('metadata')
+
+            update_metadata, project_gc.project_metadata.update_metadata = project_gc.project_metadata.update_metadata, fail
+            try:
+                with unit_of_work.unit_of_work(store):
+                    try:
+                        project_gc.collect_garbage(self.project_uri)
+                        self.fail()
+                    except project_gc.MetadataNotUpdated as e:
+                        self.assertEqual(e.summary['orphans'], set([orphan]))
+            finally:
+                project_gc.project_metadata.update_metadata = update_metadata
+
+            self.assertEqual(len(project_graph), 0)
+
+class TestProjectExport(unittest.TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import User
+
+        self.project_uri = URIRef(uuid.uuid4().urn)
+        self.user = User.objects.create(username='export-%s' % uuid.uuid4().hex[:8])
+
+    def tearDown(self):
+        self.user.delete()
+
+    def test_streamed_export(self):
+        import export
+        import projects
+        from semantic_store.models import Text
+        import gzip
+
+        ex = Namespace('http://example.org/')
+        Text.objects.create(identifier=unicode(ex.text), project=unicode(self.project_uri), title=u'Caf\xe9',
+                            content=u'<p>\u201cContent\u201d</p>', last_user=self.user)
+
+        store = ConjunctiveGraph().store
+        project_graph = Graph(store, identifier=uris.uri('semantic_store_projects', uri=self.project_uri))
+        metadata_graph = Graph(store, identifier=uris.project_metadata_graph_identifier(self.project_uri))
+        for graph in (project_graph, metadata_graph):
+            graph.add((self.project_uri, NS.ore.aggregates, ex.text))
+            graph.add((ex.text, NS.rdf.type, NS.dcmitype.Text))
+            graph.add((ex.text, NS.dc.title, Literal('Stale title')))
+        project_graph.add((ex.canvas, NS.rdf.type, NS.sc.Canvas))
+
+        with unit_of_work.unit_of_work(store):
+            expected = projects.project_export_graph(self.project_uri)
+            chunks = list(export.project_export_chunks(self.project_uri, 'nt', chunk_lines=2))
+            compressed = ''.join(export.gzip_chunks(export.project_export_chunks(self.project_uri, 'nquads')))
+
+        # The text's title comes from its Text model, rather than being added to the one in the graph
+        self.assertEqual(list(expected.objects(ex.text, NS.dc.title)), [Literal(u'Caf\xe9')])
+
+        self.assertTrue(len(chunks) > 1)
+        streamed = Graph().parse(data=''.join(chunks), format='nt')
+        self.assertEqual(set(streamed), set(expected))
+
+        quads = ConjunctiveGraph()
+        quads.parse(data=gzip.GzipFile(fileobj=StringIO(compressed)).read(), format='nquads')
+        self.assertEqual(len(Graph(quads.store, metadata_graph.identifier)), 2)
+        self.assertEqual(Graph(quads.store, project_graph.identifier).value(ex.text, NS.dc.title), Literal(u'Caf\xe9'))
+
+    def test_streams_sqlalchemy_graphs_and_pages_texts(self):
+        import export
+        from semantic_store.models import Text
+
+        ex = Namespace('http://example.org/')
+        store = rdfstore.SQLAlchemyStore(identifier=URIRef('http://example.org/store'))
+        store.open(Literal('sqlite://'), create=True)
+        graph = Graph(store, identifier=ex.graph)
+        graph.add((ex.text, NS.rdf.type, NS.dcmitype.Text))
+        graph.add((ex.text, NS.dc.title, Literal('Title')))
+        graph.add((ex.text, NS.ore.aggregates, ex.canvas))
+        Graph(store, identifier=ex.other).add((ex.other, NS.rdf.type, NS.sc.Canvas))
+
+        self.assertEqual(set(store.stream_triples(graph)), set(graph))
+        self.assertEqual(len(list(export.graph_triples(store, ex.graph))), 3)
+        with unit_of_work.unit_of_work(store):
+            self.assertEqual(set(export.graph_triples(rdfstore.rdfstore(), ex.graph)), set(graph))
+
+        for i in range(5):
+            Text.objects.create(identifier=unicode(ex['text%d' % i]), project=unicode(self.project_uri),
+                                title=u'Text %d' % i, content=u'<p>%d</p>' % i, last_user=self.user)
+        rows = list(export.text_rows(self.project_uri, page_size=2))
+        self.assertEqual([row[1] for row in rows], [u'Text %d' % i for i in range(5)])
+
+    def test_text_graphs_from_models(self):
+        import project_texts
+        from semantic_store.models import Text
+
+        ex = Namespace('http://example.org/')
+        for i, text_uri in enumerate((ex.first, ex.second, ex.unlisted)):
+            Text.objects.create(identifier=unicode(text_uri), project=unicode(self.project_uri), title=u'Text %d' % i,
+                                content=u'<p>%d</p>' % i, last_user=self.user)
+        Text.objects.create(identifier=unicode(ex.first), project=unicode(self.project_uri), title=u'Newer',
+                            content=u'<p>Newer</p>', last_user=self.user)
+
+        graph = Graph()
+        for text_uri in (ex.first, ex.second):
+            graph.add((text_uri, NS.rdf.type, NS.dctypes.Text))
+            graph.add((text_uri, NS.dc.title, Literal('Stale title')))
+
+        project_texts.overwrite_text_graphs_from_models(self.project_uri, graph)
+
+        self.assertEqual(list(graph.objects(ex.first, NS.dc.title)), [Literal(u'Newer')])
+        self.assertEqual(list(graph.objects(ex.second, NS.cnt.chars)), [Literal(u'<p>1</p>')])
+        self.assertFalse((ex.unlisted, None, None) in graph)
+
+        texts = list(project_texts.project_text_models(self.project_uri, ex.second, with_content=False))
+        self.assertEqual([t.title for t in texts], [u'Text 1'])
+        self.assertEqual(texts[0].content, u'<p>1</p>')
+
+class TestConditionalGet(unittest.TestCase):
+    def setUp(self):
+        from django.conf import settings
+        from django.contrib.auth.models import User
+        from django.test.client import RequestFactory
+
+        self.factory = RequestFactory()
+        self.user = User.objects.create(username='conditional-%s' % uuid.uuid4().hex[:8])
+        self.text_uri = URIRef(uuid.uuid4().urn)
+        self.enabled = getattr(settings, 'SEMANTIC_STORE_CONDITIONAL_GET', False)
+        settings.SEMANTIC_STORE_CONDITIONAL_GET = True
+
+    def tearDown(self):
+        from django.conf import settings
+
+        settings.SEMANTIC_STORE_CONDITIONAL_GET = self.enabled
+        self.user.delete()
+
+    def get(self, **headers):
+        import conditional
+        from django.http import HttpResponse
+
+        identifiers = [versions.model_identifier('text', self.text_uri)]
+        self.built = False
+        def build_response():
+            self.built = True
+            return HttpResponse('text')
+
+        return conditional.graph_response(self.factory.get('/', HTTP_ACCEPT='text/turtle', **headers), identifiers, build_response)
+
+    def test_not_modified_until_model_saved(self):
+        import conditional
+        from semantic_store.models import Text
+
+        first = self.get()
+        self.assertEqual(first.status_code, 200)
+        self.assertTrue(first.has_header('ETag'))
+
+        not_modified = self.get(HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertFalse(self.built)
+
+        Text.objects.create(identifier=unicode(self.text_uri), title=u'Title', last_user=self.user)
+
+        modified = self.get(HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(modified.status_code, 200)
+        self.assertTrue(self.built)
+        self.assertNotEqual(modified['ETag'], first['ETag'])
+
+        settle_seconds, conditional.LAST_MODIFIED_SETTLE_SECONDS = conditional.LAST_MODIFIED_SETTLE_SECONDS, -1
+        try:
+            last_modified = self.get()['Last-Modified']
+            self.assertEqual(self.get(HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        finally:
+            conditional.LAST_MODIFIED_SETTLE_SECONDS = settle_seconds
+
+    def test_disabled(self):
+        from django.conf import settings
+
+        settings.SEMANTIC_STORE_CONDITIONAL_GET = False
+        first = self.get()
+        self.assertFalse(first.has_header('ETag'))
+        self.assertEqual(self.get(HTTP_IF_MODIFIED_SINCE='Sat, 01 Jan 2050 00:00:00 GMT').status_code, 200)
+
+class TestChangeLog(unittest.TestCase):
+    def setUp(self):
+        from django.conf import settings
+
+        self.project_uri = URIRef(uuid.uuid4().urn)
+        self.enabled = getattr(settings, 'SEMANTIC_STORE_CHANGE_LOG', False)
+        settings.SEMANTIC_STORE_CHANGE_LOG = True
+
+    def tearDown(self):
+        from django.conf import settings
+
+        settings.SEMANTIC_STORE_CHANGE_LOG = self.enabled
+
+    def test_changes_since(self):
+        import change_log
+        from datetime import datetime, timedelta
+
+        ex = Namespace('http://example.org/')
+        graph = Graph(rdfstore.rdfstore(), identifier=uris.uri('semantic_store_projects', uri=self.project_uri))
+        self.assertEqual(change_log.project_for_graph(graph.identifier), self.project_uri)
+        self.assertEqual(change_log.project_for_graph(uris.project_metadata_graph_identifier(self.project_uri)), self.project_uri)
+
+        start = change_log.latest_sequence(self.project_uri)
+        graph.add((ex.canvas, NS.dc.title, Literal('First')))
+        graph.set((ex.canvas, NS.dc.title, Literal('Second')))
+        Graph(rdfstore.rdfstore(), identifier=URIRef('http://example.org/other')).add((ex.canvas, NS.dc.title, Literal('Other')))
+
+        changes, more = change_log.changes_since(self.project_uri, start)
+        self.assertFalse(more)
+        self.assertEqual([(c.op, c.triple) for c in changes], [
+            ('+', u'<http://example.org/canvas> <http://purl.org/dc/elements/1.1/title> "First" .'),
+            ('-', u'<http://example.org/canvas> <http://purl.org/dc/elements/1.1/title> "First" .'),
+            ('+', u'<http://example.org/canvas> <http://purl.org/dc/elements/1.1/title> "Second" .'),
+        ])
+
+        page, more = change_log.changes_since(self.project_uri, start, limit=2)
+        self.assertTrue(more)
+        self.assertEqual(len(page), 2)
+
+        self.assertEqual(change_log.compact(self.project_uri, datetime.now() + timedelta(seconds=1)), 1)
+        changes, more = change_log.changes_since(self.project_uri, start)
+        self.assertEqual([(c.op, c.triple.split(' ')[2]) for c in changes], [('-', u'"First"'), ('+', u'"Second"')])
+
+        graph.remove((None, None, None))
+
+    def test_sequences_follow_commits(self):
+        import change_log
+        import threading
+        from django.db import connection, transaction
+
+        ex = Namespace('http://example.org/')
+        graph = uris.uri('semantic_store_projects', uri=self.project_uri)
+        start = change_log.latest_sequence(self.project_uri)
+
+        logged = threading.Event()
+        release = threading.Event()
+
+        def long_transaction():
+            try:
+                with transaction.commit_on_success():
+                    change_log.record(additions=[(ex.canvas, NS.dc.title, Literal('First'), graph)])
+                    logged.set()
+                    release.wait(5)
+            finally:
+                connection.close()
+
+        def short_write():
+            try:
+                change_log.record(additions=[(ex.canvas, NS.dc.title, Literal('Second'), graph)])
+            finally:
+                connection.close()
+
+        first = threading.Thread(target=long_transaction)
+        first.start()
+        self.assertTrue(logged.wait(5))
+        second = threading.Thread(target=short_write)
+        second.start()
+        second.join(0.5)
+
+        # A client polling while the first transaction is open must not be handed the second change alone
+        polled, more = change_log.changes_since(self.project_uri, start)
+        release.set()
+        first.join()
+        second.join()
+
+        since = polled[-1].sequence if polled else start
+        changes, more = change_log.changes_since(self.project_uri, since)
+        self.assertEqual([c.triple.split(' ')[2] for c in polled + changes], [u'"First"', u'"Second"'])
+
+    def test_limits(self):
+        import permissions
+        import views
+        from django.contrib.auth.models import User
+        from django.test.client import RequestFactory
+
+        user = User.objects.create(username='changes-%s' % uuid.uuid4().hex[:8])
+        try:
+            permissions.grant_read_permissions(self.project_uri, user=user)
+
+            def get(limit):
+                request = RequestFactory().get('/', {'since': 0, 'limit': limit})
+                request.user = user
+                return views.ProjectChanges.as_view()(request, project_uri=self.project_uri)
+
+            self.assertEqual(get(1).status_code, 200)
+            for limit in (0, -1, -2):
+                self.assertEqual(get(limit).status_code, 400)
+        finally:
+            user.delete()
+
+class TestBatchReads(unittest.TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import User
+
+        self.project_uri = URIRef(uuid.uuid4().urn)
+        self.user = User.objects.create(username='batch-%s' % uuid.uuid4().hex[:8])
+
+    def tearDown(self):
+        self.user.delete()
+
+    def test_read_resources(self):
+        import batch_reads
+        import canvases
+        import project_texts
+        import specific_resources
+        from semantic_store.models import Text
+
+        ex = Namespace('http://example.org/%s/' % uuid.uuid4().hex)
+        Text.objects.create(identifier=unicode(ex.text), project=unicode(self.project_uri), title=u'Text',
+                            content=u'<p>Text</p>', last_user=self.user)
+
+        store = ConjunctiveGraph().store
+        project_graph = Graph(store, identifier=uris.uri('semantic_store_projects', uri=self.project_uri))
+        for canvas in (ex.canvas1, ex.canvas2):
+            project_graph.add((canvas, NS.rdf.type, NS.sc.Canvas))
+            project_graph.add((canvas, NS.dc.title, Literal(canvas)))
+        project_graph.add((ex.text, NS.rdf.type, NS.dcmitype.Text))
+        project_graph.add((ex.sr, NS.rdf.type, NS.oa.SpecificResource))
+        project_graph.add((ex.sr, NS.oa.hasSource, ex.canvas1))
+        project_graph.add((ex.sr, NS.oa.hasSelector, ex.selector))
+        project_graph.add((ex.selector, NS.rdf.type, NS.oa.SVGSelector))
+
+        with unit_of_work.unit_of_work(store):
+            batch = batch_reads.read_resources(self.project_uri, [ex.canvas1, ex.canvas2, ex.text, ex.sr, ex.unknown])
+
+            expected = Graph()
+            for canvas in (ex.canvas1, ex.canvas2):
+                expected += canvases.read_canvas(None, self.project_uri, canvas)
+            expected += project_texts.read_project_text(self.project_uri, ex.text)
+            expected += specific_resources.read_specific_resource(self.project_uri, ex.sr, ex.canvas1)
+
+        self.assertEqual(set(batch), set(expected))
+        self.assertEqual(batch.value(ex.text, NS.cnt.chars), Literal(u'<p>Text</p>'))
+        self.assertTrue((ex.selector, NS.rdf.type, NS.oa.SVGSelector) in batch)
+
+class TestNegotiatedFormats(unittest.TestCase):
+    def setUp(self):
+        ex = Namespace('http://example.org/')
+        self.graph = Graph()
+        self.graph.add((ex.canvas, NS.rdf.type, NS.sc.Canvas))
+        self.graph.add((ex.canvas, NS.dc.title, Literal(u'Caf\xe9', lang='fr')))
+        self.graph.add((ex.canvas, NS.exif.width, Literal(1200)))
+        self.graph.add((ex.canvas, NS.rdfs.label, Literal('Canvas')))
+        self.graph.add((ex.canvas, NS.oa.hasBody, BNode()))
+
+    def response(self, accept, accept_encoding=''):
+        from django.test.client import RequestFactory
+
+        request = RequestFactory().get('/', HTTP_ACCEPT=accept, HTTP_ACCEPT_ENCODING=accept_encoding)
+        return utils.NegotiatedGraphResponse(request, self.graph)
+
+    def test_binary_round_trip(self):
+        import binary_rdf
+
+        data = self.graph.serialize(format=binary_rdf.FORMAT)
+        self.assertEqual(set(Graph().parse(data=data, format=binary_rdf.FORMAT)), set(self.graph))
+        self.assertRaises(binary_rdf.BinaryRDFError, list, binary_rdf.decode(data[:-2]))
+        # A typed literal whose datatype index is past the terms read so far
+        self.assertRaises(binary_rdf.BinaryRDFError, list, binary_rdf.decode(binary_rdf.MAGIC + '\x01\x04\x00\x05'))
+
+    def test_negotiation(self):
+        import binary_rdf
+        import gzip
+        from rdflib.compare import isomorphic
+
+        response = self.response('application/n-triples, text/turtle')
+        self.assertEqual(response['Content-Type'], 'application/n-triples')
+        self.assertTrue(isomorphic(Graph().parse(data=response.content, format='nt'), self.graph))
+
+        response = self.response('%s, text/turtle' % binary_rdf.MIMETYPE)
+        self.assertEqual(response['Content-Type'], binary_rdf.MIMETYPE)
+        self.assertEqual(set(Graph().parse(data=response.content, format=binary_rdf.FORMAT)), set(self.graph))
+
+        self.assertEqual(self.response('text/xml, text/turtle')['Content-Type'], 'application/rdf+xml')
+        self.assertEqual(self.response('*/*')['Content-Type'], 'text/turtle')
+
+        utils_min_gzip, utils.MIN_GZIP_BYTES = utils.MIN_GZIP_BYTES, 0
+        try:
+            response = self.response('text/turtle', 'deflate, gzip')
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            content = gzip.GzipFile(fileobj=StringIO(response.content)).read()
+            self.assertTrue(isomorphic(Graph().parse(data=content, format='turtle'), self.graph))
+
+            self.assertFalse(self.response('text/turtle', 'gzip;q=0').has_header('Content-Encoding'))
+        finally:
+            utils.MIN_GZIP_BYTES = utils_min_gzip
+
+    def test_json_ld(self):
+        import json_ld
+        from django.utils import simplejson
+        from rdflib.compare import isomorphic
+
+        response = self.response('application/ld+json, text/turtle')
+        self.assertEqual(response['Content-Type'], json_ld.MIMETYPE)
+
+        document = simplejson.loads(response.content)
+        self.assertEqual(document['@context']['sc'], unicode(NS.sc))
+
+        def expand(term):
+            prefix, colon, name = term.partition(':')
+            if prefix == '_':
+                return BNode(name)
+            return URIRef(document['@context'].get(prefix, prefix + colon) + name if colon else term)
+
+        def expand_value(value):
+            if not isinstance(value, dict):
+                return Literal(value)
+            elif '@id' in value:
+                return expand(value['@id'])
+            elif '@language' in value:
+                return Literal(value['@value'], lang=value['@language'])
+            else:
+                return Literal(value['@value'], datatype=expand(value['@type']))
+
+        graph = Graph()
+        for node in document['@graph']:
+            subject = expand(node.pop('@id'))
+            for key, values in node.items():
+                for value in (values if isinstance(values, list) else [values]):
+                    if key == '@type':
+                        graph.add((subject, NS.rdf.type, expand(value)))
+                    else:
+                        graph.add((subject, expand(key), expand_value(value)))
+
+        self.assertTrue(isomorphic(graph, self.graph))
+
+        streamed = simplejson.loads(''.join(json_ld.graph_chunks(sorted(self.graph))))
+        self.assertEqual(len(streamed['@graph']), 1)
+        self.assertEqual(streamed['@graph'][0]['@type'], 'sc:Canvas')
+
+class TestSerializationCache(unittest.TestCase):
+    def setUp(self):
+        from django.conf import settings
+        import serialization_cache
+
+        self.identifier = URIRef(uuid.uuid4().urn)
+        self.enabled = getattr(settings, 'SEMANTIC_STORE_SERIALIZATION_CACHE', False)
+        settings.SEMANTIC_STORE_SERIALIZATION_CACHE = True
+        serialization_cache.clear()
+
+    def tearDown(self):
+        from django.conf import settings
+
+        settings.SEMANTIC_STORE_SERIALIZATION_CACHE = self.enabled
+
+    def serialization(self, accept='text/turtle'):
+        from django.test.client import RequestFactory
+        import serialization_cache
+
+        def builder():
+            self.builds += 1
+            graph = Graph()
+            graph.add((self.identifier, NS.rdf.type, NS.sc.Canvas))
+            return graph
+
+        request = RequestFactory().get('/', HTTP_ACCEPT=accept)
+        return serialization_cache.cached_serialization(request, 'test', [self.identifier], (self.identifier,), builder)
+
+    def test_rebuilt_after_write(self):
+        self.builds = 0
+
+        first = self.serialization()
+        self.assertEqual(first.mimetype, 'text/turtle')
+        self.assertEqual(first.triples, 1)
+        self.assertEqual(self.serialization().content, first.content)
+        self.assertEqual(self.builds, 1)
+
+        self.assertEqual(self.serialization('application/n-triples').mimetype, 'application/n-triples')
+        self.assertEqual(self.builds, 2)
+
+        versions.bump([self.identifier])
+        self.serialization()
+        self.assertEqual(self.builds, 3)
@@ -0,0 +1,334 @@
+"""
+A request scoped unit of work for the rdf store.
+
+While a unit of work is active, `rdfstore()` returns a BufferedStore, which holds every add and remove
+made to any named graph in memory (answering reads from the backing store merged with the pending changes),
+and writes them all out in one go when the unit of work ends: a single DELETE DATA ... ; INSERT DATA ...
+request for FourStore, or a single transaction for the SQLAlchemy store.
+
+    with unit_of_work():
+        project_g = Graph(store=rdfstore(), identifier=project_uri)
+        project_g.set((uri, NS.dc.title, title))
+        ...
+
+UnitOfWorkMiddleware wraps each request in one, committing the changes when a response is returned and
+discarding them if the view raises an exception. If the changes can't be written, the view's response is
+replaced with a 500, so a client is never told that a write succeeded when it didn't.
+"""
+from django.http import HttpResponseServerError
+from rdflib import BNode
+from rdflib.store import Store
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+def active_store():
+    """Returns the BufferedStore of the unit of work active on this thread, or None"""
+    return getattr(_local, 'store', None)
+
+class BufferedStore(Store):
+    """
+    Wraps a store, buffering writes to named graphs until flush is called.
+
+    Pending changes are kept per graph as {triple: (known to be in the backing store, should be present)},
+    so an add followed by a remove of the same triple (or the remove and re-add done by Graph.set) cancels
+    out rather than being sent to the store twice. (If it isn't known whether an added triple was already in the
+    backing store, that is looked up when it is removed again: the pair only cancels out if it wasn't.)
+
+    Operations which can't sensibly be buffered (writes and reads without a named graph, clearing a whole
+    graph, removing a triple with a blank node or a pattern which matches one, SPARQL queries and updates) flush
+    the pending changes first and then go straight to the backing store, as does everything once the buffer has
+    been closed.
+    """
+    def __init__(self, store):
+        super(BufferedStore, self).__init__()
+        self.store = store
+        self.closed = False
+
+        self._changes = OrderedDict()
+        self._contexts = {}
+
+    context_aware = property(lambda self: self.store.context_aware)
+    formula_aware = property(lambda self: self.store.formula_aware)
+    transaction_aware = property(lambda self: self.store.transaction_aware)
+
+    def __len__(self, context=None):
+        if self._passes_through(context):
+            return self.store.__len__(context=context)
+
+        return sum(1 for t in self.triples((None, None, None), context))
+
+    def is_dirty(self, context=None):
+        """Whether there are pending changes to the given graph (or graph identifier), or to any graph"""
+        if context is None:
+            return bool(self._changes)
+        else:
+            return bool(self._changes.get(getattr(context, 'identifier', context)))
+
+    def _passes_through(self, context):
+        """
+        Whether a read can go straight to the backing store; reads across all graphs flush any pending
+        changes first
+        """
+        if self.closed or context is None:
+            self.flush()
+            return True
+
+        return not self.is_dirty(context)
+
+    def pending_changes(self):
+        """Returns (removals, additions) as lists of quads"""
+        removals = []
+        additions = []
+
+        for identifier, changes in self._changes.iteritems():
+            context = self._contexts[identifier]
+
+            for (s, p, o), (in_store, present) in changes.iteritems():
+                if present and not in_store:
+                    additions.append((s, p, o, context))
+                elif not present and in_store is not False:
+                    removals.append((s, p, o, context))
+
+        return removals, additions
+
+    def flush(self):
+        """Writes all the pending changes to the backing store"""
+        removals, additions = self.pending_changes()
+        self.discard()
+
+        if not removals and not additions:
+            return
+
+        logger.debug('Flushing %d removals and %d additions', len(removals), len(additions))
+
+        if hasattr(self.store, 'apply_changes'):
+            self.store.apply_changes(removals, additions)
+        else:
+            for s, p, o, context in removals:
+                self.store.remove((s, p, o), context)
+            self.store.addN(additions)
+
+    def discard(self):
+        """Throws away all the pending changes"""
+        self._changes = OrderedDict()
+        self._contexts = {}
+
+    def close(self, commit_pending_transaction=False):
+        if commit_pending_transaction:
+            self.flush()
+        else:
+            self.discard()
+
+        self.closed = True
+
+    def _record(self, triple, context, present, in_store=None):
+        identifier = context.identifier
+        self._contexts.setdefault(identifier, context)
+        changes = self._changes.setdefault(identifier, OrderedDict())
+
+        if triple in changes:
+            in_store, was_present = changes[triple]
+            if in_store is None and was_present and not present:
+                # A remove of an added triple only needs to reach the store if the triple was there all along
+                in_store = any(True for t in self.store.triples(triple, context))
+                if not in_store:
+                    del changes[triple]
+                    return
+        changes[triple] = (in_store, present)
+
+    def add(self, triple, context, quoted=False):
+        if self.closed or context is None or quoted:
+            self.flush()
+            self.store.add(triple, context, quoted)
+        else:
+            self._record(triple, context, True)
+
+    def addN(self, quads):
+        for s, p, o, context in quads:
+            self.add((s, p, o), context)
+
+    def remove(self, triple, context=None):
+        s, p, o = triple
+
+        if self.closed or context is None or (s is None and p is None and o is None) or \
+                any(isinstance(term, BNode) for term in triple):
+            # A triple with a blank node can't be removed by value in a DELETE DATA, but the backing store can
+            # remove it itself
+            self.flush()
+            self.store.remove(triple, context)
+        elif s is not None and p is not None and o is not None:
+            self._record(triple, context, False)
+        else:
+            matches = list(self._merged_triples(triple, context))
+
+            if any(isinstance(term, BNode) for t, in_store in matches if in_store is not False for term in t):
+                # The matched triples can't be removed by value (DELETE DATA can't match blank nodes), but the
+                # backing store can remove the pattern itself
+                self.flush()
+                self.store.remove(triple, context)
+            else:
+                for t, in_store in matches:
+                    self._record(t, context, False, in_store)
+
+    def _merged_triples(self, triple, context):
+        """Yields (triple, whether it came from the backing store) for matches of triple in the merged view"""
+        changes = self._changes.get(context.identifier, {})
+
+        seen = set()
+        for t, contexts in self.store.triples(triple, context):
+            if t in changes:
+                if not changes[t][1]:
+                    continue
+                seen.add(t)
+            yield t, True
+
+        s, p, o = triple
+        for t, (in_store, present) in changes.items():
+            if present and t not in seen and \
+                    (s is None or s == t[0]) and (p is None or p == t[1]) and (o is None or o == t[2]):
+                yield t, in_store
+
+    def triples(self, triple, context=None):
+        if self._passes_through(context):
+            for t, contexts in self.store.triples(triple, context):
+                yield t, contexts
+        else:
+            for t, in_store in self._merged_triples(triple, context):
+                yield t, iter([context])
+
+    def stream_triples(self, context):
+        """
+        Yields the triples of a named graph, streamed by the backing store if it can (see
+        SQLAlchemyStore.stream_triples) and the graph has no pending changes
+        """
+        if self._passes_through(context) and hasattr(self.store, 'stream_triples'):
+            return self.store.stream_triples(context)
+        else:
+            return (t for t, contexts in self.triples((None, None, None), context))
+
+    def triples_choices(self, triple, context=None):
+        if self._passes_through(context):
+            for t, contexts in self.store.triples_choices(triple, context):
+                yield t, contexts
+        else:
+            for t, contexts in super(BufferedStore, self).triples_choices(triple, context):
+                yield t, contexts
+
+    def triples_multi(self, patterns, context=None):
+        if not hasattr(self.store, 'triples_multi'):
+            for pattern in patterns:
+                for t, contexts in self.triples(pattern, context):
+                    yield t, pattern
+        elif self._passes_through(context):
+            for t, pattern in self.store.triples_multi(patterns, context):
+                yield t, pattern
+        else:
+            # The patterns are still answered in one batch by the backing store, with the pending changes merged in
+            patterns = list(OrderedDict.fromkeys(tuple(pattern) for pattern in patterns))
+            changes = self._changes.get(context.identifier, {})
+
+            seen = set()
+            for t, pattern in self.store.triples_multi(patterns, context):
+                if t in changes:
+                    if not changes[t][1]:
+                        continue
+                    seen.add((t, pattern))
+                yield t, pattern
+
+            added = [t for t, (in_store, present) in changes.items() if present]
+            for pattern in patterns:
+                s, p, o = pattern
+                for t in added:
+                    if (t, pattern) not in seen and \
+                            (s is None or s == t[0]) and (p is None or p == t[1]) and (o is None or o == t[2]):
+                        yield t, pattern
+
+    def contexts(self, triple=None):
+        self.flush()
+        return self.store.contexts(triple)
+
+    def query(self, *args, **kwargs):
+        self.flush()
+        return self.store.query(*args, **kwargs)
+
+    def update(self, *args, **kwargs):
+        self.flush()
+        return self.store.update(*args, **kwargs)
+
+    def rewrite_namespace(self, *args, **kwargs):
+        self.flush()
+        return self.store.rewrite_namespace(*args, **kwargs)
+
+    def bind(self, prefix, namespace):
+        return self.store.bind(prefix, namespace)
+
+    def prefix(self, namespace):
+        return self.store.prefix(namespace)
+
+    def namespace(self, prefix):
+        return self.store.namespace(prefix)
+
+    def namespaces(self):
+        return self.store.namespaces()
+
+@contextmanager
+def unit_of_work(store=None):
+    """
+    Buffers every write made through `rdfstore()` on this thread within the block, and commits them together
+    when the block exits (or discards them if it raises). Nested units of work join the outermost one.
+    """
+    if active_store() is not None:
+        yield active_store()
+        return
+
+    if store is None:
+        from semantic_store.rdfstore import rdfstore
+        store = rdfstore()
+
+    buffered = BufferedStore(store)
+    _local.store = buffered
+
+    try:
+        yield buffered
+    except:
+        buffered.close(commit_pending_transaction=False)
+        raise
+    else:
+        buffered.close(commit_pending_transaction=True)
+    finally:
+        _local.store = None
+
+class UnitOfWorkMiddleware(object):
+    """
+    Runs each request in a unit of work, in the same way as django's TransactionMiddleware: the buffered
+    changes are written when the view returns a response, and thrown away if it raises. A response is only
+    returned once the changes have been written; if that fails, a 500 is returned instead.
+    """
+    def process_request(self, request):
+        if active_store() is None:
+            from semantic_store.rdfstore import rdfstore
+            _local.store = BufferedStore(rdfstore())
+
+    def process_exception(self, request, exception):
+        buffered = active_store()
+        if buffered is not None:
+            _local.store = None
+            buffered.close(commit_pending_transaction=False)
+
+    def process_response(self, request, response):
+        buffered = active_store()
+        if buffered is not None:
+            _local.store = None
+            try:
+                buffered.close(commit_pending_transaction=True)
+            except Exception:
+                logger.exception('Could not write the changes made by %s %s', request.method, request.path)
+                return HttpResponseServerError('The changes made by this request could not be saved')
+
+        return response
@@ -51,10 +51,18 @@ urlpatterns = patterns('',
         semantic_store.views.remove_project_triples,
         name="semantic_store_projects_remove_triples"),
 
-    url(r'^projects(?:/(?P<project_uri>[^/]+))/download\.(?P<extension>[\w\d]+)$',
+    url(r'^projects(?:/(?P<project_uri>[^/]+))/download\.(?P<extension>[\w\d]+)(?P<compressed>\.gz)?$',
         semantic_store.views.ProjectDownload.as_view(),
         name="semantic_store_projects_download"),
 
+    url(r'^projects(?:/(?P<project_uri>[^/]+))/batch/?$',
+        semantic_store.views.ProjectBatchRead.as_view(),
+        name="semantic_store_project_batch_read"),
+
+    url(r'^projects(?:/(?P<project_uri>[^/]+))/changes/?$',
+        semantic_store.views.ProjectChanges.as_view(),
+        name="semantic_store_project_changes"),
+
     url(r'^projects(?:/(?P<project_uri>[^/]+))/search_autocomplete$',
         semantic_store.views.SearchAutocomplete.as_view(),
         name="semantic_store_search_autocomplete"),
@@ -8,7 +8,7 @@ from rdflib.exceptions import ParserError
 
 from semantic_store.rdfstore import rdfstore
 from semantic_store.namespaces import bind_namespaces,NS
-from semantic_store import uris
+from semantic_store import uris, result_cache, versions, conditional, serialization_cache
 from semantic_store.utils import NegotiatedGraphResponse, parse_request_into_graph, metadata_triples
 from semantic_store.models import ProjectPermission
 from semantic_store.permissions import (
@@ -85,13 +85,25 @@ def user_graph(request, username=None, user=None):
         project_url = uris.url("semantic_store_projects", uri=project)
         graph.add((project, NS.ore.isDescribedBy, URIRef(project_url)))
 
-        for t in metadata_triples(project_graph, project):
-            graph.add(t)
+        def build_metadata(project_graph=project_graph, project=project):
+            metadata = Graph()
+            metadata += metadata_triples(project_graph, project)
+            return metadata
+
+        graph += result_cache.cached_graph('project_metadata_triples', [project_graph_identifier], (project,),
+                                           build_metadata)
 
     #TODO: dm:lastOpenProject
 
     return graph
 
+def user_graph_identifiers(user):
+    """Returns the identifiers of the graphs and model data a user's graph is derived from (see versions.py)"""
+    project_uris = ProjectPermission.objects.filter(user=user).values_list('identifier', flat=True).distinct()
+
+    return ([USER_GRAPH_IDENTIFIER, versions.model_identifier('user', user.pk)] +
+            [uris.uri('semantic_store_projects', uri=project_uri) for project_uri in project_uris])
+
 def read_user(request, username=None):
     if username:
         username.strip("/")
@@ -100,19 +112,27 @@ def read_user(request, username=None):
         except Exception as e:
             return HttpResponseNotFound()
         else:
-            graph = user_graph(request, user=user)
+            identifiers = user_graph_identifiers(user)
 
-            return NegotiatedGraphResponse(request, graph)
+            def response():
+                serialization = serialization_cache.cached_serialization(request, 'user_graph', identifiers,
+                                                                         (user.pk,), lambda: user_graph(request, user=user))
+                return NegotiatedGraphResponse(request, None, serialization)
+
+            return conditional.graph_response(request, identifiers, response)
     else:
         return read_all_users(request)
 
 def read_all_users(request):
-    g = Graph()
-    bind_namespaces(g)
-    for u in User.objects.filter():
-        g += user_metadata_graph(user=u)
+    def response():
+        g = Graph()
+        bind_namespaces(g)
+        for u in User.objects.filter():
+            g += user_metadata_graph(user=u)
+
+        return NegotiatedGraphResponse(request, g)
 
-    return NegotiatedGraphResponse(request, g)
+    return conditional.graph_response(request, [versions.model_identifier('users')], response)
 
 def permission_updates_are_allowed(request, input_graph):
     for perm_predicate in PERMISSION_PREDICATES:
@@ -1,10 +1,14 @@
 from django.http import HttpResponse
 from django.conf import settings
 from django.utils import simplejson
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_string
 from rdflib import Graph, URIRef, Literal, BNode
-from semantic_store.namespaces import NS, bind_namespaces
+from semantic_store.namespaces import NS, bind_namespaces, NamespaceUpdatingGraph
+from semantic_store import binary_rdf, json_ld
 from datetime import datetime
 from contextlib import contextmanager
+from collections import namedtuple
 import re
 from uuid import uuid4
 
@@ -23,6 +27,8 @@ METADATA_PREDICATES = [
 ]
 
 RDFLIB_SERIALIZER_FORMATS = set((
+    binary_rdf.FORMAT,
+    json_ld.FORMAT,
     'n3',
     'nquads',
     'nt',
@@ -33,6 +39,50 @@ RDFLIB_SERIALIZER_FORMATS = set((
     'xml',
 ))
 
+# Mimetype: (rdflib format, mimetype of the response)
+NEGOTIATED_MIMETYPES = {
+    'text/turtle': ('turtle', 'text/turtle'),
+    'application/x-turtle': ('turtle', 'text/turtle'),
+    'application/n-triples': ('nt', 'application/n-triples'),
+    'text/n3': ('n3', 'text/n3'),
+    'application/rdf+xml': ('xml', 'application/rdf+xml'),
+    'application/n-quads': ('nquads', 'application/n-quads'),
+    'application/trix': ('trix', 'application/trix'),
+    'application/x-trig': ('trig', 'application/x-trig'),
+    binary_rdf.MIMETYPE: (binary_rdf.FORMAT, binary_rdf.MIMETYPE),
+    json_ld.MIMETYPE: (json_ld.FORMAT, json_ld.MIMETYPE),
+}
+
+# The mimetype of the response for each rdflib format, for clients which ask for a format by a mimetype's subtype
+FORMAT_MIMETYPES = dict(NEGOTIATED_MIMETYPES.itervalues())
+
+# Responses smaller than this aren't worth compressing
+MIN_GZIP_BYTES = 200
+
+def accepts_gzip(request):
+    """Returns whether the request's Accept-Encoding header accepts gzip"""
+    for part in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        coding, semicolon, params = part.strip().partition(';')
+        if coding.strip().lower() in ('gzip', 'x-gzip'):
+            return not re.match(r'^\s*q\s*=\s*0(\.0*)?\s*$', params)
+
+    return False
+
+def negotiated_format(request):
+    """Returns the (rdflib format, mimetype) to serialize a graph as for a request, from its Accept header"""
+    mimetypes = [mimetype.strip().lower() for mimetype in accept_mimetypes(request.META.get('HTTP_ACCEPT', ''))]
+
+    if not (settings.DEBUG and mimetypes and mimetypes[0].endswith('html')):
+        for mimetype in mimetypes:
+            if mimetype in NEGOTIATED_MIMETYPES:
+                return NEGOTIATED_MIMETYPES[mimetype]
+
+            format = mimetype[mimetype.rfind('/') + 1:]
+            if format in RDFLIB_SERIALIZER_FORMATS:
+                return format, FORMAT_MIMETYPES.get(format, mimetype)
+
+    return NegotiatedGraphResponse.default_format, '%s/%s' % (NegotiatedGraphResponse.default_type, NegotiatedGraphResponse.default_format)
+
 def accept_mimetypes(accept_string):
     accept_parts = accept_string.split(',')
     accept_parts = (s.strip() for s in accept_parts)
@@ -42,31 +92,44 @@ def accept_mimetypes(accept_string):
         format = part[:index_of_semicolon] if index_of_semicolon != -1 else part
         yield format
 
+# The body of a graph response, with its mimetype, content encoding (or None) and the number of triples serialized
+GraphSerialization = namedtuple('GraphSerialization', ['content', 'mimetype', 'content_encoding', 'triples'])
+
+def negotiated_serialization(request, graph):
+    """
+    Returns the GraphSerialization of a graph in the format the request's Accept header asks for (see
+    negotiated_format), gzipped if its Accept-Encoding header allows. The content is built whole, in every format
+    (JSON-LD included), since it is gzipped and may be cached; responses which need to stream, such as project
+    downloads, serialize with json_ld.graph_chunks or export.project_export_chunks instead.
+    """
+    format, mimetype = negotiated_format(request)
+
+    bind_namespaces(graph)
+    content = graph.serialize(format=format)
+
+    if len(content) >= MIN_GZIP_BYTES and accepts_gzip(request):
+        return GraphSerialization(compress_string(content), mimetype, 'gzip', len(graph))
+    else:
+        return GraphSerialization(content, mimetype, None, len(graph))
+
 class NegotiatedGraphResponse(HttpResponse):
+    """
+    A response of a graph, serialized as negotiated_serialization does, or of a GraphSerialization made earlier
+    (passing None as the graph)
+    """
     default_format = 'turtle'
     default_type = 'text'
 
-    def __init__(self, request, graph, *args, **kwargs):
-        mimetypes = list(accept_mimetypes(request.META['HTTP_ACCEPT']))
-
-        if settings.DEBUG and mimetypes[0].strip().lower().endswith('html'):
-            format = NegotiatedGraphResponse.default_format
-            kwargs['mimetype'] = '%s/%s' % (NegotiatedGraphResponse.default_type, NegotiatedGraphResponse.default_format)
-        else:
-            for mimetype in mimetypes:
-                format = mimetype[mimetype.rfind('/') + 1:].strip().lower()
-
-                if format in RDFLIB_SERIALIZER_FORMATS:
-                    kwargs['mimetype'] = '%s/%s' % (NegotiatedGraphResponse.default_type, NegotiatedGraphResponse.default_format)
-                    break
-            else:
-                format = NegotiatedGraphResponse.default_format
-                kwargs['mimetype'] = '%s/%s' % (NegotiatedGraphResponse.default_type, NegotiatedGraphResponse.default_format)
+    def __init__(self, request, graph, serialization=None, *args, **kwargs):
+        if serialization is None:
+            serialization = negotiated_serialization(request, graph)
+        kwargs['mimetype'] = serialization.mimetype
 
-        super(NegotiatedGraphResponse, self).__init__(self, *args, **kwargs)
+        super(NegotiatedGraphResponse, self).__init__(serialization.content, *args, **kwargs)
 
-        bind_namespaces(graph)
-        self.content = graph.serialize(format=format)
+        if serialization.content_encoding:
+            self['Content-Encoding'] = serialization.content_encoding
+        patch_vary_headers(self, ('Accept', 'Accept-Encoding'))
 
         # Note(tandres): Tried this to make it more memory efficient, but I encountered infinite recursion in django's HttpResponse write method
         # graph.serialize(self, format=format)
@@ -80,7 +143,15 @@ class JsonResponse(HttpResponse):
             simplejson.dump(content, self)
 
 def parse_into_graph(graph=None, *args, **kwargs):
-    if graph is None:
+    """
+    Parses into graph (or a new graph). With update_namespaces=True, old namespaces are updated as the data
+    is parsed (see namespaces.NamespaceUpdatingGraph).
+    """
+    if kwargs.pop('update_namespaces', False):
+        temp_graph = NamespaceUpdatingGraph()
+        if graph is None:
+            graph = Graph()
+    elif graph is None:
         graph = Graph()
         temp_graph = graph
     else:
@@ -112,6 +183,26 @@ def metadata_triples(graph, subject=None):
     for t in graph.triples_choices((subject, METADATA_PREDICATES, None)):
         yield t
 
+def triples_multi(graph, patterns):
+    """
+    Yields the triples in the graph matching any of the (s, p, o) patterns. Stores which can answer
+    many patterns in one query (i.e. FourStore) are asked to, otherwise each pattern is matched in turn.
+    """
+    if hasattr(graph.store, 'triples_multi'):
+        for triple, pattern in graph.store.triples_multi(patterns, context=graph):
+            yield triple
+    else:
+        for pattern in patterns:
+            for t in graph.triples(pattern):
+                yield t
+
+def metadata_triples_multi(graph, subjects):
+    """Yields the metadata triples of all the given subjects, as fetched by triples_multi"""
+    patterns = ((subject, predicate, None) for subject in subjects for predicate in METADATA_PREDICATES)
+
+    for t in triples_multi(graph, patterns):
+        yield t
+
 def list_subgraph(graph, l):
     """
     Returns a graph of all the rdf:first, rdf:rest triples necessary to define
@@ -0,0 +1,117 @@
+"""
+Per named graph version counters.
+
+Every write to the store bumps the version of the graphs it touched, so anything derived from a graph
+(cached query results, ETags, ...) can be keyed on the graph's version and is invalidated by the next write.
+
+Versions live in the django cache named by SEMANTIC_STORE_CACHE (the default cache if not set), which must be
+shared between processes (memcached, the database cache, ...) when the application runs in more than one.
+A counter starts at the current time in milliseconds, so one which has been evicted from the cache restarts
+above any value it could have had before, rather than repeating an old version.
+
+Data kept in django models rather than the store (texts, permissions, users) is versioned the same way, under
+identifiers made with model_identifier, which are bumped when the models are saved or deleted (see models.py).
+The time of the latest bump of each identifier is also kept, for Last-Modified headers (see conditional.py).
+"""
+from django.conf import settings
+from django.core.cache import get_cache
+
+from semantic_store.signals import graph_changed
+
+import hashlib
+import time
+
+# Stands for every graph, for writes which aren't limited to a single named graph; it is part of every version
+ALL_GRAPHS = '*'
+
+VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+_cache = None
+
+def version_cache():
+    global _cache
+    if _cache is None:
+        _cache = get_cache(getattr(settings, 'SEMANTIC_STORE_CACHE', 'default'))
+
+    return _cache
+
+def is_shared():
+    """Whether the version cache can be shared between processes (it isn't a per process LocMemCache or a DummyCache)"""
+    from django.core.cache.backends.locmem import LocMemCache
+    from django.core.cache.backends.dummy import DummyCache
+
+    return not isinstance(version_cache(), (LocMemCache, DummyCache))
+
+def _key(identifier):
+    return 'semantic_store:graph_version:%s' % hashlib.md5(unicode(identifier).encode('utf-8')).hexdigest()
+
+def _modified_key(identifier):
+    return 'semantic_store:graph_modified:%s' % hashlib.md5(unicode(identifier).encode('utf-8')).hexdigest()
+
+def model_identifier(kind, key=''):
+    """Returns the identifier versioning data of the given kind kept in django models, e.g. ('text', text_uri)"""
+    return 'model:%s:%s' % (kind, key)
+
+def _initial_version():
+    return int(time.time() * 1000)
+
+def graph_versions(identifiers):
+    """
+    Returns a dictionary of the current versions of the named graphs with the given identifiers
+    (plus the version of ALL_GRAPHS)
+    """
+    cache = version_cache()
+
+    keys = dict((_key(identifier), identifier) for identifier in set(identifiers) | set([ALL_GRAPHS]))
+    versions = cache.get_many(keys.keys())
+
+    for key, identifier in keys.iteritems():
+        if key not in versions:
+            cache.add(key, _initial_version(), VERSION_TIMEOUT)
+            versions[key] = cache.get(key) or _initial_version()
+
+    return dict((keys[key], version) for key, version in versions.iteritems())
+
+def version_token(identifiers):
+    """Returns a string which changes whenever any of the named graphs change"""
+    versions = graph_versions(identifiers)
+    return '-'.join('%x' % versions[identifier] for identifier in sorted(versions, key=unicode))
+
+def last_modified(identifiers):
+    """
+    Returns the time (in seconds since the epoch) of the latest change to any of the named graphs with the given
+    identifiers (or to every graph). A graph whose time isn't known (it hasn't changed since the time was evicted
+    from the cache) is taken to have changed now, like a version which starts again.
+    """
+    cache = version_cache()
+
+    keys = [_modified_key(identifier) for identifier in set(identifiers) | set([ALL_GRAPHS])]
+    times = cache.get_many(keys)
+
+    for key in keys:
+        if key not in times:
+            cache.add(key, time.time(), VERSION_TIMEOUT)
+            times[key] = cache.get(key) or time.time()
+
+    return max(times.values())
+
+def bump(identifiers, sender=None):
+    """Increments the versions of the named graphs with the given identifiers, and sends graph_changed"""
+    cache = version_cache()
+
+    versions = {}
+    for identifier in set(identifiers):
+        key = _key(identifier)
+        try:
+            versions[identifier] = cache.incr(key)
+        except ValueError:
+            cache.add(key, _initial_version(), VERSION_TIMEOUT)
+            versions[identifier] = cache.get(key) or _initial_version()
+
+    if versions:
+        now = time.time()
+        cache.set_many(dict((_modified_key(identifier), now) for identifier in versions), VERSION_TIMEOUT)
+
+        graph_changed.send(sender=sender, identifiers=versions.keys(), versions=versions)
+
+    return versions
@@ -23,17 +23,17 @@ import rdflib.plugin
 from semantic_store import collection, permissions, manuscripts
 from semantic_store.models import ProjectPermission, UploadedImage
 from semantic_store.namespaces import NS, ns, bind_namespaces
-from semantic_store.utils import NegotiatedGraphResponse, JsonResponse, parse_request_into_graph, RDFLIB_SERIALIZER_FORMATS, get_title, metadata_triples
+from semantic_store.utils import NegotiatedGraphResponse, JsonResponse, parse_request_into_graph, RDFLIB_SERIALIZER_FORMATS, get_title, metadata_triples, accepts_gzip
 from semantic_store.rdfstore import rdfstore, default_identifier
 from semantic_store.annotation_views import create_or_update_annotations, get_annotations, search_annotations
-from semantic_store.projects import create_project_from_request, create_project, read_project, update_project, delete_triples_from_project, get_project_graph, project_export_graph, get_project_metadata_graph
-from semantic_store import uris
+from semantic_store.projects import create_project_from_request, create_project, read_project, update_project, delete_triples_from_project, get_project_graph, get_readable_project_graph, project_export_graph, get_project_metadata_graph
+from semantic_store import uris, result_cache, project_metadata, export, conditional, change_log, batch_reads, json_ld
 from semantic_store.users import read_user, update_user, remove_triples_from_user
 from semantic_store.canvases import read_canvas, update_canvas, remove_canvas_triples, create_canvas_from_upload
 from semantic_store.specific_resources import read_specific_resource, update_specific_resource
 from semantic_store.annotations import resource_annotation_subgraph
 
-from semantic_store.project_texts import create_project_text_from_request, read_project_text, update_project_text_from_request, remove_project_text
+from semantic_store.project_texts import create_project_text_from_request, read_project_text, update_project_text_from_request, remove_project_text, text_identifiers
 
 from semantic_store import text_search
 
@@ -229,9 +229,8 @@ def project_texts(request, project_uri, text_uri):
         logger.debug("$$$$$$$$$$$$$$$ POST $$$$$$$$$$$$$$")
         return create_project_text_from_request(request, project_uri, text_uri)
     elif request.method == 'GET':
-        g = read_project_text(project_uri, text_uri)
-        # logger.debug("$$$$$$$$$$$$$$$ g: " + str(g))
-        return NegotiatedGraphResponse(request, g)
+        return conditional.graph_response(request, text_identifiers(project_uri, text_uri),
+                                          lambda: NegotiatedGraphResponse(request, read_project_text(project_uri, text_uri)))
     elif request.method == 'PUT':
         logger.debug("$$$$$$$$$$$$$$$ PUT $$$$$$$$$$$$$$")
         return update_project_text_from_request(request, project_uri, text_uri)
@@ -260,7 +259,8 @@ def remove_user_triples(request, username):
 @check_project_resource_permissions
 def project_canvases(request, project_uri, canvas_uri):
     if request.method == 'GET':
-        return NegotiatedGraphResponse(request, read_canvas(request, project_uri, canvas_uri))
+        return conditional.graph_response(request, [uris.uri('semantic_store_projects', uri=project_uri)],
+                                          lambda: NegotiatedGraphResponse(request, read_canvas(request, project_uri, canvas_uri)))
     elif request.method == 'PUT':
         logger.debug('!!!!!!!!!!!!!!! views.py - project_canvases')
         input_graph = parse_request_into_graph(request)
@@ -299,28 +299,122 @@ def specific_resource_graph(request, project_uri, specific_resource, source):
         update_specific_resource(g, URIRef(project_uri), URIRef(specific_resource))
 
 class ProjectDownload(View):
+    """
+    Downloads a whole project. Line based formats (N-Triples and N-Quads) and JSON-LD are streamed from the store as
+    they are serialized (see semantic_store.export); other formats are built in memory. A download.<extension>.gz url
+    gives a gzipped file, and otherwise the download is gzipped in transit if the client accepts it.
+    """
     @method_decorator(check_project_resource_permissions)
-    def get(self, request, project_uri, extension):
-        format = 'turtle' if extension.lower() == 'ttl' else extension
-        if format not in RDFLIB_SERIALIZER_FORMATS:
-            return HttpResponseBadRequest()
-
+    def get(self, request, project_uri, extension, compressed=None):
+        extension = extension.lower()
         project_uri = URIRef(project_uri)
-        db_project_graph = get_project_graph(project_uri)
 
-        def serialization_iterator(project_uri, format):
-            yield ''
-            export_graph = project_export_graph(project_uri)
-            bind_namespaces(export_graph)
-            yield export_graph.serialize(format=format)
+        if extension in export.LINE_FORMATS:
+            format, mimetype = export.LINE_FORMATS[extension]
+            content = export.project_export_chunks(project_uri, format)
+        elif extension in export.JSON_LD_EXTENSIONS:
+            mimetype = json_ld.MIMETYPE
+            content = export.project_export_json_ld_chunks(project_uri)
+        else:
+            format = 'turtle' if extension == 'ttl' else extension
+            if format not in RDFLIB_SERIALIZER_FORMATS:
+                return HttpResponseBadRequest()
+
+            mimetype = 'text/%s' % extension
+
+            def serialization_iterator(project_uri, format):
+                yield ''
+                export_graph = project_export_graph(project_uri)
+                bind_namespaces(export_graph)
+                yield export_graph.serialize(format=format)
+
+            content = serialization_iterator(project_uri, format)
 
+        db_project_graph = get_project_graph(project_uri)
         project_title = get_title(db_project_graph, project_uri) or u'untitled project'
+        filename = '%s.%s' % (slugify(project_title), extension)
+
+        if compressed:
+            response = StreamingHttpResponse(export.gzip_chunks(content), mimetype='application/gzip')
+            filename += '.gz'
+        elif accepts_gzip(request):
+            response = StreamingHttpResponse(export.gzip_chunks(content), mimetype=mimetype)
+            response['Content-Encoding'] = 'gzip'
+        else:
+            response = StreamingHttpResponse(content, mimetype=mimetype)
 
-        response = StreamingHttpResponse(serialization_iterator(project_uri, format), mimetype='text/%s' % extension)
-        response['Content-Disposition'] = 'attachment; filename=%s.%s' % (slugify(project_title), extension)
+        response['Vary'] = 'Accept-Encoding'
+        response['Content-Disposition'] = 'attachment; filename=%s' % filename
 
         return response
 
+class ProjectBatchRead(View):
+    """
+    Reads many of a project's canvases, texts and specific resources, given as "uri" parameters, as a single graph
+    (see semantic_store.batch_reads). The uris may be POSTed as a form instead, when there are too many for a url;
+    either way, reading only needs read permission over the project.
+    """
+    def read(self, request, project_uri, resource_uris):
+        if not request.user.is_authenticated():
+            return HttpResponse(status=401)
+        if not permissions.has_permission_over(project_uri, user=request.user, permission=NS.perm.mayRead):
+            return HttpResponseForbidden()
+
+        if not resource_uris:
+            return HttpResponseBadRequest('At least one "uri" parameter is required')
+        if len(resource_uris) > batch_reads.MAX_RESOURCES:
+            return HttpResponseBadRequest('At most %d resources may be read at once' % batch_reads.MAX_RESOURCES)
+
+        project_uri = URIRef(project_uri)
+
+        return conditional.graph_response(request, batch_reads.resource_identifiers(project_uri, resource_uris),
+            lambda: NegotiatedGraphResponse(request, batch_reads.read_resources(project_uri, resource_uris)))
+
+    def get(self, request, project_uri):
+        return self.read(request, project_uri, request.GET.getlist('uri'))
+
+    def post(self, request, project_uri):
+        return self.read(request, project_uri, request.POST.getlist('uri'))
+
+class ProjectChanges(View):
+    """
+    The changes made to a project's graphs after the sequence given as "since", oldest first, in pages of up to
+    "limit" changes (see semantic_store.change_log). "next" is the sequence to ask for the changes after these,
+    and "more" says whether there are any yet. Without "since", no changes are returned, just the sequence to
+    start from, which should be fetched before loading the project.
+    """
+    @method_decorator(check_project_resource_permissions)
+    def get(self, request, project_uri):
+        if not change_log.enabled():
+            return HttpResponseNotFound('The change log is not enabled')
+
+        project_uri = URIRef(project_uri)
+
+        try:
+            since = int(request.GET['since']) if 'since' in request.GET else None
+            limit = min(int(request.GET.get('limit', change_log.DEFAULT_PAGE_SIZE)), change_log.MAX_PAGE_SIZE)
+        except ValueError:
+            return HttpResponseBadRequest('"since" and "limit" must be integers')
+
+        if limit < 1:
+            return HttpResponseBadRequest('"limit" must be at least 1')
+
+        if since is None:
+            return JsonResponse({'next': change_log.latest_sequence(project_uri), 'more': False, 'changes': []})
+
+        changes, more = change_log.changes_since(project_uri, since, limit)
+
+        return JsonResponse({
+            'next': changes[-1].sequence if changes else since,
+            'more': more,
+            'changes': [{
+                'sequence': change.sequence,
+                'graph': change.graph,
+                'op': change.op,
+                'triple': change.triple,
+            } for change in changes],
+        })
+
 class TextSearch(View):
     @method_decorator(check_project_resource_permissions)
     def get(self, request, project_uri):
@@ -351,26 +445,29 @@ class SearchAutocomplete(View):
 
 class Manuscript(View):
     def manuscript_graph(self, manuscript_uri, project_uri):
-        project_graph = get_project_graph(project_uri)
-        subgraph = manuscripts.manuscript_subgraph(project_graph, manuscript_uri)
+        project_identifier = uris.uri('semantic_store_projects', uri=project_uri)
+
+        def build():
+            subgraph = manuscripts.manuscript_subgraph(get_readable_project_graph(project_uri), manuscript_uri)
 
-        for canvas in subgraph.subjects(NS.rdf.type, NS.sc.Canvas):
-            if (canvas, NS.ore.isDescribedBy, None) not in subgraph:
-                canvas_url = uris.url('semantic_store_project_canvases', project_uri=project_uri, canvas_uri=canvas)
-                subgraph.add((canvas, NS.ore.isDescribedBy, canvas_url))
+            for canvas in subgraph.subjects(NS.rdf.type, NS.sc.Canvas):
+                if (canvas, NS.ore.isDescribedBy, None) not in subgraph:
+                    canvas_url = uris.url('semantic_store_project_canvases', project_uri=project_uri, canvas_uri=canvas)
+                    subgraph.add((canvas, NS.ore.isDescribedBy, canvas_url))
 
-        return subgraph
+            return subgraph
+
+        return result_cache.cached_graph('manuscript', [project_identifier], (project_uri, manuscript_uri), build)
 
     @method_decorator(check_project_resource_permissions)
     def get(self, request, project_uri, manuscript_uri=None):
         project_uri = URIRef(project_uri)
 
-        project_graph = get_project_graph(project_uri)
-
         if manuscript_uri:
             manuscript_uri = URIRef(manuscript_uri)
             return NegotiatedGraphResponse(request, self.manuscript_graph(manuscript_uri, project_uri))
         else:
+            project_graph = get_readable_project_graph(project_uri)
             graph = Graph()
 
             for manuscript in project_graph.subjects(NS.rdf.type, NS.sc.Manifest):
@@ -387,7 +484,7 @@ class CanvasTranscription(View):
         if transcription_uri:
             transcription_uri = URIRef(transcription_uri)
 
-            project_graph = get_project_graph(project_uri)
+            project_graph = get_readable_project_graph(project_uri)
 
             return NegotiatedGraphResponse(request, resource_annotation_subgraph(project_graph, transcription_uri))
 
@@ -415,7 +512,7 @@ class CanvasUpload(View):
         canvas_graph.add((project_uri, NS.ore.aggregates, uri))
 
         project_graph += canvas_graph
-        project_metadata_graph += canvas_graph
+        project_metadata.update_metadata(project_uri, canvas_graph)
 
         canvas_graph += metadata_triples(project_metadata_graph, project_uri)
         canvas_graph += project_metadata_graph.triples((project_uri, NS.ore.aggregates, None))
@@ -122,11 +122,13 @@ TEMPLATE_CONTEXT_PROCESSORS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'semantic_store.instrumentation.StoreInstrumentationMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'semantic_store.unit_of_work.UnitOfWorkMiddleware',
 )
 
 RDFLIB_STORE_IDENTIFIER = 'rdfstore'